@@ -0,0 +1,45 @@
+"""
+Time stile.FormatArray on a large unformatted array, comparing it to the old approach of building
+a tuple for every row.  Run from this directory with, eg,
+`python benchmark_format_array.py 1000000`.
+"""
+import sys
+import time
+import numpy
+try:
+    import stile
+except ImportError:
+    sys.path.append('..')
+    import stile
+
+
+def format_array_rowwise(d):
+    # The old implementation of the FormatArray reformatting step
+    dtype = ','.join([d.dtype.char]*d.shape[1])
+    return numpy.array([tuple(nd) for nd in d], dtype=dtype)
+
+
+def time_function(function, data, n_repeat=3):
+    best = None
+    for i in range(n_repeat):
+        t0 = time.time()
+        function(data)
+        dt = time.time()-t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def main(n_rows=1000000, n_cols=6):
+    data = numpy.random.random((n_rows, n_cols))
+    for name, function in [('row-by-row tuples', format_array_rowwise),
+                           ('FormatArray', stile.FormatArray),
+                           ('FormatArray, no copy', lambda d: stile.FormatArray(d, copy=False))]:
+        dt = time_function(function, data)
+        print '%20s: %10.4f s, %14.0f rows/s' % (name, dt, n_rows/dt)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
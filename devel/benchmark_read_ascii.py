@@ -0,0 +1,51 @@
+"""
+Time stile.ReadASCIITable on a large whitespace-delimited catalog of numbers, comparing the fast
+parser (with different numbers of worker processes) to numpy.genfromtxt.  Run from this directory
+with, eg, `python benchmark_read_ascii.py 1000000`.
+"""
+import sys
+import os
+import time
+import tempfile
+import multiprocessing
+import numpy
+try:
+    import stile
+except ImportError:
+    sys.path.append('..')
+    import stile
+
+
+def time_function(function, n_repeat=3):
+    best = None
+    for i in range(n_repeat):
+        t0 = time.time()
+        function()
+        dt = time.time()-t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def main(n_rows=1000000):
+    handle, file_name = tempfile.mkstemp()
+    data = numpy.random.random((n_rows, 6))
+    data[:, 0] = numpy.arange(n_rows)
+    numpy.savetxt(file_name, data, fmt='%d %.8g %.8g %.8g %.8g %.8g')
+    tests = [('genfromtxt', lambda: numpy.genfromtxt(file_name, dtype=None))]
+    n_workers = 1
+    while n_workers <= multiprocessing.cpu_count():
+        tests.append(('fast parser, %i workers' % n_workers,
+                      lambda n=n_workers: stile.ReadASCIITable(file_name, n_workers=n)))
+        n_workers *= 2
+    for name, function in tests:
+        dt = time_function(function)
+        print '%25s: %10.4f s, %12.0f rows/s' % (name, dt, n_rows/dt)
+    os.close(handle)
+    os.remove(file_name)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -30,15 +30,14 @@ def main():
 
     # do with binning
     data = dh.getData(data_ids[0],'galaxy lens','single','field','table')
-    # turns a list of binning schemes into a pseudo-nested list of single bins
-    expanded_bin_list = stile.ExpandBinList(bin_list)
-    handles_list = []
-    deletes_list = []
+    data2 = dh.getData(data_ids[1],'galaxy','single','field','table')
+    # assigns every row of data2 to one of the combinations of bins from the list of binning
+    # schemes (the same combinations that stile.ExpandBinList(bin_list) would return)
+    bin_assigner = stile.BinAssigner(bin_list, data2)
     # for each set of bins, do the systematics test as above
-    for bin_list in expanded_bin_list:
-        bins_name = '-'.join([bl.short_name for bl in bin_list])
-        data2 = dh.getData(data_ids[1],'galaxy','single','field','table',bin_list=bin_list)
-        results = sys_test(data, data2=data2, config=stile_args)
+    for single_bin_list, binned_data2 in bin_assigner:
+        bins_name = '-'.join([bl.short_name for bl in single_bin_list])
+        results = sys_test(data, data2=binned_data2, config=stile_args)
         stile.WriteASCIITable('realshear-'+bins_name+'.dat',results)
         fig = sys_test.plot(results)
         fig.savefig(sys_test.short_name+bins_name+'.png')
@@ -1,7 +1,9 @@
-from .file_io import (ReadFITSImage, ReadFITSTable, ReadASCIITable, ReadTable, WriteTable,
-                      WriteASCIITable, WriteFITSTable)
+from .file_io import (ReadFITSImage, ReadFITSTable, ReadASCIITable, ReadTable, IterTable,
+                      WriteTable, WriteASCIITable, WriteFITSTable, WriteColumnar, ReadColumnar,
+                      AsyncWriter, ResultStore, ExpandResultStore, OutputFingerprints,
+                      ColumnCache)
 from .stile_utils import Parser, FormatArray, fieldNames
-from .binning import BinList, BinStep, BinFunction, ExpandBinList
+from .binning import BinList, BinStep, BinFunction, ExpandBinList, BinAssigner
 from . import treecorr_utils
 from .treecorr_utils import ReadTreeCorrResultsFile
 from .data_handler import DataHandler
@@ -3,6 +3,7 @@ Contains definitions of Bin* classes that generate binning schemes and the Singl
 objects they create which can be applied to data to limit it to the bin in question.
 """
 #TODO: binning for images
+import itertools
 import numpy
 
 
@@ -353,3 +354,126 @@ def ExpandBinList(bin_list):
         data_bins = [[bin]+d for bin in this_bin() for d in data_bins]
     return data_bins
 
+
+
+class BinAssigner:
+    """
+    An object which assigns every row of a data array to a bin combination from a list of
+    :class:`Bin*` objects in one pass, rather than having each :class:`SingleBin` scan and copy the
+    whole array.  The bin combinations are the same as (and in the same order as) the ones returned
+    by :func:`ExpandBinList`, and each one selects exactly the rows that applying its
+    :class:`SingleBin`\s in turn would select, in the same order.
+
+    For :class:`BinList` and :class:`BinStep` objects (or anything else whose bins have ``field``,
+    ``low`` and ``high`` attributes and are contiguous), the bin of each row is found with
+    :func:`numpy.searchsorted`; for :class:`BinFunction` objects, the function is called once per
+    data array (or once per bin if it ``returns_bools``).  Each row ends up in at most one bin
+    combination, so bins from a single :class:`Bin*` object must not overlap.
+
+        >>> assigner = BinAssigner([BinStep('ra', low=-1, high=1, step=1),
+                                    BinStep('dec', low=-1, high=1, step=1)], data)
+        >>> for bins, bin_data in assigner:
+        ...     do_something(bin_data)
+
+    :param bin_list: A :class:`Bin*` object or a list of them, as for :func:`ExpandBinList`.
+    :param data:     The data array to be binned.
+    """
+
+    def __init__(self, bin_list, data):
+        if not isinstance(bin_list, (list, tuple)):
+            bin_list = [bin_list]
+        self.data = data
+        single_bin_lists = [bin_scheme() for bin_scheme in bin_list]
+        self.bins = [list(bins) for bins in itertools.product(*single_bin_lists)]
+        self.shape = tuple(len(single_bins) for single_bins in single_bin_lists)
+        if not single_bin_lists:
+            self.bin_index = numpy.zeros(0, dtype=int)
+        else:
+            indices = [self._assign(single_bins, data) for single_bins in single_bin_lists]
+            in_bin = numpy.all([index >= 0 for index in indices], axis=0)
+            # Bin combinations are ordered with the first Bin* object changing most slowly, which
+            # is the C ordering of a multi-dimensional index.
+            self.bin_index = numpy.full(len(data), -1, dtype=int)
+            self.bin_index[in_bin] = numpy.ravel_multi_index([index[in_bin] for index in indices],
+                                                             self.shape)
+        # A stable sort keeps the rows of each bin in their original order.
+        self._order = numpy.argsort(self.bin_index, kind='mergesort')
+        counts = numpy.bincount(self.bin_index[self.bin_index >= 0], minlength=len(self.bins))
+        self._offsets = numpy.concatenate([[0], numpy.cumsum(counts)]) + numpy.sum(
+                                                                            self.bin_index < 0)
+        self._sorted_data = None
+
+    def _assign(self, single_bins, data):
+        """
+        Return an array containing the position in ``single_bins`` of the bin each row of ``data``
+        belongs to, or -1 for rows in none of the bins.
+        """
+        index = numpy.full(len(data), -1, dtype=int)
+        if all(isinstance(b, SingleFunctionBin) for b in single_bins):
+            if any(b.__call__ == b._call_bool for b in single_bins):
+                # Only the function knows whether a row is in a given bin, so ask it for each bin.
+                for i, b in enumerate(single_bins):
+                    mask = numpy.asarray(b.function(data, b.n), dtype=bool)
+                    if numpy.any(index[mask] >= 0):
+                        raise ValueError('Bins from a single BinFunction overlap; BinAssigner '
+                                         'cannot assign rows to more than one bin')
+                    index[mask] = i
+                return index
+            values = single_bins[0].function(data)
+            for i, b in enumerate(single_bins):
+                index[values == b.n] = i
+            return index
+        order = numpy.argsort([b.low for b in single_bins], kind='mergesort')
+        lows = numpy.array([single_bins[i].low for i in order])
+        highs = numpy.array([single_bins[i].high for i in order])
+        if (len(set(b.field for b in single_bins)) != 1 or
+                numpy.any(lows[1:] != highs[:-1])):
+            # Not a simple contiguous binning of one field, so fall back to the individual bins.
+            for i, b in enumerate(single_bins):
+                field = data[b.field]
+                mask = numpy.logical_and(field >= b.low, field < b.high)
+                if numpy.any(index[mask] >= 0):
+                    raise ValueError('Bins overlap; BinAssigner cannot assign rows to more than '
+                                     'one bin')
+                index[mask] = i
+            return index
+        # Now edges[i] <= x < edges[i+1] for x in the ith bin, which is what we get from
+        # searchsorted with side='right' (minus 1).  NaNs sort to the end, so they aren't in any
+        # bin, just as for SingleBin.
+        edges = numpy.append(lows, highs[-1])
+        sorted_index = numpy.searchsorted(edges, data[single_bins[0].field], side='right')-1
+        in_bin = (sorted_index >= 0) & (sorted_index < len(single_bins))
+        index[in_bin] = order[sorted_index[in_bin]]
+        return index
+
+    def __len__(self):
+        return len(self.bins)
+
+    def getIndices(self, i):
+        """
+        Return the indices of the rows of the data in bin combination ``i``.
+
+        :param i:  The index of the bin combination in ``self.bins``.
+        :returns:  An array of row indices, in increasing order.
+        """
+        return self._order[self._offsets[i]:self._offsets[i+1]]
+
+    def getData(self, i):
+        """
+        Return the data in bin combination ``i``.  The first call to this method sorts a copy of
+        the data by bin combination, so this and later calls return a view of a contiguous piece of
+        that copy rather than a new copy.
+
+        :param i:  The index of the bin combination in ``self.bins``.
+        :returns:  The data in the bin combination.
+        """
+        if self._sorted_data is None:
+            self._sorted_data = self.data[self._order]
+        return self._sorted_data[self._offsets[i]:self._offsets[i+1]]
+
+    def __iter__(self):
+        """
+        Iterate over (list of :class:`SingleBin`\s, data in that bin combination) pairs.
+        """
+        for i, bins in enumerate(self.bins):
+            yield bins, self.getData(i)
@@ -11,6 +11,7 @@ except ImportError:
         has_fits = True
     except ImportError:
         has_fits = False
+import hashlib
 import numpy
 import os
 import stile_utils
@@ -37,21 +38,64 @@ def ReadFITSImage(file_name, hdu=0):
     else:
         raise ImportError('No FITS handler found!')
 
-def ReadFITSTable(file_name, hdu=1, fields=None):
+def ReadFITSTable(file_name, hdu=1, fields=None, columns=None, memmap=False):
     """
     This function exists so you can call ``ReadFITSTable(file_name)`` rather than remembering that
     table data is usually in extension 1, and also to automatically rewrite the fields if you want
     that.
 
+    If ``columns`` is given, only those columns are read into memory; this is most useful in
+    combination with ``memmap=True``, since then the other columns are never read from disk at all.
+    With ``memmap=True`` and no ``columns``, the returned array is backed by the memory-mapped
+    file, which stays open for as long as the array (or any view of it) is in use.
+
     :param file_name: A path leading to a valid FITS file.
     :param hdu:       The HDU in which the requested data is located [default: 1].
     :param fields:    A valid dict or list description of the fields in the file.  The list must
                       have the same number of items as there are fields; the dict takes the form
                       ``{'new_name': 'old_name'}`` or ``{'new_name': old_column_number}`` and can
-                      skip some fields.
+                      skip some fields.  If ``columns`` is given, column numbers refer to the
+                      position in ``columns`` rather than in the file.
+    :param columns:   A list of the column names or numbers to read.  [default: None, meaning read
+                      all columns]
+    :param memmap:    Whether to memory-map the file rather than reading the whole HDU into
+                      memory.  [default: False]
     :returns:         The contents of the requested HDU.
     """
-    return stile_utils.FormatArray(ReadFITSImage(file_name, hdu), fields=fields)
+    if not has_fits:
+        raise ImportError('No FITS handler found!')
+    fits_file = fits_handler.open(file_name, memmap=memmap)
+    try:
+        data = fits_file[hdu].data
+        if columns is not None:
+            data = _selectFITSColumns(data, columns)
+    finally:
+        # Memory-mapped data stays valid after the file is closed: the FITS handler only closes
+        # the memory map itself once no arrays refer to it anymore.
+        fits_file.close()
+    return stile_utils.FormatArray(data, fields=fields)
+
+
+def _selectFITSColumns(data, columns):
+    """
+    Copy the requested columns of a FITS table into a new array.  Only the requested columns are
+    accessed, so if ``data`` is memory-mapped, the rest of the table is never read.
+
+    :param data:    A FITS table (as returned by the ``.data`` attribute of the FITS handler's HDU
+                    objects).
+    :param columns: A list of the column names or numbers to read.
+    :returns:       A formatted NumPy array containing only the requested columns, in the order
+                    given.
+    """
+    names = [data.columns.names[column] if isinstance(column, (int, numpy.integer)) else column
+             for column in columns]
+    # Pulling the columns out with .field() applies any scaling defined by the FITS standard.
+    column_data = [data.field(name) for name in names]
+    dtype = [(name, col.dtype, col.shape[1:]) for name, col in zip(names, column_data)]
+    new_data = numpy.empty(len(data), dtype=dtype)
+    for name, col in zip(names, column_data):
+        new_data[name] = col
+    return new_data
 
 
 def ReadASCIITable(file_name, **kwargs):
@@ -60,10 +104,20 @@ def ReadASCIITable(file_name, **kwargs):
     returns the kind of array we expect.  The kwargs should be suitable kwargs
     from :func:`numpy.genfromtxt`.
 
+    Whitespace-delimited tables of numbers (with no kwargs other than ``comments``) are read with a
+    much faster parser, which infers the column types from the first lines of the file and then
+    parses the rest of the file, in ``n_workers`` processes if the file is large.  If the file
+    turns out not to be that simple (eg it has strings, blank lines, missing values, comments after
+    the header, lines with different numbers of values, or non-integer values in a column that
+    looked like integers), it falls back to :func:`numpy.genfromtxt`.
+
     :param file_name: A path leading to a valid FITS file.
     :param fields:    A valid dict or list description of the fields in the file.  The list must
                       have the same number of items as there are fields; the dict takes the form
                       ``{'new_name': old_column_number}`` and can skip some fields.
+    :param n_workers: The number of processes to use for the fast parser on files larger than
+                      ``_fast_ascii_parallel_bytes``; smaller files are always parsed in this
+                      process.  [default: 1]
     :param kwargs:    Other kwargs to be used by :func:`numpy.genfromtxt`\.
     :returns:         The contents of the requested file.
     """
@@ -71,8 +125,169 @@ def ReadASCIITable(file_name, **kwargs):
         fields = kwargs.pop('fields')
     else:
         fields = None
-    d = numpy.genfromtxt(file_name, dtype=None, **kwargs)
-    return stile_utils.FormatArray(d, fields=fields)
+    n_workers = kwargs.pop('n_workers', 1)
+    d = None
+    if set(kwargs) <= set(['comments']):
+        d = _fastReadASCIITable(file_name, n_workers=n_workers, **kwargs)
+    if d is None:
+        d = numpy.genfromtxt(file_name, dtype=None, **kwargs)
+    return stile_utils.FormatArray(d, fields=fields, copy=False)
+
+
+# Settings for the fast ASCII parser: the number of data lines used to infer the column types, the
+# approximate size in bytes of the pieces of the file parsed at once, and the size in bytes of the
+# data below which the file is parsed in this process (starting workers takes longer than that).
+_fast_ascii_infer_lines = 1000
+_fast_ascii_range_bytes = 32*1024*1024
+_fast_ascii_parallel_bytes = 16*1024*1024
+
+
+def _fastReadASCIITable(file_name, comments='#', n_workers=1):
+    """
+    Read a whitespace-delimited table of numbers from ``file_name``, returning None if the file
+    isn't simple enough for this method (see :func:`ReadASCIITable`).
+
+    The column types are inferred by running :func:`numpy.genfromtxt` on the first data lines.  The
+    rest of the file is split into byte ranges that start and end on line boundaries, each of which
+    is parsed by :func:`_parseASCIIRange` (in parallel if ``n_workers`` is more than 1 and the data
+    is larger than ``_fast_ascii_parallel_bytes``), and the results are copied into a single
+    preallocated array.
+    """
+    import multiprocessing
+    import itertools
+
+    with open(file_name, 'rb') as f:
+        # Skip the header (blank and comment lines), then collect some data lines to infer types.
+        data_start = 0
+        for line in f:
+            stripped = line.strip()
+            if stripped and not (comments and stripped.startswith(comments)):
+                break
+            data_start += len(line)
+        else:
+            return None
+        sample = [line]
+        sample += list(itertools.islice(f, _fast_ascii_infer_lines-1))
+        if comments and any(comments in line for line in sample):
+            return None
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        # Split the data into byte ranges, moving each boundary to the start of the next line.
+        if file_size-data_start < _fast_ascii_parallel_bytes:
+            n_workers = 1
+        n_ranges = max(n_workers, (file_size-data_start)//_fast_ascii_range_bytes+1)
+        boundaries = [data_start]
+        for i in range(1, n_ranges):
+            f.seek(max(data_start + i*(file_size-data_start)//n_ranges - 1, boundaries[-1]))
+            f.readline()
+            if f.tell() > boundaries[-1] and f.tell() < file_size:
+                boundaries.append(f.tell())
+        boundaries.append(file_size)
+
+    try:
+        sample = _genfromtxtQuiet(sample, dtype=None, comments=comments)
+    except ValueError:
+        # Let the fallback raise the error with the line numbers for the whole file.
+        return None
+    if sample.dtype.names and sample.ndim == 1:
+        types = [sample.dtype[name] for name in sample.dtype.names]
+    elif not sample.dtype.names and sample.ndim == 2:
+        types = [sample.dtype]*sample.shape[1]
+    else:
+        # Single lines and single columns have special shapes in genfromtxt; don't try to match.
+        return None
+    if any(t.kind not in ('i', 'f') for t in types):
+        return None
+
+    if types.count(types[0]) == len(types) and not sample.dtype.names:
+        dtype = ','.join([types[0].char]*len(types))
+    else:
+        dtype = [(name, t) for name, t in zip(sample.dtype.names, types)]
+    # Every line of a simple file is one row, so we can preallocate the output.
+    n_rows = 0
+    with open(file_name, 'rb') as f:
+        f.seek(data_start)
+        for piece in iter(lambda: f.read(1024*1024), ''):
+            n_rows += piece.count('\n')
+        if file_size > data_start and not piece.endswith('\n'):
+            n_rows += 1
+    d = numpy.empty(n_rows, dtype=dtype)
+
+    args = [(file_name, start, end, len(types), comments)
+            for start, end in zip(boundaries[:-1], boundaries[1:])]
+    if n_workers > 1 and len(args) > 1:
+        pool = multiprocessing.Pool(min(n_workers, len(args)))
+        blocks = pool.imap(_parseASCIIRange, args)
+    else:
+        pool = None
+        blocks = itertools.imap(_parseASCIIRange, args)
+    try:
+        start = 0
+        for result in blocks:
+            if result is None:
+                return None
+            block, float_columns = result
+            if start+len(block) > n_rows:
+                return None
+            for i, (name, t) in enumerate(zip(d.dtype.names, types)):
+                column = block[:, i]
+                # genfromtxt would have made a column floats if there were non-integers anywhere
+                # in it (even written as eg 5.0 or 1e3), and we can only represent integers
+                # exactly up to 2**53 as floats.
+                if t.kind == 'i' and (float_columns[i] or numpy.any(numpy.abs(column) > 2**53)):
+                    return None
+                d[name][start:start+len(block)] = column
+            start += len(block)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if start != n_rows:
+        return None
+    return d
+
+
+def _parseASCIIRange(args):
+    """
+    Parse the lines of a whitespace-delimited table of numbers between byte offsets ``start`` and
+    ``end`` of a file, returning a 2-d float array and a boolean array saying which columns have
+    any values written as floats (with a ``.``, an exponent, ``nan`` or ``inf``), or None if any
+    line doesn't have exactly ``n_cols`` numbers.  This is a module-level function so it can be
+    used by a :class:`multiprocessing.Pool`.
+
+    :param args: A tuple of (file_name, start, end, n_cols, comments).
+    """
+    import warnings
+    file_name, start, end, n_cols, comments = args
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        text = f.read(end-start)
+    if comments and comments in text:
+        return None
+    n_lines = text.count('\n')
+    if text and not text.endswith('\n'):
+        n_lines += 1
+    with warnings.catch_warnings():
+        # fromstring warns (and stops) if it finds something that isn't a number.
+        warnings.simplefilter('ignore')
+        values = numpy.fromstring(text, sep=' ')
+    if len(values) != n_lines*n_cols:
+        return None
+    # Check the number of values on each line, so a short line followed by a long one isn't read
+    # as two good lines: find where each value starts, and which line it's on.
+    chars = numpy.frombuffer(text, dtype=numpy.uint8)
+    is_space = numpy.in1d(chars, numpy.frombuffer(' \t\r\n', dtype=numpy.uint8))
+    is_start = numpy.logical_not(is_space)
+    is_start[1:] &= is_space[:-1]
+    line_numbers = numpy.cumsum(chars == ord('\n'))-(chars == ord('\n'))
+    if numpy.any(numpy.bincount(line_numbers[is_start], minlength=n_lines) != n_cols):
+        return None
+    # Then find the columns of any values with the characters of floats in them.
+    value_numbers = numpy.cumsum(is_start)-1
+    is_float = numpy.in1d(chars, numpy.frombuffer('.eEnNiI', dtype=numpy.uint8))
+    float_columns = numpy.zeros(n_cols, dtype=bool)
+    float_columns[numpy.unique(value_numbers[is_float] % n_cols)] = True
+    return values.reshape(n_lines, n_cols), float_columns
+
 
 # numpy.savetxt uses a completely different format specification language than the dtypes, so
 # this dict and the function _format_str take a formatted NumPy array and return something
@@ -251,23 +466,893 @@ def WriteTable(file_name, data_array, fields=None):
             WriteASCIITable(file_name, data_array, fields)
 
 
-def ReadTable(file_name, **kwargs):
+class AsyncWriter(object):
+    """
+    Write output files from a background thread, so that serializing tables and encoding figures
+    doesn't hold up the computation that produces them.
+
+    Writes are put on a queue of at most ``max_queued`` items; if the queue is full, the next write
+    waits for room, which bounds the memory held by outputs waiting to be written.  The writer
+    takes ownership of the arrays and figures it is given, so they should not be modified after
+    being passed to it.  Errors raised while writing are kept until :func:`close`, which waits for
+    the remaining writes and then raises the first of them.
+
+    Figures are drawn by the writer thread with their own Agg canvas, without going through
+    pyplot, whose global figure manager isn't thread-safe.  Figures managed by pyplot are closed
+    from the thread using the writer once they have been saved.
+
+    :param max_queued: The largest number of writes waiting at once. [default: 4]
+    """
+    def __init__(self, max_queued=4):
+        import Queue
+        import threading
+        self._queue = Queue.Queue(max_queued)
+        self.errors = []
+        # Figures the writer thread has finished with, to be closed by the calling thread.
+        self._saved_figures = []
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        import sys
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            func, args, kwargs = job
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                self.errors.append(sys.exc_info())
+
+    def submit(self, func, *args, **kwargs):
+        """Call ``func(*args, **kwargs)`` in the writer thread."""
+        self._closeSavedFigures()
+        if self._thread is None:
+            raise RuntimeError('Cannot write to a closed AsyncWriter')
+        self._queue.put((func, args, kwargs))
+
+    def writeASCIITable(self, file_name, data_array, **kwargs):
+        """Write ``data_array`` to ``file_name`` with :func:`WriteASCIITable`."""
+        self.submit(WriteASCIITable, file_name, data_array, **kwargs)
+
+    def saveFigure(self, fig, file_name, **kwargs):
+        """
+        Save the matplotlib figure ``fig`` to ``file_name`` (with ``kwargs`` as for
+        ``fig.savefig()``), then close it to release its memory.
+        """
+        self.submit(self._saveFigure, fig, file_name, **kwargs)
+
+    def _saveFigure(self, fig, file_name, **kwargs):
+        # Some sys tests return placeholder objects with a do-nothing savefig() instead of figures
+        import matplotlib.figure
+        if not isinstance(fig, matplotlib.figure.Figure):
+            fig.savefig(file_name, **kwargs)
+            return
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        try:
+            FigureCanvasAgg(fig).print_figure(file_name, **kwargs)
+        finally:
+            self._saved_figures.append(fig)
+
+    def _closeSavedFigures(self):
+        # Close (in the calling thread) the pyplot figures the writer thread has finished with.
+        while self._saved_figures:
+            import matplotlib.pyplot
+            matplotlib.pyplot.close(self._saved_figures.pop(0))
+
+    def close(self):
+        """
+        Wait for all the queued writes to finish and stop the writer thread.  If any of the writes
+        failed, raise the exception from the first failure.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._closeSavedFigures()
+        if self.errors:
+            exc_type, exc_value, exc_traceback = self.errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+
+class _OutputIndex(object):
+    """
+    An append-only index of outputs, each identified by a test name and a data ID (a dict such as
+    ``{'visit': 1228, 'ccd': 49}``), stored as one JSON line per entry.  The whole index is read
+    into a dict, so entries can be looked up directly.  A later entry for the same test and data ID
+    replaces an earlier one, and a line whose writing was interrupted is ignored.  Appends are
+    locked (with :func:`fcntl.lockf`), so several processes may share an index.
+    """
+    def __init__(self, index_file_name):
+        self.index_file_name = index_file_name
+        self._index = {}
+        self._index_position = 0
+        self.refresh()
+
+    @staticmethod
+    def _normalizeValue(value):
+        if isinstance(value, (list, tuple)):
+            return tuple([_OutputIndex._normalizeValue(v) for v in value])
+        if isinstance(value, numpy.generic):
+            return value.item()
+        return value
+
+    @staticmethod
+    def _key(test_name, data_id):
+        return (test_name, tuple(sorted([(key, _OutputIndex._normalizeValue(value))
+                                         for key, value in data_id.items()])))
+
+    def refresh(self):
+        """Read any index entries written (eg by another process) since the index was opened."""
+        import json
+        if not os.path.exists(self.index_file_name):
+            return
+        with open(self.index_file_name) as f:
+            f.seek(self._index_position)
+            while True:
+                line = f.readline()
+                # A line without a newline is still being written
+                if not line.endswith('\n'):
+                    break
+                self._index_position += len(line)
+                entry = json.loads(line)
+                self._index[self._key(entry['test_name'], entry['data_id'])] = entry
+
+    def _getEntry(self, test_name, data_id):
+        key = self._key(test_name, data_id)
+        if key not in self._index:
+            self.refresh()
+        return self._index.get(key)
+
+    def _appendEntry(self, test_name, data_id, **kwargs):
+        import fcntl
+        import json
+        entry = {'test_name': test_name,
+                 'data_id': dict([(key, self._normalizeValue(value))
+                                  for key, value in data_id.items()])}
+        entry.update(kwargs)
+        with open(self.index_file_name, 'a') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            try:
+                f.write(json.dumps(entry)+'\n')
+            finally:
+                f.flush()
+                fcntl.lockf(f, fcntl.LOCK_UN)
+        self._index[self._key(test_name, data_id)] = entry
+
+    def keys(self):
+        """Return a list of the ``(test_name, data_id)`` pairs of all the entries."""
+        return [(entry['test_name'], entry['data_id']) for entry in self._index.values()]
+
+    def __contains__(self, key):
+        return self._key(*key) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+
+class ResultStore(_OutputIndex):
+    """
+    A single file holding many result tables, each identified by the name of the test that made it
+    and a data ID (a dict such as ``{'visit': 1228, 'ccd': 49}``).  This replaces the many small
+    files written when each table goes to a file of its own, which can be slow on shared file
+    systems.
+
+    The tables are appended to ``file_name`` in NumPy's ``.npy`` format, and then an index line
+    for each (in JSON) is appended to ``file_name+'.index'``.  The index is read into a dict when
+    the store is opened, so any table can be looked up directly by test name and data ID.  Since
+    the files are only ever appended to, a table written again for the same test and data ID
+    replaces the earlier one, and a write that was interrupted before its index line was written is
+    ignored.  Writes are locked (with :func:`fcntl.lockf`), so several processes may write to the
+    same store.
+
+    :param file_name: The name of the file holding the tables.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        _OutputIndex.__init__(self, file_name+'.index')
+
+    def write(self, test_name, data_id, data_array, file_name=None):
+        """
+        Append a table to the store.
+
+        :param test_name:  The name of the test which made the table.
+        :param data_id:    A dict describing the data the test was run on.
+        :param data_array: A NumPy array.
+        :param file_name:  The name of the file the table would have been written to outside the
+                           store, relative to the output directory, for :func:`ExpandResultStore`.
+                           [default: None]
+        """
+        import fcntl
+        with open(self.file_name, 'ab') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                numpy.lib.format.write_array(f, numpy.asanyarray(data_array))
+                f.flush()
+                self._appendEntry(test_name, data_id, offset=offset, length=f.tell()-offset,
+                                  file_name=file_name)
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def read(self, test_name, **data_id):
+        """
+        Return the table written for ``test_name`` and the data ID given by the keyword
+        arguments, eg ``store.read('rho1', visit=1228, ccd=49)``.  Raises a :exc:`KeyError` if
+        there is no such table.
+        """
+        entry = self._getEntry(test_name, data_id)
+        if entry is None:
+            raise KeyError('No results for test %s with data ID %s'%(test_name, data_id))
+        return self._readEntry(entry)
+
+    def _readEntry(self, entry):
+        with open(self.file_name, 'rb') as f:
+            f.seek(entry['offset'])
+            return numpy.lib.format.read_array(f)
+
+
+class OutputFingerprints(_OutputIndex):
+    """
+    A record of the fingerprints of the inputs that each set of outputs was made from, so that
+    outputs whose inputs haven't changed need not be made again.  A fingerprint is any string
+    (usually a hash) describing the inputs, and each entry is identified by a test name and a data
+    ID, as for :class:`ResultStore`.  The record is kept in ``file_name``, one JSON line per
+    entry.
+
+    :param file_name: The name of the file holding the fingerprints.
+    """
+    def __init__(self, file_name):
+        _OutputIndex.__init__(self, file_name)
+
+    @staticmethod
+    def testFingerprint(input_fingerprint, test_name, test_config=''):
+        """
+        Return the fingerprint of the outputs of one test: a hash of the fingerprint of the inputs
+        shared by all the tests, the test's name and a description of its own configuration.
+        """
+        return hashlib.sha1(repr((input_fingerprint, test_name, test_config))).hexdigest()
+
+    def findStale(self, data_id, input_fingerprint, test_configs):
+        """
+        Find the tests whose outputs for ``data_id`` need to be made again.
+
+        :param data_id:           A dict describing the data the tests are run on.
+        :param input_fingerprint: A string describing the inputs shared by all the tests.
+        :param test_configs:      A list of ``(test_name, test_config)`` pairs, where
+                                  ``test_config`` is a string describing the configuration of that
+                                  test alone, so that changing it only affects that test.
+        :returns:                 A list of the names of the tests that aren't current (see
+                                  :func:`isCurrent`), in the order given, and a dict of the
+                                  fingerprint of each test to :func:`record` once they're made.
+        """
+        test_fingerprints = dict([(test_name,
+                                   self.testFingerprint(input_fingerprint, test_name, test_config))
+                                  for test_name, test_config in test_configs])
+        # Many tests share a store, so open each one (and read its index) only once
+        stores = {}
+        stale = [test_name for test_name, test_config in test_configs
+                 if not self.isCurrent(test_name, data_id, test_fingerprints[test_name],
+                                       stores=stores)]
+        return stale, test_fingerprints
+
+    def record(self, test_name, data_id, fingerprint, outputs=(), stores=()):
+        """
+        Record that ``outputs`` were made by ``test_name`` for ``data_id`` from inputs with the
+        given ``fingerprint``.
+
+        :param test_name:   The name of the test.
+        :param data_id:     A dict describing the data the test was run on.
+        :param fingerprint: A string describing the inputs.
+        :param outputs:     The names of the files written, relative to the directory of the
+                            fingerprint file. [default: ()]
+        :param stores:      The names of any :class:`ResultStore` files (relative to the same
+                            directory) the test's tables were written to, under ``test_name`` and
+                            ``data_id``. [default: ()]
+        """
+        self._appendEntry(test_name, data_id, fingerprint=fingerprint, outputs=list(outputs),
+                          stores=list(stores))
+
+    def isCurrent(self, test_name, data_id, fingerprint, stores=None):
+        """
+        Return True if the outputs of ``test_name`` for ``data_id`` were made from inputs with the
+        given ``fingerprint``, all of the output files still exist, and any result stores they were
+        written to still hold the test's tables.
+
+        :param stores: A dict of the :class:`ResultStore` objects already opened, keyed by file
+                       name, to reuse across calls; stores opened here are added to it.
+                       [default: None, to open the stores afresh]
+        """
+        entry = self._getEntry(test_name, data_id)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return False
+        output_dir = os.path.dirname(self.index_file_name)
+        if not all([os.path.exists(os.path.join(output_dir, output))
+                    for output in entry['outputs']]):
+            return False
+        if stores is None:
+            stores = {}
+        for store in entry.get('stores', []):
+            store_file_name = os.path.join(output_dir, store)
+            if store_file_name not in stores:
+                stores[store_file_name] = ResultStore(store_file_name)
+            if (test_name, data_id) not in stores[store_file_name]:
+                return False
+        return True
+
+
+def ExpandResultStore(store_file_name, output_dir):
+    """
+    Write each table in a :class:`ResultStore` to an ASCII file of its own, as it would have been
+    written without the store: to the ``file_name`` given when it was stored, relative to
+    ``output_dir``.  Tables stored without a ``file_name`` are skipped.
+
+    :param store_file_name: The name of the store's file.
+    :param output_dir:      The directory to write the tables to.
+    :returns:               A list of the files written.
+    """
+    store = ResultStore(store_file_name)
+    written = []
+    for entry in store._index.values():
+        if entry['file_name'] is None:
+            continue
+        file_name = os.path.join(output_dir, entry['file_name'])
+        if not os.path.isdir(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+        WriteASCIITable(file_name, store._readEntry(entry), print_header=True)
+        written.append(file_name)
+    return written
+
+
+class ColumnCache(object):
+    """
+    A persistent cache of columns derived from a catalog, such as shapes or magnitudes computed
+    from its measurements, so that different runs over the same catalog need only compute each of
+    them once.  Rows are identified by source ID, so the cache can be shared by catalogs that
+    contain different subsets of the same sources.  As in the HSC tasks, ``nan`` marks a value
+    that hasn't been computed; each column also has a validity mask, which is False for rows whose
+    values were computed but shouldn't be used (eg because of a measurement flag).
+
+    The cache is stored in Stile's columnar format (see :func:`WriteColumnar`) in ``dir_name``, and
+    the columns that are requested are memory-mapped, so only the rows of them that match ``ids``
+    are read from disk.  It is only written when
+    :func:`write` is called; the new version replaces the old one all at once, so other processes
+    reading it never see a partial write.
+
+    :param dir_name:    The directory holding the cache.
+    :param ids:         The source IDs of the rows of the catalog.
+    :param fingerprint: A string describing the inputs the columns are computed from.  A cache
+                        written with a different fingerprint is ignored, and replaced when this one
+                        is written.
+    """
+    def __init__(self, dir_name, ids, fingerprint):
+        self.dir_name = dir_name
+        self.ids = numpy.asarray(ids)
+        self.fingerprint = fingerprint
+        self._columns = {}
+        self._changed = False
+
+    def _storedNames(self):
+        # The names of the columns on disk, or None if there's no usable cache there.
+        manifest = _readColumnarManifest(self.dir_name)
+        if manifest is None or manifest.get('metadata') != {'fingerprint': self.fingerprint}:
+            return None
+        return [str(c['name']) for c in manifest['columns']
+                if c['name'] != 'id' and not c['name'].endswith('.valid')]
+
+    def _matchRows(self, stored_ids):
+        # Return a mask of our rows that are in stored_ids, and the indices of those rows in it.
+        if len(stored_ids) == len(self.ids) and numpy.all(stored_ids == self.ids):
+            return numpy.ones(len(self.ids), dtype=bool), numpy.arange(len(self.ids))
+        if not len(stored_ids):
+            return numpy.zeros(len(self.ids), dtype=bool), numpy.zeros(0, dtype=int)
+        order = numpy.argsort(stored_ids, kind='mergesort')
+        positions = numpy.searchsorted(stored_ids[order], self.ids)
+        positions[positions == len(stored_ids)] = 0
+        found = stored_ids[order][positions] == self.ids
+        return found, order[positions[found]]
+
+    def getColumn(self, name):
+        """
+        Return the values and the validity mask of the column ``name``, in the order of ``ids``.
+        Rows not in the cache are ``nan`` and valid.  These are the cache's own arrays, so they
+        should be changed only through :func:`update`.
+        """
+        if name not in self._columns:
+            values = numpy.empty(len(self.ids))
+            values.fill(numpy.nan)
+            valid = numpy.ones(len(self.ids), dtype=bool)
+            stored_names = self._storedNames()
+            if stored_names and name in stored_names:
+                stored = ReadColumnar(self.dir_name, columns=['id', name, name+'.valid'],
+                                      as_columns=True)
+                found, stored_rows = self._matchRows(stored['id'])
+                values[found] = stored[name][stored_rows]
+                valid[found] = stored[name+'.valid'][stored_rows]
+            self._columns[name] = (values, valid)
+        return self._columns[name]
+
+    def update(self, name, rows, values, valid=None):
+        """
+        Set the values (and optionally the validity mask) of the column ``name`` for some rows.
+
+        :param name:   The name of the column.
+        :param rows:   A boolean mask or index array picking out the rows to set.
+        :param values: The values for those rows.
+        :param valid:  The validity mask for those rows. [default: None, meaning all valid]
+        """
+        column_values, column_valid = self.getColumn(name)
+        column_values[rows] = values
+        column_valid[rows] = True if valid is None else valid
+        self._changed = True
+
+    def write(self):
+        """
+        Write the cache to disk, if anything has been updated.  Cached columns and sources that
+        weren't used here are kept.  If another process replaces the cache at the same time, this
+        write is dropped, and the columns will be computed again next time.
+        """
+        import shutil
+        if not self._changed:
+            return
+        # The whole cache is rewritten, so start from what's there now.
+        stored_names = self._storedNames() or []
+        if stored_names:
+            stored = ReadColumnar(self.dir_name, as_columns=True)
+            found, stored_rows = self._matchRows(stored['id'])
+            unmatched = numpy.ones(len(stored['id']), dtype=bool)
+            unmatched[stored_rows] = False
+            # Copy out the rows we keep, so the memory-mapped files can be replaced below.
+            stored = dict([(key, stored[key][unmatched]) for key in stored])
+        else:
+            stored = {'id': numpy.zeros(0, dtype=self.ids.dtype)}
+        names = sorted(set(stored_names) | set(self._columns))
+        n_rows = len(self.ids)
+        dtype = [('id', self.ids.dtype)]
+        for name in names:
+            dtype += [(name, float), (name+'.valid', bool)]
+        data = numpy.empty(n_rows+len(stored['id']), dtype=dtype)
+        data['id'][:n_rows] = self.ids
+        data['id'][n_rows:] = stored['id']
+        for name in names:
+            data[name][:n_rows], data[name+'.valid'][:n_rows] = self.getColumn(name)
+            if name in stored_names:
+                data[name][n_rows:] = stored[name]
+                data[name+'.valid'][n_rows:] = stored[name+'.valid']
+            else:
+                data[name][n_rows:] = numpy.nan
+                data[name+'.valid'][n_rows:] = True
+        tmp_dir_name = '%s.%i.tmp'%(self.dir_name, os.getpid())
+        WriteColumnar(tmp_dir_name, data, metadata={'fingerprint': self.fingerprint})
+        old_dir_name = None
+        try:
+            if os.path.exists(self.dir_name):
+                old_dir_name = '%s.%i.old'%(self.dir_name, os.getpid())
+                os.rename(self.dir_name, old_dir_name)
+            os.rename(tmp_dir_name, self.dir_name)
+        except OSError:
+            shutil.rmtree(tmp_dir_name, ignore_errors=True)
+        if old_dir_name:
+            shutil.rmtree(old_dir_name, ignore_errors=True)
+        self._changed = False
+
+
+def ReadTable(file_name, use_cache=True, write_cache=False, as_columns=False, **kwargs):
     """
     Pick a proper (FITS or ASCII) reading function for a file containing a table and read the file
     in.  If ``file_name`` has an extention, it will be used to determine the file type (``.fit`` or
     ``.fits`` in any capitalization will be FITS, else ASCII); if no extension, it will try reading
     it as a FITS file, then as an ASCII file.  If you know which kind of file you want to read,
     you should use :func:`WriteFITSTable` or :func:`WriteASCIITable` directly.
+
+    If there is an up-to-date columnar cache of the file (see :func:`WriteColumnar`) made with the
+    same kwargs next to the file, it is read instead of the file itself.  Such a cache is written
+    when you call this function with ``write_cache=True``.  With ``as_columns=True``, a cached
+    table is memory-mapped rather than read (see :func:`ReadColumnar`).
+
+    :param file_name:   A path leading to a valid FITS or ASCII file.
+    :param use_cache:   Whether to read from an up-to-date columnar cache, if one exists.
+                        [default: True]
+    :param write_cache: Whether to write a columnar cache of the file after reading it (if the data
+                        did not come from the cache). [default: False]
+    :param as_columns:  Whether to return an ordered dict of column arrays, keyed by (field) name,
+                        instead of a formatted NumPy array. [default: False]
+    :param kwargs:      Other kwargs for :func:`ReadFITSTable` or :func:`ReadASCIITable`.
+    :returns:           The contents of the requested file.
     """
+    fields = kwargs.pop('fields', None)
+    cache_name = _columnarCacheName(file_name)
+    # These kwargs don't change what's read from the file, so the cache doesn't need to match them.
+    # The rest are converted for the manifest now, since the readers may change them (eg
+    # genfromtxt replaces converters).
+    read_kwargs = _jsonKwargs(dict([(key, kwargs[key]) for key in kwargs
+                                    if key not in ['memmap', 'n_workers']]))
+    if use_cache and _isFreshColumnarCache(cache_name, file_name, read_kwargs):
+        return ReadColumnar(cache_name, fields=fields, as_columns=as_columns)
     ext = os.path.splitext(file_name)[1]
     if not ext:
         try:
-            return ReadFITSTable(file_name, **kwargs)
+            data = ReadFITSTable(file_name, **kwargs)
         except:
-            return ReadASCIITable(file_name, **kwargs)
-    ext = ext.lower()
-    if ext == '.fit' or ext == '.fits':
-        return ReadFITSTable(file_name, **kwargs)
+            data = ReadASCIITable(file_name, **kwargs)
+    else:
+        ext = ext.lower()
+        if ext == '.fit' or ext == '.fits':
+            data = ReadFITSTable(file_name, **kwargs)
+        else:
+            data = ReadASCIITable(file_name, **kwargs)
+    if write_cache:
+        WriteColumnar(cache_name, data, source_file=file_name, read_kwargs=read_kwargs)
+    data = stile_utils.FormatArray(data, fields=fields, copy=False)
+    if as_columns:
+        import collections
+        return collections.OrderedDict([(name, data[name]) for name in data.dtype.names])
+    return data
+
+
+# The name of the manifest file in a columnar table directory, and the version of the format.
+_columnar_manifest = 'manifest.json'
+_columnar_version = 1
+
+
+def WriteColumnar(dir_name, data_array, fields=None, source_file=None, read_kwargs=None,
+                  metadata=None):
+    """
+    Write a formatted NumPy array to a directory in Stile's columnar format: one ``.npy`` file per
+    column, plus a JSON manifest (``manifest.json``) describing the dtype and number of rows and,
+    if the table is a cache of another file, the size, modification time and MD5 checksum of that
+    file.  The manifest is written last, so a directory whose writing was interrupted will not be
+    read as a valid table.
+
+    :param dir_name:    The directory to write to.  It is created if it doesn't exist.
+    :param data_array:  A formatted NumPy array.
+    :param fields:      A fields specification, as for :func:`WriteTable`. [default: None]
+    :param source_file: The file this is a cache of, if any. [default: None]
+    :param read_kwargs: The kwargs used to read ``source_file``, if any. [default: None]
+    :param metadata:    Any other (JSON-serializable) information to record in the manifest.
+                        [default: None]
+    """
+    if fields:
+        data = _handleFields(data_array, fields)
+    else:
+        data = data_array
+    if not hasattr(data, 'dtype') or not data.dtype.names:
+        raise TypeError('WriteColumnar requires a formatted NumPy array')
+    if not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+    columns = []
+    for i, name in enumerate(data.dtype.names):
+        column = numpy.ascontiguousarray(data[name])
+        column_file = 'column_%i.npy'%i
+        numpy.save(os.path.join(dir_name, column_file), column)
+        columns.append({'name': name, 'file': column_file, 'dtype': column.dtype.str,
+                        'shape': list(column.shape[1:])})
+    manifest = {'version': _columnar_version, 'n_rows': len(data), 'columns': columns,
+                'source': _fileInfo(source_file, checksum=True) if source_file else None,
+                'read_kwargs': _jsonKwargs(read_kwargs), 'metadata': metadata}
+    _writeColumnarManifest(dir_name, manifest)
+
+
+def _writeColumnarManifest(dir_name, manifest):
+    """
+    Write the manifest of a columnar table, replacing any old one all at once.
+    """
+    import json
+    manifest_file = os.path.join(dir_name, _columnar_manifest)
+    with open(manifest_file+'.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(manifest_file+'.tmp', manifest_file)
+
+
+def _jsonKwargs(kwargs):
+    """
+    Return ``kwargs`` as they would come back from JSON, so they can be stored in and compared with
+    a columnar manifest.  Values JSON can't represent (eg dtypes) are replaced by their ``repr``,
+    so kwargs such as open files, whose ``repr`` differs each time, never match a cache.
+    """
+    import json
+    return json.loads(json.dumps(kwargs, default=repr))
+
+
+def ReadColumnar(dir_name, fields=None, columns=None, as_columns=False):
+    """
+    Read a table written by :func:`WriteColumnar`.  Only the columns that are requested are read
+    from disk.
+
+    With ``as_columns=True``, each column file is memory-mapped and the columns are returned
+    separately, so reading the table costs almost nothing until the values are used.  Otherwise
+    the columns are read in full and packed into a single formatted NumPy array.
+
+    :param dir_name:   The directory containing the table.
+    :param fields:     A fields specification, as for :func:`ReadFITSTable`. [default: None]
+    :param columns:    A list of the column names or numbers to read. [default: None, meaning read
+                       all columns]
+    :param as_columns: Whether to return an ordered dict of read-only memory-mapped column arrays,
+                       keyed by (field) name, instead of a formatted NumPy array. [default: False]
+    :returns:          A formatted NumPy array, or an ordered dict of column arrays.
+    """
+    manifest = _readColumnarManifest(dir_name)
+    if manifest is None:
+        raise IOError('No valid columnar table found in %s'%dir_name)
+    column_info = manifest['columns']
+    if columns is not None:
+        names = [column_info[column]['name'] if isinstance(column, (int, numpy.integer))
+                 else column for column in columns]
+        column_info = [[c for c in column_info if c['name'] == name][0] for name in names]
+    if as_columns:
+        import collections
+        # Empty arrays can't be memory-mapped, but they cost nothing to read anyway.
+        mmap_mode = 'r' if manifest['n_rows'] else None
+        names = _renameColumns([str(c['name']) for c in column_info], fields)
+        return collections.OrderedDict(
+            [(name, numpy.load(os.path.join(dir_name, c['file']), mmap_mode=mmap_mode))
+             for name, c in zip(names, column_info)])
+    # JSON gives us unicode strings, which (Python 2) NumPy doesn't accept as field names.
+    dtype = [(str(c['name']), str(c['dtype']), tuple(c['shape'])) for c in column_info]
+    data = numpy.empty(manifest['n_rows'], dtype=dtype)
+    for c in column_info:
+        data[str(c['name'])] = numpy.load(os.path.join(dir_name, c['file']))
+    return stile_utils.FormatArray(data, fields=fields)
+
+
+def _renameColumns(names, fields):
+    """
+    Return the list of column ``names`` renamed according to the fields specification ``fields``,
+    as :func:`FormatArray <stile.stile_utils.FormatArray>` would rename the fields of an array.
+    """
+    names = list(names)
+    if not fields:
+        pass
+    elif isinstance(fields, dict):
+        for key in fields:
+            names[fields[key]] = key
+    elif len(fields) == len(names):
+        names = list(fields)
     else:
-        return ReadASCIITable(file_name, **kwargs)
+        raise RuntimeError('Cannot use given fields: '+str(fields))
+    return names
+
+
+def _readColumnarManifest(dir_name):
+    """
+    Return the manifest of a columnar table as a dict, or None if there isn't a valid one.
+    """
+    import json
+    manifest_file = os.path.join(dir_name, _columnar_manifest)
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != _columnar_version:
+        return None
+    return manifest
+
+
+def _columnarCacheName(file_name):
+    """
+    The name of the columnar cache directory for ``file_name``.
+    """
+    return file_name+'.columnar'
+
 
+def _fileInfo(file_name, checksum=False):
+    """
+    Return a dict with the size and modification time of ``file_name``, plus its MD5 checksum if
+    ``checksum`` is True.
+    """
+    info = {'size': os.path.getsize(file_name), 'mtime': os.path.getmtime(file_name)}
+    if checksum:
+        md5 = hashlib.md5()
+        with open(file_name, 'rb') as f:
+            for piece in iter(lambda: f.read(1024*1024), ''):
+                md5.update(piece)
+        info['checksum'] = md5.hexdigest()
+    return info
+
+
+def _isFreshColumnarCache(cache_name, file_name, read_kwargs):
+    """
+    Determine whether the columnar cache ``cache_name`` is an up-to-date copy of ``file_name``,
+    read with ``read_kwargs``.  The file is only checksummed if its size matches the cache's
+    record but its modification time doesn't; if the checksum matches, the new modification time
+    is recorded so the file isn't checksummed again next time.
+    """
+    manifest = _readColumnarManifest(cache_name)
+    if manifest is None or not manifest['source'] or not os.path.isfile(file_name):
+        return False
+    # Compare the kwargs as they come back from JSON, since eg tuples become lists
+    if _jsonKwargs(read_kwargs) != manifest['read_kwargs']:
+        return False
+    source = manifest['source']
+    info = _fileInfo(file_name)
+    if info['size'] != source['size']:
+        return False
+    if info['mtime'] == source['mtime']:
+        return True
+    if _fileInfo(file_name, checksum=True)['checksum'] != source['checksum']:
+        return False
+    source['mtime'] = info['mtime']
+    try:
+        _writeColumnarManifest(cache_name, manifest)
+    except (IOError, OSError):
+        # The cache is still good even if we can't update it (eg it's read-only)
+        pass
+    return True
+
+
+def IterTable(file_name, chunk_rows=100000, columns=None, fields=None, **kwargs):
+    """
+    Read a (FITS or ASCII) table in chunks of at most ``chunk_rows`` rows, so that tables larger
+    than the available memory can be processed piece by piece.  The file type is determined as for
+    :func:`ReadTable`, except that files without an extension are checked for a FITS header rather
+    than attempting to read them both ways.  Concatenating the chunks gives the same array as
+    :func:`ReadTable` would return.
+
+    FITS files are memory-mapped, so only the rows (and columns) in the current chunk are read.
+    ASCII files are read twice: once to determine the column types for the whole file (since
+    :func:`numpy.genfromtxt` infers them from the data, and a single chunk may not be
+    representative), and once to return the data.  For ASCII files, ``chunk_rows`` counts lines of
+    the file, so chunks may have fewer rows than that if there are comments or blank lines.  ASCII
+    files with a single column are not supported.
+
+    :param file_name:  A path leading to a valid FITS or ASCII file.
+    :param chunk_rows: The maximum number of rows in each returned array. [default: 100000]
+    :param columns:    A list of the column names or numbers to read. [default: None, meaning read
+                       all columns]
+    :param fields:     A valid dict or list description of the fields in the file, as for
+                       :func:`ReadFITSTable` or :func:`ReadASCIITable`.
+    :param kwargs:     Other kwargs for the FITS (``hdu``) or ASCII (the kwargs of
+                       :func:`numpy.genfromtxt`) readers.  ``skip_footer`` is not supported.
+    :returns:          A generator yielding formatted NumPy arrays.
+    """
+    if chunk_rows < 1:
+        raise ValueError('chunk_rows must be at least 1, not %s'%chunk_rows)
+    if _isFITSFile(file_name):
+        return _iterFITSTable(file_name, chunk_rows, columns, fields, **kwargs)
+    else:
+        return _iterASCIITable(file_name, chunk_rows, columns, fields, **kwargs)
+
+
+def _isFITSFile(file_name):
+    """
+    Determine whether a file should be treated as a FITS file: by extension if it has one (as for
+    :func:`ReadTable`), otherwise by checking for the mandatory first FITS header card.
+    """
+    ext = os.path.splitext(file_name)[1]
+    if ext:
+        return ext.lower() == '.fit' or ext.lower() == '.fits'
+    with open(file_name, 'rb') as f:
+        return f.read(9) == 'SIMPLE  ='
+
+
+def _iterFITSTable(file_name, chunk_rows, columns, fields, hdu=1):
+    """
+    Generator for :func:`IterTable` for FITS files.
+    """
+    if not has_fits:
+        raise ImportError('No FITS handler found!')
+    fits_file = fits_handler.open(file_name, memmap=True)
+    try:
+        data = fits_file[hdu].data
+        if columns is None:
+            columns = data.columns.names
+        for start in range(0, len(data), chunk_rows):
+            # Copying the selected columns out of the memory map means we never hold more than one
+            # chunk in memory.
+            chunk = _selectFITSColumns(data[start:start+chunk_rows], columns)
+            yield stile_utils.FormatArray(chunk, fields=fields)
+    finally:
+        fits_file.close()
+
+
+def _iterLines(file_name, chunk_rows, skip_header=0):
+    """
+    Generator returning lists of at most ``chunk_rows`` lines from the file ``file_name``, after
+    skipping the first ``skip_header`` lines.
+    """
+    import itertools
+    with open(file_name) as f:
+        for line in itertools.islice(f, skip_header):
+            pass
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                break
+            yield lines
+
+
+def _genfromtxtQuiet(lines, **kwargs):
+    """
+    Call :func:`numpy.genfromtxt` on a list of lines, ignoring the warnings about empty input that
+    happen for chunks of a file that are all comments.
+    """
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return numpy.genfromtxt(lines, **kwargs)
+
+
+def _readASCIIChunk(lines, first, names, **kwargs):
+    """
+    Read a list of lines with :func:`numpy.genfromtxt`, returning a formatted array with at least
+    one dimension (or None if there was no data in the lines).  ``names`` is only passed through
+    for the first chunk, since that's where any header line will be.
+    """
+    d = _genfromtxtQuiet(lines, names=names if first else None, **kwargs)
+    if not d.size:
+        return None
+    return stile_utils.FormatArray(numpy.atleast_1d(d), copy=False)
+
+
+def _mergeASCIITypes(type1, type2):
+    """
+    Return the type numpy.genfromtxt would infer for a column if part of it was inferred to be of
+    type ``type1`` and part of type ``type2``, and whether the width of a resulting string column
+    needs to be recomputed (since the width of numbers as text isn't known).
+    """
+    if type1 == type2:
+        return type1, False
+    string_kinds = ('S', 'U')
+    if type1.kind in string_kinds and type2.kind in string_kinds:
+        return numpy.promote_types(type1, type2), False
+    if (type1.kind in string_kinds or type2.kind in string_kinds or
+            type1.kind == 'b' or type2.kind == 'b'):
+        # genfromtxt falls back to strings for mixed types, and can't upgrade booleans to numbers.
+        return numpy.dtype('S'), True
+    return numpy.promote_types(type1, type2), False
+
+
+def _iterASCIITable(file_name, chunk_rows, columns, fields, **kwargs):
+    """
+    Generator for :func:`IterTable` for ASCII files.
+    """
+    if 'skip_footer' in kwargs:
+        raise ValueError('skip_footer cannot be used when reading a file in chunks')
+    if columns is not None:
+        kwargs['usecols'] = columns
+    skip_header = kwargs.pop('skip_header', 0)
+    names = kwargs.pop('names', None)
+    dtype = kwargs.pop('dtype', None)
+    if dtype is None:
+        # First pass: infer the type of each column over the whole file.
+        rewidth = set()
+        for i, lines in enumerate(_iterLines(file_name, chunk_rows, skip_header)):
+            d = _readASCIIChunk(lines, i == 0, names, dtype=None, **kwargs)
+            if d is None:
+                continue
+            if dtype is None:
+                dtype = [[name, d.dtype[name]] for name in d.dtype.names]
+                continue
+            if len(d.dtype) != len(dtype):
+                raise ValueError('Inconsistent number of columns in file %s'%file_name)
+            for field, name in zip(dtype, d.dtype.names):
+                field[1], needs_rewidth = _mergeASCIITypes(field[1], d.dtype[name])
+                if needs_rewidth:
+                    rewidth.add(field[0])
+        if dtype is None:
+            return
+        if rewidth:
+            # Columns with a mix of numbers and strings become strings as wide as the longest
+            # entry, so we need to go back and read those columns as text.
+            usecols = kwargs.get('usecols', range(len(dtype)))
+            for field_num, field in enumerate(dtype):
+                if field[0] in rewidth:
+                    text_kwargs = kwargs.copy()
+                    text_kwargs['usecols'] = (usecols[field_num],)
+                    field[1] = numpy.dtype('S1')
+                    for i, lines in enumerate(_iterLines(file_name, chunk_rows, skip_header)):
+                        # The header line, if any, would count as an entry here, so skip it.
+                        if i == 0 and names is True:
+                            lines = lines[1:]
+                        d = _genfromtxtQuiet(lines, dtype=str, **text_kwargs)
+                        if d.size:
+                            field[1] = numpy.promote_types(field[1], d.dtype)
+        dtype = [tuple(field) for field in dtype]
+    # Second pass: read the data with the types we found.
+    for i, lines in enumerate(_iterLines(file_name, chunk_rows, skip_header)):
+        d = _readASCIIChunk(lines, i == 0, names, dtype=dtype, **kwargs)
+        if d is not None:
+            yield stile_utils.FormatArray(d, fields=fields)
@@ -5,6 +5,7 @@ side of the pipeline, but eventually this will be usable for both.
 """
 
 import os
+import hashlib
 import lsst.pex.config
 import lsst.pipe.base
 import lsst.meas.mosaic
@@ -16,17 +17,38 @@ import lsst.afw.cameraGeom.utils as cameraGeomUtils
 from lsst.meas.mosaic.mosaicTask import MosaicTask
 from lsst.pipe.tasks.dataIds import PerTractCcdDataIdContainer
 from lsst.pipe.tasks.coaddBase import ExistingCoaddDataIdContainer
-from lsst.pex.exceptions import LsstCppException
-from .sys_test_adapters import adapter_registry
+from .sys_test_adapters import (adapter_registry, mask_flags, GetColumn, slow_column_reads,
+                                ConfigFingerprint)
+from .sys_test_runner import RunSysTests
 import numpy
 import re
 import stile
 
+# The subfields of an LSST moments field, in the order of the rows of the moment arrays used here
+# (and of the LSST shape covariance matrices).
+moment_elements = ['xx', 'yy', 'xy']
+
 # So we can cut too-long path names.  This assumes that the machine where the code is stored has the
 # same settings as the machine where the files will be placed, but I think this is a safe assumption
 # for most HSC use cases.
 max_path_length = os.pathconf('.', 'PC_NAME_MAX')
 
+# The name of the file holding the result tables when config.use_result_store is set
+result_store_name = 'stile_results.npys'
+
+# The name of the file recording which inputs each output was made from when config.skip_unchanged
+# is set, and the task config fields that the outputs of every test depend on.  (Each test's own
+# config is fingerprinted separately, so changing one test doesn't force the others to be rerun.)
+fingerprint_file_name = 'stile_fingerprints'
+fingerprint_config_fields = ['treecorr_kwargs', 'flags_keep_false', 'flags_keep_true', 'do_hsm',
+                             'shape_flags', 'shape_flags_hsm', 'bright_star_sn_cutoff', 'ccd_type',
+                             'wcs_jacobian_tolerance', 'wcs_jacobian_grid_spacing',
+                             'whiskerplot_figsize', 'whiskerplot_xlim', 'whiskerplot_ylim',
+                             'whiskerplot_scale', 'scatterplot_per_ccd_stat']
+# The config fields that the derived columns kept in config.column_cache_dir depend on.
+column_cache_config_fields = ['do_hsm', 'shape_flags', 'shape_flags_hsm', 'wcs_jacobian_tolerance',
+                              'wcs_jacobian_grid_spacing']
+
 parser_description = """
 This is a script to run Stile through the LSST/HSC pipeline.
 
@@ -106,6 +128,28 @@ class CCDSingleEpochStileConfig(lsst.pex.config.Config):
         doc="Flags that indicate failures for HSM-type shape measurements",
         default=['shape.hsm.regauss.flags'])
     bright_star_sn_cutoff = 50
+    use_result_store = lsst.pex.config.Field(dtype=bool, default=False,
+        doc="Write the result tables to a single file per output directory (%s), rather than "
+            "one file per table; stile.ExpandResultStore converts it back to separate files"
+            % result_store_name)
+    skip_unchanged = lsst.pex.config.Field(dtype=bool, default=False,
+        doc="Skip the sys tests whose catalogs, calibrations and config haven't changed since "
+            "their outputs were last written (as recorded in %s in the output directory)"
+            % fingerprint_file_name)
+    column_cache_dir = lsst.pex.config.Field(dtype=str, default='',
+        doc="Directory in which to keep the derived columns (shapes, magnitudes, etc.) computed "
+            "for each catalog, so that they're shared by later runs of this or other tasks on the "
+            "same data (an empty string to not keep them)")
+    n_queued_outputs = lsst.pex.config.Field(dtype=int, default=4,
+        doc="Number of results tables and figures that may wait to be written in the background")
+    n_sys_test_processes = lsst.pex.config.Field(dtype=int, default=1,
+        doc="Number of processes running sys tests at once (1 to run them one at a time in the "
+            "task's own process)")
+    wcs_jacobian_tolerance = lsst.pex.config.Field(dtype=float, default=1.E-6,
+        doc="Relative accuracy of the interpolated local WCS Jacobians used to convert shapes "
+            "to sky coordinates (0 to linearize the WCS at every source)")
+    wcs_jacobian_grid_spacing = lsst.pex.config.Field(dtype=float, default=512.,
+        doc="Initial spacing in pixels of the grid used to interpolate the local WCS Jacobians")
     whiskerplot_figsize = lsst.pex.config.ListField(dtype=float,
         doc="figure size for whisker plot", default=[7., 10.])
     whiskerplot_xlim = lsst.pex.config.ListField(dtype=float,
@@ -130,11 +174,15 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
     # lsst magic
     ConfigClass = CCDSingleEpochStileConfig
     _DefaultName = "CCDSingleEpochStile"
+    # The dataId keys identifying results in a result store
+    result_id_keys = ('visit', 'ccd')
     # necessary basic parameters for treecorr to run
     def __init__(self, **kwargs):
         lsst.pipe.base.CmdLineTask.__init__(self, **kwargs)
         self.sys_tests = self.config.sys_tests.apply()
         self.catalog_type = 'src'
+        self.flux_fit_corrections = {}
+        self.column_caches = {}
 
     @staticmethod
     def getFilenameBase(dataRef):
@@ -154,28 +202,40 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
         return dir, "-%07d-%03d" % (dataRef.dataId["visit"], dataRef.dataId["ccd"])
 
     def run(self, dataRef):
+        dir, filename_chip = self.getFilenameBase(dataRef)
+        result_id = self.getResultId([dataRef])
+        # If we're skipping tests whose inputs haven't changed, find the ones left to run.
+        sys_tests, fingerprints = self.findStaleSysTests(dir, [dataRef], result_id)
+        if not sys_tests:
+            self.log.info("Outputs for %s are up to date" % dataRef.dataId)
+            return
+
         # Pull the source catalog from the butler corresponding to the particular CCD in the
         # dataRef.
         catalog = dataRef.get(self.catalog_type, immediate=True,
                               flags=afwTable.SOURCE_IO_NO_FOOTPRINTS)
 
-        dir, filename_chip = self.getFilenameBase(dataRef)
-
-        # Remove objects so badly measured we shouldn't use them in any test.
-        catalog = self.removeFlaggedObjects(catalog)
+        # Read all the flags we need just once, then remove objects so badly measured we shouldn't
+        # use them in any test.
+        flags = self.readFlags(catalog)
+        catalog, flags = self.removeFlaggedObjects(catalog, flags)
         sys_data_list = []
         extra_col_dict = {}
+        # Most tests use the same object types, so their masks are computed once and shared.
+        mask_cache = {}
+        config_fingerprint = ConfigFingerprint(self.config)
         # Now, pull the mask and required-quantity info from the individual systematics tests we're
         # going to run.  We'll generate any required quantities only for the data within the
         # corresponding mask; we'll also check for more specific flags, such as flux measurement
         # failures for tests where we need the flux or magnitude or color of an object, and
         # fold those into the overall mask.
-        for sys_test in self.sys_tests:
+        for sys_test in sys_tests:
             sys_test_data = SysTestData()
             sys_test_data.sys_test_name = sys_test.name
             # Masks expects: a tuple of tuples, with each tuple having a mask name and a mask,
             # and one tuple for each required data set for the sys_test
-            sys_test_data.mask_tuple_list = sys_test.getMasks(catalog, self.config)
+            sys_test_data.mask_tuple_list = sys_test.getMasks(catalog, self.config, flags,
+                                                              mask_cache, config_fingerprint)
             # cols expects: an iterable of iterables, describing for each required data set
             # the set of extra required columns. len(mask_tuple_list) should be equal to
             # len(cols_list).
@@ -194,7 +254,8 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
                                  'g1_chip', 'g1_err_chip', 'g2_chip', 'g2_err_chip',
                                  'sigma_sky', 'sigma_chip', 'sigma_err_sky', 'sigma_err_chip',
                                  'w']]):
-                    shape_masks.append(self._computeShapeMask(catalog, mask_type))
+                    shape_masks.append(self._computeShapeMask(catalog, mask_type, flags,
+                                                              mask_cache))
                 else:
                     shape_masks.append(True)
             sys_test_data.mask_tuple_list = [(mask_type, numpy.logical_and(mask, shape_mask))
@@ -202,8 +263,9 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
             # Generate any quantities that aren't already in the source catalog, but can
             # be generated from things that *are* in the source catalog.
             for (mask, cols) in zip(sys_test_data.mask_tuple_list, sys_test_data.cols_list):
-                self.generateColumns(dataRef, catalog, mask, cols, extra_col_dict)
+                self.generateColumns(dataRef, catalog, mask, cols, extra_col_dict, flags)
             sys_data_list.append(sys_test_data)
+        self.writeColumnCaches()
         # Right now, we have a source catalog, plus a dict of other computed quantities.  Step
         # through the masks and required quantities and generate a NumPy array for each pair,
         # containing only the required quantities and only in the rows indicated by the mask.
@@ -213,42 +275,289 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
                 for c in cols:
                     if '_sky' in c or '_chip' in c:
                         cols.append('_'.join(c.split('_')[:-1]))
-        for sys_test, sys_test_data in zip(self.sys_tests, sys_data_list):
+        # Many tests use the same masks and columns, so the masked columns and arrays are shared
+        # through a column store.
+        column_store = stile.stile_utils.ColumnStore()
+        sys_test_jobs = []
+        for sys_test, sys_test_data in zip(sys_tests, sys_data_list):
             new_catalogs = []
             for (mask_type, mask), cols in zip(sys_test_data.mask_tuple_list,
                                                sys_test_data.cols_list):
-                new_catalog = {}
-                for column in cols:
+                def makeColumn(column):
                     if column in extra_col_dict:
-                        new_catalog[column] = extra_col_dict[column][mask]
+                        return extra_col_dict[column][mask]
                     elif column in catalog.schema:
-                        try:
-                            new_catalog[column] = catalog[column][mask]
-                        except LsstCppException:
-                            new_catalog[column] = (numpy.array([src[column]
-                                                   for src in catalog])[mask])
-                new_catalogs.append(self.makeArray(new_catalog))
-            # run the test!
-            results = sys_test(self.config, *new_catalogs)
+                        return GetColumn(catalog, column)[mask]
+                new_catalogs.append(column_store.getArray(column_store.maskKey(mask), cols,
+                                                          makeColumn, self.makeArray))
+            sys_test_jobs.append((sys_test, new_catalogs))
+        # run the tests!
+        sys_test_results = self.runSysTests(sys_test_jobs)
+        # Outputs are written in the background while the next ones are prepared.
+        writer = stile.AsyncWriter(self.config.n_queued_outputs)
+        result_store = self.getResultStore(dir)
+        outputs_list = []
+        for sys_test, sys_test_data, (results, sys_test_output) in zip(sys_tests,
+                                                                       sys_data_list,
+                                                                       sys_test_results):
             # If there's anything fancy to do with the results, do that.
             this_max_path_length = max_path_length-4-len(sys_test_data.sys_test_name)
+            base_name = sys_test_data.sys_test_name+filename_chip[:this_max_path_length]
+            outputs = set()
             if isinstance(results, numpy.ndarray):
-                stile.WriteASCIITable(os.path.join(dir,
-                      sys_test_data.sys_test_name+filename_chip[:this_max_path_length]+'.dat'),
-                      results, print_header=True)
+                outputs.add(self.writeResultTable(writer, result_store, dir, base_name+'.dat',
+                                                  sys_test_data.sys_test_name, result_id, results))
             if hasattr(sys_test.sys_test, 'getData'):
-                stile.WriteASCIITable(os.path.join(dir,
-                      sys_test_data.sys_test_name+filename_chip[:this_max_path_length]+'.dat'),
-                      sys_test.sys_test.getData(), print_header=True)
+                outputs.add(self.writeResultTable(writer, result_store, dir, base_name+'.dat',
+                                                  sys_test_data.sys_test_name, result_id,
+                                                  sys_test_output))
             if hasattr(sys_test.sys_test, 'plot'):
                 fig = sys_test.sys_test.plot(results)
-                fig.savefig(os.path.join(dir,
-                      sys_test_data.sys_test_name+filename_chip[:this_max_path_length]+'.png'))
+                # The base plot() returns the results themselves if they're a figure; the writer
+                # closes figures once saved, so only save them once.
+                if fig is not results:
+                    writer.saveFigure(fig, os.path.join(dir, base_name+'.png'))
+                    outputs.add(base_name+'.png')
             if hasattr(results, 'savefig'):
-                results.savefig(os.path.join(dir,
-                      sys_test_data.sys_test_name+filename_chip[:this_max_path_length]+'.png'))
+                writer.saveFigure(results, os.path.join(dir, base_name+'.png'))
+                outputs.add(base_name+'.png')
+            outputs_list.append(outputs)
+        # Wait for the outputs to be written, raising any errors from writing them.
+        writer.close()
+        self.recordFingerprints(fingerprints, result_id, sys_tests, outputs_list)
+        self.reportColumnStore(column_store)
+        self.reportSlowColumnReads()
+
+    def getResultStore(self, dir):
+        """
+        Return the :class:`stile.ResultStore` for the result tables written to ``dir`` if
+        ``config.use_result_store`` is set, else None.
+        """
+        if self.config.use_result_store:
+            return stile.ResultStore(os.path.join(dir, result_store_name))
+        return None
+
+    def getResultId(self, dataRefList):
+        """
+        Return the data ID for results from ``dataRefList`` in a :class:`stile.ResultStore`: a dict
+        of the values of the keys in ``self.result_id_keys``, each of which is a scalar if it is
+        the same for all the dataRefs or else a sorted tuple of the values.  For example, CCD-level
+        results are stored under ``{'visit': visit, 'ccd': ccd}``.
+        """
+        result_id = {}
+        for key in self.result_id_keys:
+            values = sorted(set([dataRef.dataId[key] for dataRef in dataRefList]))
+            result_id[key] = values[0] if len(values) == 1 else tuple(values)
+        return result_id
+
+    def writeResultTable(self, writer, result_store, dir, file_name, sys_test_name, result_id,
+                         data):
+        """
+        Queue a result table on ``writer``, an :class:`stile.AsyncWriter`, to be written either to
+        ``result_store`` (if it isn't None) or to its own file ``file_name`` in ``dir``.  Return the
+        name of the file it is written to, relative to ``dir``.
+        """
+        if result_store is None:
+            writer.writeASCIITable(os.path.join(dir, file_name), data, print_header=True)
+            return file_name
+        writer.submit(result_store.write, sys_test_name, result_id, data, file_name=file_name)
+        return result_store_name
+
+    def findStaleSysTests(self, dir, dataRefList, result_id):
+        """
+        Return the sys tests that need to be run for ``dataRefList``, and a
+        :class:`stile.OutputFingerprints` to record the outputs in once they're written.  Unless
+        ``config.skip_unchanged`` is set, this is all the sys tests and None.  Otherwise it is the
+        tests that have not been run on exactly these inputs (see :func:`getInputFingerprint`)
+        with their current configs, or whose outputs are missing from ``dir``.
+        """
+        if not self.config.skip_unchanged:
+            return list(self.sys_tests), None
+        fingerprints = stile.OutputFingerprints(os.path.join(dir, fingerprint_file_name))
+        stale, self.test_fingerprints = fingerprints.findStale(
+            result_id, self.getInputFingerprint(dataRefList),
+            [(sys_test.name, ConfigFingerprint(sys_test.config)) for sys_test in self.sys_tests])
+        return [sys_test for sys_test in self.sys_tests if sys_test.name in stale], fingerprints
+
+    def getInputFingerprint(self, dataRefList):
+        """
+        Return a string identifying the inputs shared by all the sys tests for ``dataRefList``: the
+        task config fields in ``fingerprint_config_fields``, the data IDs, the modification time
+        and size of each catalog file, and the calibration metadata.  Changes to the code itself
+        are not detected.
+        """
+        fingerprint = hashlib.sha1()
+        config_dict = self.config.toDict()
+        for field in fingerprint_config_fields:
+            # bright_star_sn_cutoff is a plain class attribute, so it isn't in toDict().
+            value = config_dict.get(field, getattr(self.config, field, None))
+            if isinstance(value, dict):
+                value = sorted(value.items())
+            fingerprint.update(repr((field, value)))
+        for dataRef in sorted(dataRefList, key=lambda dataRef: sorted(dataRef.dataId.items())):
+            fingerprint.update(self.getDataFingerprint(dataRef))
+        return fingerprint.hexdigest()
+
+    def getDataFingerprint(self, dataRef):
+        """
+        Return a string identifying the data for ``dataRef``: its data ID, the modification time
+        and size of its catalog file, and its calibration metadata.
+        """
+        fingerprint = hashlib.sha1()
+        fingerprint.update(repr(sorted(dataRef.dataId.items())))
+        try:
+            file_name = dataRef.get(self.catalog_type+'_filename', immediate=True)[0]
+            stat = os.stat(file_name)
+            fingerprint.update(repr((file_name, stat.st_mtime, stat.st_size)))
+        except Exception:
+            fingerprint.update('missing catalog')
+        try:
+            calib_type, calib_metadata, calib_metadata_shape = self.getCalibData(dataRef, ['shape'])
+            fingerprint.update(calib_type)
+            for metadata in [calib_metadata, calib_metadata_shape]:
+                fingerprint.update(repr([(name, metadata.get(name))
+                                         for name in metadata.names()]))
+        except Exception:
+            fingerprint.update('missing calibration')
+        return fingerprint.hexdigest()
+
+    def getColumnCache(self, dataRef, catalog, calib_type):
+        """
+        Return the :class:`stile.ColumnCache` of derived columns for ``catalog``, which came from
+        ``dataRef`` and is calibrated with ``calib_type``, or None if ``config.column_cache_dir``
+        isn't set.  Each cache is opened only once; :func:`writeColumnCaches` saves them.
+        """
+        if not self.config.column_cache_dir:
+            return None
+        key = (tuple(sorted(dataRef.dataId.items())), calib_type)
+        if key not in self.column_caches:
+            cache_name = '-'.join([self.catalog_type, calib_type]+
+                                  ['%s%s' % item for item in key[0]])
+            fingerprint = hashlib.sha1(self.getDataFingerprint(dataRef))
+            fingerprint.update(repr([getattr(self.config, field, None)
+                                     for field in column_cache_config_fields]))
+            if not os.path.isdir(self.config.column_cache_dir):
+                try:
+                    os.makedirs(self.config.column_cache_dir)
+                except OSError:
+                    # Another process may have just made it
+                    pass
+            self.column_caches[key] = stile.ColumnCache(
+                os.path.join(self.config.column_cache_dir, cache_name), GetColumn(catalog, 'id'),
+                fingerprint.hexdigest())
+        return self.column_caches[key]
+
+    def writeColumnCaches(self):
+        """
+        Write the derived columns computed in this run to ``config.column_cache_dir``.
+        """
+        for column_cache in self.column_caches.values():
+            column_cache.write()
+        self.column_caches = {}
+
+    def readCachedColumns(self, column_cache, cols, cache_names, n_rows, mask_tuple,
+                          extra_col_dict):
+        """
+        Make sure there's a NumPy array in ``extra_col_dict`` for each of ``cols``, filled with
+        any values in ``column_cache`` (under the corresponding ``cache_names``) and ``nan`` for
+        the rest, and remove from the mask (``mask_tuple[1]``) any rows that the cache records as
+        invalid for one of ``cols``.
+        """
+        for col, cache_name in zip(cols, cache_names):
+            if column_cache is None:
+                if col not in extra_col_dict:
+                    extra_col_dict[col] = numpy.zeros(n_rows)
+                    extra_col_dict[col].fill('nan')
+                continue
+            values, valid = column_cache.getColumn(cache_name)
+            if col not in extra_col_dict:
+                extra_col_dict[col] = values.copy()
+            mask_tuple[1][numpy.logical_not(valid)] = False
 
-    def removeFlaggedObjects(self, catalog):
+    def recordFingerprints(self, fingerprints, result_id, sys_tests, outputs_list):
+        """
+        Record the fingerprints found by :func:`findStaleSysTests` for the ``sys_tests`` that were
+        just run, along with the files they wrote (``outputs_list``, one set of file names per
+        test, as returned by :func:`writeResultTable`), so that later runs can skip them.  Does
+        nothing if ``fingerprints`` is None.
+        """
+        if fingerprints is None:
+            return
+        for sys_test, outputs in zip(sys_tests, outputs_list):
+            # Tables in the result store are checked by their entry in its index, not by the file.
+            fingerprints.record(sys_test.name, result_id, self.test_fingerprints[sys_test.name],
+                                outputs=sorted(outputs-set([result_store_name])),
+                                stores=sorted(outputs & set([result_store_name])))
+
+    def runSysTests(self, jobs):
+        """
+        Run the sys tests on their input arrays, using ``config.n_sys_test_processes`` processes
+        (see :func:`.sys_test_runner.RunSysTests`).
+
+        :param jobs: A list of ``(sys_test, new_catalogs)`` pairs, where ``sys_test`` is a sys test
+                     adapter and ``new_catalogs`` is the list of arrays to call it with.
+        :returns:    A list, in the same order as ``jobs``, of ``(results, output)`` pairs:
+                     whatever the sys test returned, and the result of its ``getData()`` method if
+                     it has one (else None).
+        """
+        return RunSysTests(jobs, self.config, self.config.n_sys_test_processes)
+
+    def reportColumnStore(self, column_store):
+        """
+        Log the memory used by a :class:`stile.stile_utils.ColumnStore` and how often the columns
+        and arrays in it were reused.
+        """
+        summary = column_store.summary()
+        self.log.info("Column store: %i masked columns (%.1f MB), %i arrays (%.1f MB); columns "
+                      "reused %i times, arrays reused %i times" %
+                      (summary['n_columns'], summary['column_bytes']/1.E6, summary['n_arrays'],
+                       summary['array_bytes']/1.E6, summary['column_reuses'],
+                       summary['array_reuses']))
+
+    def reportSlowColumnReads(self):
+        """
+        Warn if any columns had to be read one source at a time (see
+        :data:`.sys_test_adapters.slow_column_reads`), which means some catalog was not contiguous.
+        """
+        if slow_column_reads:
+            counts = ["%s: %i" % item for item in sorted(slow_column_reads.items())]
+            self.log.warn("Columns read one source at a time (column: number of reads): %s" %
+                          ", ".join(counts))
+
+    def makeContiguous(self, catalog):
+        """
+        Return a contiguous version of ``catalog``: the catalog itself if it is already contiguous,
+        otherwise a deep copy.  Columns of contiguous catalogs can be read as NumPy arrays, rather
+        than one source at a time, so we make every catalog contiguous right after subsetting it.
+
+        :param catalog: A source catalog pulled from the LSST pipeline.
+        :returns:       A contiguous source catalog with the same rows.
+        """
+        if catalog.isContiguous():
+            return catalog
+        return catalog.copy(deep=True)
+
+    def readFlags(self, catalog):
+        """
+        Read every flag column this task and the masks of its systematics tests use (the flags in
+        ``self.config.flags_keep_false``, ``self.config.flags_keep_true``,
+        ``self.config.shape_flags`` and ``self.config.shape_flags_hsm``, plus the PSF flux and
+        PSF star flags) from ``catalog``, just once, into a packed bitmask.  Any combination of
+        these flags can then be checked with a single vectorized operation, and the resulting masks
+        are cached for reuse by all the systematics tests.
+
+        :param catalog: A source catalog pulled from the LSST pipeline.
+        :returns:       A :class:`stile.stile_utils.PackedFlags` object.
+        """
+        names = (list(self.config.flags_keep_false) + list(self.config.flags_keep_true) +
+                 list(self.config.shape_flags) + list(self.config.shape_flags_hsm) + mask_flags)
+        flag_columns = []
+        for name in names:
+            if name in catalog.schema:
+                flag_columns.append((name, GetColumn(catalog, name)))
+        return stile.stile_utils.PackedFlags(flag_columns)
+
+    def removeFlaggedObjects(self, catalog, flags=None):
         """
         Remove objects which have certain flags we consider unrecoverable failures for weak lensing.
         Currently set to be quite conservative--we may want to relax this in the future.  The actual
@@ -257,19 +566,24 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
         as described in the parser help.
 
         :param catalog: A source catalog pulled from the LSST pipeline.
+        :param flags:   The flags of ``catalog`` from :func:`readFlags`, or None to read them here.
+                        [default: None]
         :returns:       The source catalog, masked to the rows which don't have any of our defined
-                        flags set.
-        """
-        masks = []
-        if self.config.flags_keep_false:
-            masks += [catalog[flag] == False for flag in self.config.flags_keep_false]
-        if self.config.flags_keep_true:
-            masks += [catalog[flag] == True for flag in self.config.flags_keep_true]
-        if masks:
-            mask = masks[0]
-            for new_mask in masks[1:]:
-                mask = numpy.logical_and(mask, new_mask)
+                        flags set, and copied if necessary so that it is contiguous.  If ``flags``
+                        was given, a tuple of that catalog and the flags for its rows.
+        """
+        return_flags = flags is not None
+        if self.config.flags_keep_false or self.config.flags_keep_true:
+            if flags is None:
+                flags = self.readFlags(catalog)
+            mask = flags.getMask(keep_false=self.config.flags_keep_false,
+                                 keep_true=self.config.flags_keep_true)
             catalog = catalog[mask]
+            if return_flags:
+                flags = flags.select(mask)
+        catalog = self.makeContiguous(catalog)
+        if return_flags:
+            return catalog, flags
         return catalog
 
     def makeArray(self, catalog_dict):
@@ -290,12 +604,14 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
             data[key] = catalog_dict[key]
         return data
 
-    def generateColumns(self, dataRef, catalog, mask_tuple, raw_cols, extra_col_dict):
+    def generateColumns(self, dataRef, catalog, mask_tuple, raw_cols, extra_col_dict, flags=None):
         """
         Generate required columns which are not already in the data array,  and update
         ``extra_col_dict`` to include them.  Also update the mask (``mask_tuple[1]``) to exclude any
         objects which have specific failures for the requested quantities, such as flux measurement
-        failures for flux/magnitude measurements.
+        failures for flux/magnitude measurements.  If ``config.column_cache_dir`` is set, quantities
+        computed for the same sources in earlier runs are read from there rather than recomputed,
+        and the new ones are added to it.
 
         :param dataRef:        A ``dataRef`` that is the source of the following data
         :param catalog:        A source catalog from the LSST pipeline.
@@ -308,6 +624,8 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
                                as-yet uncomputed results; elements which are something other than
                                ``nan`` are not recomputed.  ``extra_col_dict`` is updated by this
                                function.
+        :param flags:          The flags of ``catalog`` from :func:`readFlags`, or None.
+                               [default: None]
         """
         cols = list(raw_cols) # so we can pop items and not mess up our column description elsewhere
         # The moments measurement is slow enough to make a difference if we're processing many
@@ -334,6 +652,10 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
                 shape_cols.append(key)
 
         calib_type, calib_metadata, calib_metadata_shape = self.getCalibData(dataRef, shape_cols)
+        if calib_type == "fcr" and "mag" in cols:
+            flux_fit_correction = self.getFluxFitCorrection(dataRef, calib_metadata, catalog)
+        else:
+            flux_fit_correction = None
 
         # offset for (x,y) if extra_col_dict has a column 'CCD'. Currently getMm() returns values
         # in pixel. When the pipeline is updated, we should update this line as well.
@@ -344,16 +666,17 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
                                        ).getPositionFromPixel(afwGeom.PointD(0., 0.)).getMm()
         else:
             xy0 = None
+        # Columns computed in earlier runs, if we're keeping them, are read from the cache.
+        column_cache = self.getColumnCache(dataRef, catalog, calib_type)
 
         if shape_cols:
             for col in shape_cols:
                 if col in cols:
                     cols.remove(col)
-                # Make sure there's already a NumPy array in the dict associated with this key.
-                # We use "nan" to mark the rows we haven't computed already.
-                if col not in extra_col_dict:
-                    extra_col_dict[col] = numpy.zeros(len(catalog))
-                    extra_col_dict[col].fill('nan')
+            # Make sure there's already a NumPy array in the dict associated with each key.
+            # We use "nan" to mark the rows we haven't computed already.
+            self.readCachedColumns(column_cache, shape_cols, shape_cols, len(catalog), mask_tuple,
+                                   extra_col_dict)
             # Now, figure out the rows where we need to compute at least one of these quantities
             nan_masks = [numpy.isnan(extra_col_dict[col]) for col in shape_cols]
             nan_mask = numpy.logical_or.reduce(nan_masks)
@@ -362,34 +685,47 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
             # we may also need the quantities in chip coordinates.
             do_sky_coords = True if numpy.any(['_sky' in col for col in raw_cols]) else False
             do_chip_coords = True if numpy.any(['_chip' in col for col in raw_cols]) else False
-            if any(nan_and_col_mask > 0):
+            if any(nan_and_col_mask > 0) and (do_sky_coords or do_chip_coords):
                 # computeShapes returns a dict of ('key': column) pairs, and sometimes an extra
                 # mask indicating where measurements were valid. Here, the extra mask is only used
                 # if PSF shapes were computed, since we already computed the shape masking in run().
-                for do_quantity, sky_coords in [(do_sky_coords, True), (do_chip_coords, False)]:
-                    if do_quantity:
-                        shapes_dict, extra_mask = self.computeShapes(catalog[nan_and_col_mask],
-                            calib_metadata_shape, do_shape=do_shape, do_err=do_err, do_psf=do_psf,
-                            do_psf_err=do_psf_err, sky_coords=sky_coords, mask_type=mask_tuple[0])
-                        if extra_mask is not None:
-                            mask_tuple[1][nan_and_col_mask] = numpy.logical_and(extra_mask,
+                # Both coordinate systems are computed from a single read of the moments.
+                shapes_dict, extra_mask = self.computeShapes(
+                    self.makeContiguous(catalog[nan_and_col_mask]),
+                    calib_metadata_shape, do_shape=do_shape, do_err=do_err, do_psf=do_psf,
+                    do_psf_err=do_psf_err, sky_coords=do_sky_coords, chip_coords=do_chip_coords,
+                    mask_type=mask_tuple[0],
+                    flags=None if flags is None else flags.select(nan_and_col_mask))
+                if extra_mask is not None:
+                    mask_tuple[1][nan_and_col_mask] = numpy.logical_and(extra_mask,
                                                                    mask_tuple[1][nan_and_col_mask])
-                        for col in shapes_dict:
-                            if shapes_dict[col] is not None and col in extra_col_dict:
-                                extra_col_dict[col][nan_and_col_mask] = shapes_dict[col]
+                for col in shapes_dict:
+                    if shapes_dict[col] is not None and col in extra_col_dict:
+                        extra_col_dict[col][nan_and_col_mask] = shapes_dict[col]
+                        if column_cache is not None:
+                            # The extra mask flags bad PSF fluxes, so it only says whether the PSF
+                            # columns are valid; the galaxy shapes are valid wherever computed.
+                            column_cache.update(col, nan_and_col_mask, shapes_dict[col],
+                                                extra_mask if col.startswith('psf_') else None)
         # Now we do the other quantities.  A lot of this is similar to the above code.
         for col in cols:
             if not col in catalog.schema:
-                if not col in extra_col_dict:
-                    extra_col_dict[col] = numpy.zeros(len(catalog))
-                    extra_col_dict[col].fill('nan')
+                # Positions offset to the focal plane are cached apart from the chip positions.
+                cache_name = col+'_focal_plane' if xy0 and col in ['x', 'y'] else col
+                self.readCachedColumns(column_cache, [col], [cache_name], len(catalog), mask_tuple,
+                                       extra_col_dict)
                 nan_mask = numpy.isnan(extra_col_dict[col])
                 nan_and_col_mask = numpy.logical_and(nan_mask, mask_tuple[1])
                 if any(nan_and_col_mask > 0):
                     # "extra_mask" is the new mask with the quantity-specific flags
                     extra_col_dict[col][nan_and_col_mask], extra_mask = self.computeExtraColumn(
-                        col, catalog[nan_and_col_mask], calib_metadata, calib_type, xy0,
-                        mask_type=mask_tuple[0])
+                        col, self.makeContiguous(catalog[nan_and_col_mask]), calib_metadata,
+                        calib_type, xy0,
+                        mask_type=mask_tuple[0], flux_fit_correction=flux_fit_correction,
+                        flags=None if flags is None else flags.select(nan_and_col_mask))
+                    if column_cache is not None:
+                        column_cache.update(cache_name, nan_and_col_mask,
+                                            extra_col_dict[col][nan_and_col_mask], extra_mask)
                     if extra_mask is not None:
                         mask_tuple[1][nan_and_col_mask] = numpy.logical_and(extra_mask,
                                                                    mask_tuple[1][nan_and_col_mask])
@@ -418,31 +754,145 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
 
         return calib_type, calib_metadata, calib_metadata_shape
 
-    def _computeShapeMask(self, data, mask_type):
+    def getFluxFitCorrection(self, dataRef, calib_metadata, catalog):
+        """
+        Return the function computing the ``fcr`` zeropoint correction for the given dataRef (see
+        :func:`makeFluxFitCorrection`), making it only the first time it's requested for that
+        dataRef.
+
+        :param dataRef:        A dataRef for the catalog.
+        :param calib_metadata: The ``fcr_md`` metadata for the dataRef.
+        :param catalog:        The source catalog, used to validate the correction.
+        :returns:              A function taking arrays of x and y positions and returning the
+                               zeropoint correction at each position.
+        """
+        key = tuple(sorted(dataRef.dataId.items()))
+        if key not in self.flux_fit_corrections:
+            self.flux_fit_corrections[key] = self.makeFluxFitCorrection(calib_metadata, catalog)
+        return self.flux_fit_corrections[key]
+
+    def makeFluxFitCorrection(self, calib_metadata, catalog):
+        """
+        Make a function that evaluates the :class:`lsst.meas.mosaic.FluxFitParams` zeropoint
+        correction over whole arrays of positions.  The polynomial order, coefficients and scaling
+        are read from the ``fcr_md`` metadata once and the polynomial is evaluated with
+        :func:`stile.stile_utils.EvaluatePolynomial2D`.
+
+        The result is checked against ``FluxFitParams.eval()`` on a grid covering the positions
+        in ``catalog``; if the metadata can't be read or the two disagree, the returned function
+        falls back to calling ``FluxFitParams.eval()`` for each position.
+
+        :param calib_metadata: The ``fcr_md`` metadata.
+        :param catalog:        The source catalog whose positions will be corrected.
+        :returns:              A function taking arrays of x and y positions and returning the
+                               zeropoint correction at each position.
+        """
+        ffp = lsst.meas.mosaic.FluxFitParams(calib_metadata)
+
+        def evalCorrection(x, y):
+            return numpy.array([ffp.eval(xi, yi) for xi, yi in zip(x, y)])
+
+        keys = ["NCOEFF", "CHEBYSHEV", "X0", "Y0", "U_MAX", "V_MAX"]
+        if calib_metadata.exists("NCOEFF"):
+            n_coeff = calib_metadata.get("NCOEFF")
+            keys += ["%s%i" % (key, i) for i in range(n_coeff)
+                     for key in ["COEFF", "XORDER", "YORDER"]]
+        if not all([calib_metadata.exists(key) for key in keys]):
+            self.log.warn("Could not read the fcr polynomial from its metadata; evaluating the "
+                          "zeropoint correction one source at a time")
+            return evalCorrection
+        coefficients = [calib_metadata.get("COEFF%i" % i) for i in range(n_coeff)]
+        x_orders = [calib_metadata.get("XORDER%i" % i) for i in range(n_coeff)]
+        y_orders = [calib_metadata.get("YORDER%i" % i) for i in range(n_coeff)]
+        chebyshev = calib_metadata.get("CHEBYSHEV")
+        x0, y0 = calib_metadata.get("X0"), calib_metadata.get("Y0")
+        u_max, v_max = calib_metadata.get("U_MAX"), calib_metadata.get("V_MAX")
+
+        def polynomialCorrection(x, y):
+            return stile.stile_utils.EvaluatePolynomial2D(
+                (numpy.asarray(x)+x0)/u_max, (numpy.asarray(y)+y0)/v_max, coefficients,
+                x_orders, y_orders, chebyshev=chebyshev)
+
+        # Check the polynomial against FluxFitParams on a grid covering the catalog
+        centroid_name = catalog.getCentroidDefinition()
+        x = GetColumn(catalog, centroid_name+'.x')
+        y = GetColumn(catalog, centroid_name+'.y')
+        if len(x):
+            grid_x, grid_y = numpy.meshgrid(numpy.linspace(numpy.nanmin(x), numpy.nanmax(x), 5),
+                                            numpy.linspace(numpy.nanmin(y), numpy.nanmax(y), 5))
+            grid_x, grid_y = grid_x.ravel(), grid_y.ravel()
+            if not numpy.allclose(polynomialCorrection(grid_x, grid_y),
+                                  evalCorrection(grid_x, grid_y), rtol=0., atol=1.E-8):
+                self.log.warn("The fcr polynomial read from its metadata does not match "
+                              "FluxFitParams.eval(); evaluating the zeropoint correction one "
+                              "source at a time")
+                return evalCorrection
+        return polynomialCorrection
+
+    def _computeShapeMask(self, data, mask_type, flags=None, mask_cache=None):
         """
         Compute and return the mask for ``data`` that excludes pernicious shape measurement
-        failures.
+        failures.  If ``flags`` (the flags of ``data`` from :func:`readFlags`) is given, the mask is
+        computed from those instead of reading the flags from ``data``.  If ``mask_cache`` (a dict
+        of masks for ``data``, as for the sys test adapters' ``getMasks()``) is given, the mask is
+        computed once per set of shape flags and the cached, read-only mask is returned.
         """
-        masks = list()
         if 'galaxy' in mask_type and self.config.do_hsm:
-            for flag in self.config.shape_flags_hsm:
-                key = data.schema.find(flag).key
-                masks.append(numpy.array([src.get(key) == False for src in data]))
+            shape_flags = self.config.shape_flags_hsm
+        else:
+            shape_flags = self.config.shape_flags
+        key = ('shape', tuple(shape_flags))
+        if mask_cache is not None and key in mask_cache:
+            return mask_cache[key]
+        if flags is not None:
+            mask = flags.getMask(keep_false=shape_flags)
         else:
-            for flag in self.config.shape_flags:
-                key = data.schema.find(flag).key
-                masks.append(numpy.array([src.get(key) == False for src in data]))
-        mask = masks[0]
-        for new_mask in masks[1:]:
-            mask = numpy.logical_and(mask, new_mask)
+            masks = [GetColumn(data, flag) == False for flag in shape_flags]
+            mask = masks[0]
+            for new_mask in masks[1:]:
+                mask = numpy.logical_and(mask, new_mask)
+        if mask_cache is not None:
+            mask.flags.writeable = False
+            mask_cache[key] = mask
         return mask
 
+    def computeLocalLinearTransforms(self, data, calib):
+        """
+        Compute the local linear approximation to the WCS (the Jacobian of the pixel-to-sky
+        transformation, in degrees per pixel) at the centroid of every source in ``data``.
+
+        Rather than linearizing the WCS at every source, this linearizes it on a coarse grid of
+        pixel positions and interpolates, refining the grid until the interpolated Jacobians agree
+        with the WCS to a relative accuracy of ``config.wcs_jacobian_tolerance`` (see
+        :func:`stile.stile_utils.InterpolateJacobians`).  Setting that tolerance to 0 linearizes
+        the WCS at every source.
+
+        :param data:  An LSST source catalog.
+        :param calib: The metadata from a calibrated exposure (``'calexp'`` or ``'fcr'``).
+        :returns:     A NumPy array of shape ``(len(data), 2, 2)``.
+        """
+        wcs = afwImage.makeWcs(calib)
+        centroid_name = data.getCentroidDefinition()
+        x = numpy.array(GetColumn(data, centroid_name+'.x'), dtype=float)
+        y = numpy.array(GetColumn(data, centroid_name+'.y'), dtype=float)
+
+        def linearize(x, y):
+            lt = wcs.linearizePixelToSky(afwGeom.Point2D(x, y)).getLinear()
+            return [[lt[0,0], lt[0,1]], [lt[1,0], lt[1,1]]]
+        return stile.stile_utils.InterpolateJacobians(
+            linearize, x, y, tolerance=self.config.wcs_jacobian_tolerance,
+            grid_spacing=self.config.wcs_jacobian_grid_spacing)
+
     def computeShapes(self, data, calib, do_shape=True, do_err=True, do_psf=True, do_psf_err=True,
-                             sky_coords=True, mask_type=None):
+                             sky_coords=True, mask_type=None, flags=None, chip_coords=None):
         """
         Compute the shapes for the given ``data``, an LSST source catalog, with the associated
         ``calib`` calibrated exposure metadata (``'calexp'`` or ``'fcr'``, either works).
 
+        The moments are read from the catalog once, however many coordinate systems are requested;
+        for sky coordinates they are then transformed with the local WCS Jacobians, while native
+        coordinates use them as they are.
+
         :param data:       An LSST source catalog whose shape moments you would like to retrieve.
         :param calib:      The metadata from a calibrated exposure (``'calexp'`` or ``'fcr'``).  If
                            ``sky_coords=False`` (see below) this can be None.
@@ -451,9 +901,13 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
         :param do_psf:     A bool indicating whether to compute ``(psf_g1, psf_g2, psf_sigma)``.
         :param do_psf_err: A bool indicating whether to compute ``(psf_g1_err, psf_g2_err,
                            psf_sigma_err)``.
-        :param sky_coords: If True, compute the moments in ra, dec coordinates; else compute in
-                           native coordinates (x, y for CCD).
+        :param sky_coords: If True, compute the moments in ra, dec coordinates (the ``*_sky``
+                           columns).
         :param mask_type:  The object type corresponding to the data in ``data`` [default: ``None``]
+        :param flags:      The flags of ``data`` from :func:`readFlags`, or None to read them from
+                           ``data``. [default: None]
+        :param chip_coords: If True, compute the moments in native coordinates (x, y for CCD; the
+                           ``*_chip`` columns).  [default: None, meaning ``not sky_coords``]
         :returns:          A tuple consisting of:
         
                               - A dict whose keys are column names (``'g1', 'psf_sigma'``, etc) and
@@ -461,80 +915,106 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
                               - None if no new mask was needed, or a NumPy array of bools indicating
                                 which rows had valid measurements.
         """
-        if sky_coords:
-            wcs = afwImage.makeWcs(calib)
-            localLinearTransform = [wcs.linearizePixelToSky(src.getCentroid()).getLinear()
-                                for src in data]
+        if chip_coords is None:
+            chip_coords = not sky_coords
+        # First pull the pixel-coordinate moments out of the catalog, as arrays whose rows are
+        # (ixx, iyy, ixy) (the order of the LSST shape covariance matrices).
+        use_hsm = (do_shape or do_err) and 'galaxy' in mask_type and self.config.do_hsm
+        moments = {}
+        covariances = None
+        hsm_errs = None
         if do_shape or do_err:
-            if 'galaxy' in mask_type and self.config.do_hsm:  # For any galaxy type, use shape.hsm
-                key_g1 = data.schema.find("shape.hsm.regauss.e1").key
-                key_g2 = data.schema.find("shape.hsm.regauss.e2").key
-                g1 = numpy.array([src.get(key_g1) for src in data])
-                g2 = numpy.array([src.get(key_g2) for src in data])
-                if sky_coords:
-                    # we do not have size in shape.hsm, but it does not matter for shapes.
-                    # The size derived in this code is meaningless though.
-                    ixx_pixel = 1.+g1
-                    iyy_pixel = 1.-g1
-                    ixy_pixel = g2
-                    ixx = numpy.array([lt[0,0]**2*ixxp+2.*lt[0,0]*lt[0,1]*ixyp+lt[0,1]**2*iyyp
-                            for (ixxp, ixyp, iyyp, lt)
-                            in zip(ixx_pixel, ixy_pixel, iyy_pixel, localLinearTransform)])
-                    iyy = numpy.array([lt[1,0]**2*ixxp+2.*lt[1,0]*lt[1,1]*ixyp+lt[1,1]**2*iyyp
-                            for (ixxp, ixyp, iyyp, lt)
-                            in zip(ixx_pixel, ixy_pixel, iyy_pixel, localLinearTransform)])
-                    ixy = numpy.array([(lt[0,0]*lt[1,0]*ixxp +
-                                     (lt[0,0]*lt[1,1]+lt[0,1]*lt[1,0])*ixyp+
-                                     lt[0,1]*lt[1,1]*iyyp)
-                            for (ixxp, ixyp, iyyp, lt)
-                            in zip(ixx_pixel, ixy_pixel, iyy_pixel, localLinearTransform)])
-                else:
-                    ixx = 1.+g1
-                    iyy = 1.-g1
-                    ixy = g2
+            if use_hsm:  # For any galaxy type, use shape.hsm
+                g1 = numpy.array(GetColumn(data, "shape.hsm.regauss.e1"))
+                g2 = numpy.array(GetColumn(data, "shape.hsm.regauss.e2"))
+                # we do not have size in shape.hsm, but it does not matter for shapes.
+                # The size derived in this code is meaningless though.
+                moments['shape'] = numpy.array([1.+g1, 1.-g1, g2]).T.reshape(-1, 3)
             else:
-                key = data.schema.find("shape.sdss").key
-                moments = [src.get(key) for src in data]
-                if sky_coords:
-                    moments = [moment.transform(lt) for moment, lt in
-                                      zip(moments, localLinearTransform)]
-                ixx = numpy.array([mom.getIxx() for mom in moments])
-                ixy = numpy.array([mom.getIxy() for mom in moments])
-                iyy = numpy.array([mom.getIyy() for mom in moments])
+                moments['shape'] = self._readMoments(data, "shape.sdss")
         if do_err:
-            if 'galaxy' in mask_type and self.config.do_hsm:
-                key = data.schema.find('shape.hsm.regauss.sigma').key
-                errs = numpy.array([src.get(key) for src in data])
-                sigma_errs = numpy.array(errs.shape)
-                sigma_errs.fill(1.)
+            if use_hsm:
+                hsm_errs = numpy.array(GetColumn(data, 'shape.hsm.regauss.sigma'))
             else:
-                key = data.schema.find("shape.sdss.err").key
-                covariances = numpy.array([src.get(key) for src in data])
-                if sky_coords:
-                    cov_ixx = numpy.zeros(covariances[:,0,0].shape)
-                    cov_iyy = numpy.zeros(covariances[:,0,0].shape)
-                    cov_ixy = numpy.zeros(covariances[:,0,0].shape)
-                    for i, (cov, lt) in enumerate(zip(covariances,localLinearTransform)):
-                        cov_ixx[i] = (lt[0,0]**4*cov[0,0] +
-                                      (2.*lt[0,0]*lt[0,1])**2*cov[2,2] + lt[0,1]**4*cov[1,1])
-                        cov_iyy[i] = (lt[1,0]**4*cov[0,0] +
-                                      (2.*lt[1,0]*lt[1,1])**2*cov[2,2] + lt[1,1]**4*cov[1,1])
-                        cov_ixy[i] = ((lt[0,0]*lt[1,0])**2*cov[0,0] +
-                                      (lt[0,0]*lt[1,1]+lt[0,1]*lt[1,0])**2*cov[2,2] +
-                                      (lt[0,1]*lt[1,1])**2*cov[1,1])
-                else:
-                    cov_ixx = covariances[:,0,0]
-                    cov_iyy = covariances[:,1,1]
-                    cov_ixy = covariances[:,2,2]
+                covariances = self._readMomentCovariances(data, "shape.sdss.err")
         if do_psf:
-            key = data.schema.find("shape.sdss.psf").key
-            psf_moments = [src.get(key) for src in data]
-            if sky_coords:
-                psf_moments = [moment.transform(lt) for moment, lt in
-                                  zip(psf_moments, localLinearTransform)]
-            psf_ixx = numpy.array([mom.getIxx() for mom in psf_moments])
-            psf_ixy = numpy.array([mom.getIxy() for mom in psf_moments])
-            psf_iyy = numpy.array([mom.getIyy() for mom in psf_moments])
+            moments['psf'] = self._readMoments(data, "shape.sdss.psf")
+            extra_mask = self._computePSFFluxMask(data, flags)
+        else:
+            extra_mask = None
+
+        results = {}
+        for name in ['g1', 'g2', 'sigma']:
+            results[name] = numpy.zeros(len(data)) if do_shape else None
+            results[name+'_err'] = numpy.zeros(len(data)) if do_err else None
+            results['psf_'+name] = numpy.zeros(len(data)) if do_psf else None
+        # Then compute the quantities in each coordinate system from the same moments.  If both are
+        # requested, the weights come from the chip-coordinate errors, as they did when the two
+        # were computed separately in that order.
+        for frame, do_frame in [('sky', sky_coords), ('chip', chip_coords)]:
+            if not do_frame:
+                continue
+            if frame == 'sky' and moments:
+                # Transform all the moments (and the shape covariances) to sky coordinates at once.
+                local_linear_transforms = self.computeLocalLinearTransforms(data, calib)
+                moment_names = sorted(moments)
+                sky_moments, frame_covariances = stile.stile_utils.TransformMoments(
+                    numpy.array([moments[name] for name in moment_names]).transpose(1, 0, 2),
+                    local_linear_transforms, covariances)
+                frame_moments = dict([(name, sky_moments[:, i])
+                                      for i, name in enumerate(moment_names)])
+            else:
+                frame_moments, frame_covariances = moments, covariances
+            quantities = self._computeShapeQuantities(frame_moments, frame_covariances, hsm_errs,
+                                                      do_shape, do_err, do_psf, len(data))
+            if frame == 'sky':
+                # convert degree to arcsec
+                for name in ['sigma', 'sigma_err', 'psf_sigma']:
+                    if quantities[name] is not None:
+                        quantities[name] *= 3600.
+            results['w'] = quantities.pop('w')
+            for name in quantities:
+                results[name+'_'+frame] = quantities[name]
+        return results, extra_mask
+
+    @staticmethod
+    def _readMoments(data, name):
+        """
+        Read the moments field ``name`` of ``data``, an LSST source catalog, as an ``(N, 3)`` array
+        whose rows are ``(ixx, iyy, ixy)``, from the columns of its subfields.
+        """
+        return numpy.array([GetColumn(data, name+'.'+element) for element in moment_elements],
+                           dtype=float).T.reshape(-1, 3)
+
+    @staticmethod
+    def _readMomentCovariances(data, name):
+        """
+        Read the moment covariance field ``name`` of ``data``, an LSST source catalog, as an
+        ``(N, 3, 3)`` array in the order of :func:`_readMoments`, from the columns of its elements.
+        The matrices are symmetric, so each off-diagonal element is read once.
+        """
+        covariances = numpy.empty((len(data), 3, 3))
+        for i, element_i in enumerate(moment_elements):
+            for j, element_j in enumerate(moment_elements[i:], i):
+                covariances[:, i, j] = GetColumn(data, '%s.%s,%s' % (name, element_i, element_j))
+                covariances[:, j, i] = covariances[:, i, j]
+        return covariances
+
+    def _computeShapeQuantities(self, moments, covariances, hsm_errs, do_shape, do_err, do_psf,
+                                n_rows):
+        """
+        Combine moments into the shape quantities for :func:`computeShapes`: a dict with keys
+        ``'g1'``, ``'g2'``, ``'sigma'``, their ``'_err'`` and ``'psf_'`` versions, and ``'w'``,
+        with None for any quantity that was not requested.
+        """
+        if 'shape' in moments:
+            ixx, iyy, ixy = moments['shape'].T
+        if covariances is not None:
+            cov_ixx = covariances[:,0,0]
+            cov_iyy = covariances[:,1,1]
+            cov_ixy = covariances[:,2,2]
+        if 'psf' in moments:
+            psf_ixx, psf_iyy, psf_ixy = moments['psf'].T
 
         # Now, combine the moment measurements into the actual quantities we want.
         if do_shape:
@@ -546,10 +1026,10 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
             g2 = None
             sigma = None
         if do_err:
-            if 'galaxy' in mask_type and self.config.do_hsm:
-                g1_err = errs
-                g2_err = errs
-                sigma_err = sigma_errs
+            if hsm_errs is not None:
+                g1_err = hsm_errs
+                g2_err = hsm_errs
+                sigma_err = numpy.ones(hsm_errs.shape)
             else:
                 dg1_dixx = 2.*iyy/(ixx+iyy)**2
                 dg1_diyy = -2.*ixx/(ixx+iyy)**2
@@ -569,53 +1049,30 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
             g1_err = None
             g2_err = None
             sigma_err = None
-            w = [1.]*len(data)
+            w = [1.]*n_rows
         if do_psf:
             psf_g1 = (psf_ixx-psf_iyy)/(psf_ixx+psf_iyy)
             psf_g2 = 2.*psf_ixy/(psf_ixx+psf_iyy)
             psf_sigma = (psf_ixx*psf_iyy - psf_ixy**2)**0.25
-            key = data.schema.find('flux.psf.flags').key
-            extra_mask = numpy.array([src.get(key) == 0 for src in data])
         else:
             psf_g1 = None
             psf_g2 = None
             psf_sigma = None
-            extra_mask = None
-        fake_g1 = None if g1 is None else numpy.zeros(len(g1))
-        fake_g2 = None if g2 is None else numpy.zeros(len(g2))
-        fake_sigma = None if sigma is None else numpy.zeros(len(sigma))
-        fake_g1_err = None if g1_err is None else numpy.zeros(len(g1_err))
-        fake_g2_err = None if g2_err is None else numpy.zeros(len(g2_err))
-        fake_sigma_err = None if sigma_err is None else numpy.zeros(len(sigma_err))
-        fake_psf_g1 = None if psf_g1 is None else numpy.zeros(len(psf_g1))
-        fake_psf_g2 = None if psf_g2 is None else numpy.zeros(len(psf_g2))
-        fake_psf_sigma = None if psf_sigma is None else numpy.zeros(len(psf_sigma))
-
-        if sky_coords:
-            # convert degree to arcsec
-            if sigma is not None:
-                sigma *= 3600.
-            if sigma_err is not None:
-                sigma_err *= 3600.
-            if psf_sigma is not None:
-                psf_sigma *= 3600.
-            return ({'g1': fake_g1, 'g2': fake_g2, 'g1_err': fake_g1_err, 'g2_err': fake_g2_err,
-                     'sigma': fake_sigma, 'psf_g1': fake_psf_g1, 'psf_g2': fake_psf_g2,
-                     'psf_sigma': fake_psf_sigma,
-                     'g1_sky': g1, 'g2_sky': g2, 'sigma_sky': sigma, 'g1_err_sky': g1_err,
-                     'g2_err_sky': g2_err, 'sigma_err_sky': sigma_err, 'w': w,
-                     'psf_g1_sky': psf_g1, 'psf_g2_sky': psf_g2, 'psf_sigma_sky': psf_sigma},
-                     extra_mask)
-        else:
-            return ({'g1': fake_g1, 'g2': fake_g2, 'g1_err': fake_g1_err, 'g2_err': fake_g2_err,
-                     'sigma': fake_sigma, 'psf_g1': fake_psf_g1, 'psf_g2': fake_psf_g2,
-                     'psf_sigma': fake_psf_sigma,
-                     'g1_chip': g1, 'g2_chip': g2, 'sigma_chip': sigma, 'g1_err_chip': g1_err,
-                     'g2_err_chip': g2_err, 'sigma_err_chip': sigma_err, 'w': w,
-                     'psf_g1_chip': psf_g1, 'psf_g2_chip': psf_g2, 'psf_sigma_chip': psf_sigma},
-                     extra_mask)
+        return {'g1': g1, 'g2': g2, 'sigma': sigma, 'g1_err': g1_err, 'g2_err': g2_err,
+                'sigma_err': sigma_err, 'psf_g1': psf_g1, 'psf_g2': psf_g2, 'psf_sigma': psf_sigma,
+                'w': w}
 
-    def computeExtraColumn(self, col, data, calib_data, calib_type, xy0=None, mask_type=None):
+    def _computePSFFluxMask(self, data, flags=None):
+        """
+        Compute and return the mask for ``data`` that excludes PSF flux measurement failures, using
+        ``flags`` (the flags of ``data`` from :func:`readFlags`) if given.
+        """
+        if flags is not None:
+            return flags.getMask(keep_false=['flux.psf.flags'])
+        return GetColumn(data, 'flux.psf.flags') == 0
+
+    def computeExtraColumn(self, col, data, calib_data, calib_type, xy0=None, mask_type=None,
+                           flags=None, flux_fit_correction=None):
         """
         Compute the quantity ``col`` for the given ``data``.
 
@@ -626,48 +1083,48 @@ class CCDSingleEpochStileTask(lsst.pipe.base.CmdLineTask):
                            coadds where available, else "calexp").
         :param xy0:        Offset of a CCD. [default: None, meaning do not add any offset]
         :param mask_type:  The object type corresponding to the data in ``data`` [default: None]
+        :param flags:      The flags of ``data`` from :func:`readFlags`, or None to read them from
+                           ``data``. [default: None]
+        :param flux_fit_correction: The ``fcr`` zeropoint correction from
+                           :func:`getFluxFitCorrection`, or None to make one from ``calib_data``.
+                           [default: None]
         :returns:          A 2-element tuple.  The first element is a list or NumPy array of the
                            quantity indicated by ``col``. The second is either None (if no further
                            masking is needed) or a NumPy array of boolean values indicating where
                            the quantity is reliable (True) or unusable in some way (False).
 
         """
+        # Everything is computed from whole columns read as arrays; the positions and PSF fluxes
+        # come from the same slots that src.getX(), src.getPsfFlux() etc would use.
         if col == "ra":
-            return [src.getRa().asDegrees() for src in data], None
+            return numpy.degrees(GetColumn(data, 'coord.ra')), None
         elif col == "dec":
-            return [src.getDec().asDegrees() for src in data], None
-        elif col == "x":
+            return numpy.degrees(GetColumn(data, 'coord.dec')), None
+        elif col == "x" or col == "y":
+            pos = numpy.array(GetColumn(data, data.getCentroidDefinition()+'.'+col))
             if xy0:
-                return [src.getX() + xy0.getX() for src in data], None
-            else:
-                return [src.getX() for src in data], None
-        elif col == "y":
-            if xy0:
-                return [src.getY() + xy0.getY() for src in data], None
-            else:
-                return [src.getY() for src in data], None
-        elif col == "mag_err":
-            key = data.schema.find('flux.psf.flags').key
-            return (2.5/numpy.log(10)*numpy.array([src.getPsfFluxErr()/src.getPsfFlux()
-                                                    for src in data]),
-                    numpy.array([src.get(key) == 0 for src in data]))
-        elif col == "mag":
+                pos += xy0.getX() if col == "x" else xy0.getY()
+            return pos, None
+        elif col in ["mag_err", "mag", "mag_inst"]:
+            psf_flux_name = data.getPsfFluxDefinition()
+            psf_flux = GetColumn(data, psf_flux_name)
+            psf_flux_mask = self._computePSFFluxMask(data, flags)
+            if col == "mag_err":
+                return (2.5/numpy.log(10)*GetColumn(data, psf_flux_name+'.err')/psf_flux,
+                        psf_flux_mask)
+            elif col == "mag_inst":
+                return -2.5*numpy.log10(psf_flux), psf_flux_mask
             # From Steve Bickerton's helpful HSC butler documentation
             if calib_type == "fcr":
-                ffp = lsst.meas.mosaic.FluxFitParams(calib_data)
-                x = [src.getX() for src in data]
-                y = [src.getY() for src in data]
-                correction = numpy.array([ffp.eval(x[i], y[i]) for i in range(len(x))])
+                if flux_fit_correction is None:
+                    flux_fit_correction = self.makeFluxFitCorrection(calib_data, data)
+                centroid_name = data.getCentroidDefinition()
+                correction = flux_fit_correction(GetColumn(data, centroid_name+'.x'),
+                                                 GetColumn(data, centroid_name+'.y'))
                 zeropoint = 2.5*numpy.log10(calib_data.get("FLUXMAG0")) + correction
             elif calib_type == "calexp":
                 zeropoint = 2.5*numpy.log10(calib_data.get("FLUXMAG0"))
-            key = data.schema.find('flux.psf.flags').key
-            return (zeropoint - 2.5*numpy.log10(numpy.array([src.getPsfFlux() for src in data])),
-                    numpy.array([src.get(key) == 0 for src in data]))
-        elif col == "mag_inst":
-            key = data.schema.find('flux.psf.flags').key
-            return (-2.5*numpy.log10(numpy.array([src.getPsfFlux() for src in data])),
-                    numpy.array([src.get(key) == 0 for src in data]))
+            return zeropoint - 2.5*numpy.log10(psf_flux), psf_flux_mask
         elif col == "w":
             # Use uniform weights for now if we don't use shapes ("w" will be removed from the
             # list of columns if shapes are computed).
@@ -704,6 +1161,31 @@ class CCDNoTractSingleEpochStileTask(CCDSingleEpochStileTask):
         return parser
 
 
+def ValidatePrefetch(config):
+    """
+    Raise a ValueError if ``config`` asks to prefetch catalogs while running the sys tests in a
+    pool of worker processes.  The workers are forked while the prefetch threads may be in the
+    middle of loading catalogs, so they could inherit locks (eg for logging, memory allocation or
+    the butler) that those threads were holding.
+    """
+    if config.prefetch_catalogs and config.n_sys_test_processes > 1:
+        raise ValueError("prefetch_catalogs can't be used with n_sys_test_processes > 1")
+
+
+def AddPrefetchTargets(parsedCmd, targets):
+    """
+    If ``config.prefetch_catalogs`` is set and the targets will be run one after another in this
+    process (with the sys tests run in this process too, see :func:`ValidatePrefetch`), append the
+    next target's dataRef list to each ``(id, dataRefList)`` target, so that
+    :func:`VisitSingleEpochStileTask.run` can start loading those catalogs early.
+    """
+    if (not parsedCmd.config.prefetch_catalogs or getattr(parsedCmd, 'processes', 1) > 1 or
+            parsedCmd.config.n_sys_test_processes > 1 or len(targets) < 2):
+        return targets
+    return [target+(next_target[1],) for target, next_target in zip(targets, targets[1:])] + \
+           [targets[-1]]
+
+
 class StileVisitRunner(lsst.pipe.base.TaskRunner):
     """Subclass of :class:`TaskRunner` for Stile visit tasks.  Most of this code (incl this docstring)
     pulled from :class:`measMosaic`.
@@ -725,9 +1207,9 @@ class StileVisitRunner(lsst.pipe.base.TaskRunner):
         for ref in parsedCmd.id.refList:
             refListDict.setdefault(ref.dataId["visit"], []).append(ref)
         # we call run() once with each visit
-        return [(visit,
+        return AddPrefetchTargets(parsedCmd, [(visit,
                  refListDict[visit]
-                 ) for visit in sorted(refListDict.keys())]
+                 ) for visit in sorted(refListDict.keys())])
 
     def __call__(self, args):
         task = self.TaskClass(config=self.config, log=self.log)
@@ -762,8 +1244,36 @@ class VisitSingleEpochStileConfig(CCDSingleEpochStileConfig):
         doc="length of whisker per inch", default=0.4)
     scatterplot_per_ccd_stat = lsst.pex.config.Field(dtype=str, default='median',
                          doc="Which statistics (median, mean, or None) to be performed in CCDs.")
+    n_load_threads = lsst.pex.config.Field(dtype=int, default=4,
+        doc="Number of catalogs to load at once (1 to load them one at a time)")
+    prefetch_catalogs = lsst.pex.config.Field(dtype=bool, default=False,
+        doc="Load the next target's catalogs while the sys tests run on the current one (only "
+            "when running in a single process; can't be combined with n_sys_test_processes > 1)")
     ccd_type = 'S7'
 
+    def validate(self):
+        CCDSingleEpochStileConfig.validate(self)
+        ValidatePrefetch(self)
+
+# Catalogs being loaded in the background for the next run (see
+# VisitSingleEpochStileTask.prefetchCatalogs).  This is module-level since the runners make a new
+# task for every target.
+_prefetched_catalogs = {}
+
+
+def _discardPrefetchedCatalogs(key=None):
+    """
+    Stop loading the prefetched catalogs for ``key`` (as made by
+    :func:`VisitSingleEpochStileTask._catalogKey`), or for every key if ``key`` is None, and
+    forget them, so that no loads are left running in the background.
+    """
+    keys = _prefetched_catalogs.keys() if key is None else [key]
+    for key in keys:
+        pending = _prefetched_catalogs.pop(key, None)
+        if pending is not None:
+            pending.terminate()
+
+
 class VisitSingleEpochStileTask(CCDSingleEpochStileTask):
     """
     A basic Task class to run visit-level single-epoch tests.  Inheriting from
@@ -817,7 +1327,7 @@ class VisitSingleEpochStileTask(CCDSingleEpochStileTask):
                 ccd_str += "^%03d" % ccd
         return dir, "-%07d-%s" % (dataRefList[0].dataId["visit"], ccd_str)
 
-    def run(self, visit, dataRefList):
+    def run(self, visit, dataRefList, prefetch_dataRefList=None):
         # It seems like it would make more sense to put all of this in a separate function and run
         # it once per catalog, then collate the results at the end (just before running the test).
         # Turns out that, compared to the current implementation, that takes 2-3 times as long to
@@ -825,19 +1335,38 @@ class VisitSingleEpochStileTask(CCDSingleEpochStileTask):
         # the name of runtime, at the expense of some complexity in terms of nested lists of things.
         # Some of this code is annotated more clearly in the CCD* version of this class.
 
-        # temporary fix for a patch that exists in dataRefList but not in catalogs.
-        catalogs = list()
-        for dataRef in dataRefList:
-            try:
-                catalogs.append(dataRef.get(self.catalog_type, immediate=True,
-                                flags=afwTable.SOURCE_IO_NO_FOOTPRINTS))
-            except RuntimeError as e:
-                print e, ', skip this patch'
-        catalogs = [self.removeFlaggedObjects(catalog) for catalog in catalogs]
+        # temporary fix for a patch that exists in dataRefList but not in catalogs.  The catalogs
+        # are loaded concurrently (or were prefetched during the previous run), and dataRefList is
+        # trimmed to match; the output filenames still describe all the requested dataRefs.
+        requested_dataRefList = dataRefList
+        dir, filename_chips = self.getFilenameBase(requested_dataRefList)
+        result_id = self.getResultId(requested_dataRefList)
+        # If we're skipping tests whose inputs haven't changed, find the ones left to run.
+        sys_tests, fingerprints = self.findStaleSysTests(dir, dataRefList, result_id)
+        if not sys_tests:
+            self.log.info("Outputs for %s are up to date" % result_id)
+            _discardPrefetchedCatalogs(self._catalogKey(dataRefList))
+            if prefetch_dataRefList:
+                self.prefetchCatalogs(prefetch_dataRefList)
+            return
+        loaded, failed = self.loadCatalogs(dataRefList)
+        for dataRef, e in failed:
+            print e, ', skip this patch'
+        dataRefList = [dataRef for dataRef, catalog in loaded]
+        catalogs = [catalog for dataRef, catalog in loaded]
+        if prefetch_dataRefList:
+            self.prefetchCatalogs(prefetch_dataRefList)
+        # Read the flags of each catalog once, and remove the badly measured objects.
+        catalogs_and_flags = [self.removeFlaggedObjects(catalog, self.readFlags(catalog))
+                              for catalog in catalogs]
+        catalogs = [catalog for catalog, flags in catalogs_and_flags]
+        flags_list = [flags for catalog, flags in catalogs_and_flags]
         sys_data_list = []
         extra_col_dicts = [{} for catalog in catalogs]
-
-        dir, filename_chips = self.getFilenameBase(dataRefList)
+        # Masks are computed once per catalog and object type (or set of shape flags), not once per
+        # sys test.
+        mask_caches = [{} for catalog in catalogs]
+        config_fingerprint = ConfigFingerprint(self.config)
 
         # Some tests need to know which data came from which CCD
         for dataRef, catalog, extra_col_dict in zip(dataRefList, catalogs, extra_col_dicts):
@@ -847,23 +1376,28 @@ class VisitSingleEpochStileTask(CCDSingleEpochStileTask):
                                            str(dataRef.dataId[self.item_type]))
             else:
                 extra_col_dict['CCD'].fill(dataRef.dataId[self.item_type])
-        for sys_test in self.sys_tests:
+        for sys_test in sys_tests:
             sys_test_data = SysTestData()
             sys_test_data.sys_test_name = sys_test.name
             # Masks expects: a tuple of tuples, with each tuple having a mask name and a mask,
             # and one tuple for each required data set for the sys_test
-            temp_mask_tuple_list = [sys_test.getMasks(catalog, self.config) for catalog in catalogs]
+            temp_mask_tuple_list = [sys_test.getMasks(catalog, self.config, flags, mask_cache,
+                                                      config_fingerprint)
+                                    for catalog, flags, mask_cache in zip(catalogs, flags_list,
+                                                                          mask_caches)]
             # cols expects: an iterable of iterables, describing for each required data set
             # the set of extra required columns.
             sys_test_data.cols_list = sys_test.getRequiredColumns()
             if any([key in c for cols_list in sys_test_data.cols_list for c in cols_list
                     for key in ['g1', 'g2', 'sigma']]):
-                shape_masks = [[self._computeShapeMask(catalog, mask_type=mask[0])
+                shape_masks = [[self._computeShapeMask(catalog, mask_type=mask[0], flags=flags,
+                                                       mask_cache=mask_cache)
                                 for mask in mask_tuple_list]
-                                for catalog, mask_tuple_list in zip(catalogs, temp_mask_tuple_list)]
+                               for catalog, flags, mask_cache, mask_tuple_list in zip(catalogs,
+                                                flags_list, mask_caches, temp_mask_tuple_list)]
             else:
-                shape_masks = [[[True]*len(catalog) for mask in mask_tuple_list]
-                               for catalog, mask_tuple_list in zip(catalogs, temp_mask_tuple_list)]
+                shape_masks = [[True for mask in mask_tuple_list]
+                               for mask_tuple_list in temp_mask_tuple_list]
             # Now, temp_mask_tuple_list and shape_mask is ordered such that there is one list per
             # catalog, and the list for each catalog iterates through the sys tests.  But we
             # actually want one list per sys test, and the list for each sys test to iterate through
@@ -876,57 +1410,104 @@ class VisitSingleEpochStileTask(CCDSingleEpochStileTask):
                     for i in range(len(temp_mask_tuple_list[0]))]
             for (mask_tuple_list, cols) in zip(sys_test_data.mask_tuple_list,
                                                sys_test_data.cols_list):
-                for dataRef, mask, catalog, extra_col_dict in zip(dataRefList, mask_tuple_list,
-                                                                  catalogs, extra_col_dicts):
-                    self.generateColumns(dataRef, catalog, mask, cols, extra_col_dict)
+                for dataRef, mask, catalog, extra_col_dict, flags in zip(dataRefList,
+                        mask_tuple_list, catalogs, extra_col_dicts, flags_list):
+                    self.generateColumns(dataRef, catalog, mask, cols, extra_col_dict, flags)
             # Some tests need to know which data came from which CCD, so we add a column for that
             # here to make sure it's propagated through to the sys_tests.
             sys_test_data.cols_list = [list(cols)+['CCD'] for cols in sys_test_data.cols_list]
             sys_data_list.append(sys_test_data)
+        self.writeColumnCaches()
         for sys_data in sys_data_list:
             for cols in sys_data.cols_list:
                 for c in cols:
                     if '_sky' in c or '_chip' in c:
                         cols.append('_'.join(c.split('_')[:-1]))
-        for sys_test, sys_test_data in zip(self.sys_tests, sys_data_list):
+        column_store = stile.stile_utils.ColumnStore()
+        sys_test_jobs = []
+        for sys_test, sys_test_data in zip(sys_tests, sys_data_list):
             new_catalogs = []
             for mask_tuple_list, cols in zip(sys_test_data.mask_tuple_list,
                                              sys_test_data.cols_list):
-                new_catalog = {}
-                for column in cols:
+                # The masked columns are lists of the quantity we want, one per dataRef.
+                def makeColumn(column):
+                    newcols = []
                     for catalog, extra_col_dict, (mask_type, mask) in zip(catalogs, extra_col_dicts,
                                                                           mask_tuple_list):
                         if column in extra_col_dict:
-                            newcol = extra_col_dict[column][mask]
+                            newcols.append(extra_col_dict[column][mask])
                         elif column in catalog.schema:
-                            key = catalog.schema.find(column).key
-                            try:
-                                newcol = catalog.get(key)[mask]
-                            except LsstCppException:
-                                newcol = numpy.array([src.get(key) for src in catalog])[mask]
-                        # The new_catalog dict has values which are lists of the quantity we want,
-                        # one per dataRef.
-                        if column in new_catalog:
-                            new_catalog[column].append(newcol)
-                        else:
-                            new_catalog[column] = [newcol]
-                new_catalogs.append(self.makeArray(new_catalog))
-            results = sys_test(self.config, *new_catalogs)
+                            newcols.append(GetColumn(catalog, column)[mask])
+                    return newcols or None
+                mask_key = column_store.maskKey([mask for mask_type, mask in mask_tuple_list])
+                new_catalogs.append(column_store.getArray(mask_key, cols, makeColumn,
+                                                          self.makeArray))
+            sys_test_jobs.append((sys_test, new_catalogs))
+        sys_test_results = self.runSysTests(sys_test_jobs)
+        # Outputs are written in the background while the next ones are prepared.
+        writer = stile.AsyncWriter(self.config.n_queued_outputs)
+        result_store = self.getResultStore(dir)
+        outputs_list = []
+        for sys_test, sys_test_data, (results, sys_test_output) in zip(sys_tests,
+                                                                       sys_data_list,
+                                                                       sys_test_results):
             this_max_path_length = max_path_length-4-len(sys_test_data.sys_test_name)
+            base_name = sys_test_data.sys_test_name+filename_chips[:this_max_path_length]
+            outputs = set()
             if isinstance(results, numpy.ndarray):
-                stile.WriteASCIITable(os.path.join(dir,
-                      sys_test_data.sys_test_name+filename_chips[:this_max_path_length]+'.dat'),
-                      results, print_header=True)
+                outputs.add(self.writeResultTable(writer, result_store, dir, base_name+'.dat',
+                                                  sys_test_data.sys_test_name, result_id, results))
             if hasattr(sys_test.sys_test, 'getData'):
-                stile.WriteASCIITable(os.path.join(dir,
-                      sys_test_data.sys_test_name+filename_chips[:this_max_path_length]+'.dat'),
-                      sys_test.sys_test.getData(), print_header=True)
-            if hasattr(results, 'savefig'):
-                results.savefig(os.path.join(dir,
-                      sys_test_data.sys_test_name+filename_chips[:this_max_path_length]+'.png'))
+                outputs.add(self.writeResultTable(writer, result_store, dir, base_name+'.dat',
+                                                  sys_test_data.sys_test_name, result_id,
+                                                  sys_test_output))
+            # Make the plot before handing the results to the writer, which closes figures once
+            # they're saved; if the results are a figure, plot() just returns them.
             fig = sys_test.sys_test.plot(results)
-            fig.savefig(os.path.join(dir,
-                      sys_test_data.sys_test_name+filename_chips[:this_max_path_length]+'.png'))
+            if hasattr(results, 'savefig'):
+                writer.saveFigure(results, os.path.join(dir, base_name+'.png'))
+            if fig is not results:
+                writer.saveFigure(fig, os.path.join(dir, base_name+'.png'))
+            outputs.add(base_name+'.png')
+            outputs_list.append(outputs)
+        # Wait for the outputs to be written, raising any errors from writing them.
+        writer.close()
+        self.recordFingerprints(fingerprints, result_id, sys_tests, outputs_list)
+        self.reportColumnStore(column_store)
+        self.reportSlowColumnReads()
+
+    def _loadCatalog(self, dataRef):
+        return dataRef.get(self.catalog_type, immediate=True,
+                           flags=afwTable.SOURCE_IO_NO_FOOTPRINTS)
+
+    @staticmethod
+    def _catalogKey(dataRefList):
+        return tuple([tuple(sorted(dataRef.dataId.items())) for dataRef in dataRefList])
+
+    def loadCatalogs(self, dataRefList):
+        """
+        Load the catalogs for ``dataRefList`` with ``config.n_load_threads`` threads, or collect
+        them from an earlier :func:`prefetchCatalogs` call for the same dataRefs.
+
+        :param dataRefList: A list of dataRefs.
+        :returns:           A tuple of two lists: ``(dataRef, catalog)`` pairs for the catalogs
+                            that were loaded, in the order of ``dataRefList``, and ``(dataRef,
+                            exception)`` pairs for the dataRefs whose catalogs could not be read.
+        """
+        pending = _prefetched_catalogs.pop(self._catalogKey(dataRefList), None)
+        if pending is not None:
+            return pending.get()
+        return stile.stile_utils.LoadConcurrently(self._loadCatalog, dataRefList,
+                                                  n_workers=self.config.n_load_threads)
+
+    def prefetchCatalogs(self, dataRefList):
+        """
+        Start loading the catalogs for ``dataRefList`` in the background, to be collected by a
+        later :func:`loadCatalogs` call for the same dataRefs (normally the next run).
+        """
+        _discardPrefetchedCatalogs()  # drop anything prefetched but never used
+        _prefetched_catalogs[self._catalogKey(dataRefList)] = stile.stile_utils.LoadConcurrently(
+            self._loadCatalog, dataRefList, n_workers=self.config.n_load_threads, wait=False)
 
     def makeArray(self, catalog_dict):
         """
@@ -1106,12 +1687,15 @@ class PatchSingleEpochStileTask(CCDSingleEpochStileTask):
     """Like :class:`CCDSingleEpochStileTask`, but for use on single coadd patches instead of
     single CCDs."""
     _DefaultName = "PatchSingleEpochStile"
+    result_id_keys = ('tract', 'patch')
     ConfigClass = PatchSingleEpochStileConfig
 
     def __init__(self, **kwargs):
         lsst.pipe.base.CmdLineTask.__init__(self, **kwargs)
         self.sys_tests = self.config.sys_tests.apply()
         self.catalog_type = self.config.coadd_catalog_type
+        self.flux_fit_corrections = {}
+        self.column_caches = {}
 
     @staticmethod
     def getFilenameBase(dataRef):
@@ -1198,9 +1782,18 @@ class TractSingleEpochStileConfig(CCDSingleEpochStileConfig):
                  'flags.pixel.saturated.center', 'flags.pixel.cr.any', 'flags.pixel.cr.center',
                  'flags.pixel.bad', 'flags.pixel.suspect.any', 'flags.pixel.suspect.center',
                  'flags.pixel.clipped.any'])
+    n_load_threads = lsst.pex.config.Field(dtype=int, default=4,
+        doc="Number of catalogs to load at once (1 to load them one at a time)")
+    prefetch_catalogs = lsst.pex.config.Field(dtype=bool, default=False,
+        doc="Load the next target's catalogs while the sys tests run on the current one (only "
+            "when running in a single process; can't be combined with n_sys_test_processes > 1)")
 
     ccd_type = 'S7'  # NumPy string dtype, 7 characters long
 
+    def validate(self):
+        CCDSingleEpochStileConfig.validate(self)
+        ValidatePrefetch(self)
+
 class StileTractRunner(lsst.pipe.base.TaskRunner):
     """Subclass of :class:`TaskRunner` for Stile tract tasks.  Most of this code (incl this docstring)
     pulled from :class:`measMosaic`.
@@ -1222,9 +1815,9 @@ class StileTractRunner(lsst.pipe.base.TaskRunner):
         for ref in parsedCmd.id.refList:
             refListDict.setdefault(ref.dataId["tract"], []).append(ref)
         # we call run() once with each visit
-        return [(tract,
+        return AddPrefetchTargets(parsedCmd, [(tract,
                  refListDict[tract]
-                 ) for tract in sorted(refListDict.keys())]
+                 ) for tract in sorted(refListDict.keys())])
 
     def __call__(self, args):
         task = self.TaskClass(config=self.config, log=self.log)
@@ -1241,6 +1834,7 @@ class TractSingleEpochStileTask(VisitSingleEpochStileTask):
     instead of CCD."""
     RunnerClass = StileTractRunner
     _DefaultName = "TractSingleEpochStile"
+    result_id_keys = ('tract', 'patch')
     ConfigClass = TractSingleEpochStileConfig
     item_type = 'patch'  # Key to populate a fake 'CCD' column for the tests that will use it
 
@@ -1248,6 +1842,8 @@ class TractSingleEpochStileTask(VisitSingleEpochStileTask):
         lsst.pipe.base.CmdLineTask.__init__(self, **kwargs)
         self.sys_tests = self.config.sys_tests.apply()
         self.catalog_type = self.config.coadd_catalog_type
+        self.flux_fit_corrections = {}
+        self.column_caches = {}
 
     @staticmethod
     def getFilenameBase(dataRefList):
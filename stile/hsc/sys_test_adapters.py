@@ -2,6 +2,7 @@
 sys_test_adapters.py: Contains classes to wrap Stile systematics tests with functions necessary to run the tests via the
 HSC/LSST pipeline.
 """
+import collections
 import lsst.pex.config
 from lsst.pex.exceptions import LsstCppException
 from .. import sys_tests
@@ -9,66 +10,88 @@ import numpy
 
 adapter_registry = lsst.pex.config.makeRegistry("Stile test outputs")
 
+# The number of times GetColumn() had to read a column one source at a time, by column name.  The
+# tasks in base_tasks.py make their catalogs contiguous, so this should stay empty; if it doesn't,
+# some catalog is being subset without being copied.
+slow_column_reads = collections.Counter()
+
+
+def GetColumn(catalog, name):
+    """
+    Return the column ``name`` of ``catalog``, an LSST source catalog, as a NumPy array.  For
+    contiguous catalogs this is a fast, vectorized view of the column.  Otherwise (eg for a catalog
+    that was subset with a mask and not copied), the column is read one source at a time and the
+    read is counted in ``slow_column_reads``.
+    """
+    try:
+        return catalog[name]
+    except LsstCppException:
+        slow_column_reads[name] += 1
+        key = catalog.schema.find(name).key
+        return numpy.array([src.get(key) for src in catalog])
+
 
 # We need to mask the data to particular object types; these pick out the flags we need to do that.
-def MaskGalaxy(data, config):
+# The mask functions all take an optional ``flags`` argument, a stile.stile_utils.PackedFlags object
+# holding the flag columns of ``data``; when it is given, it is used instead of reading the flags
+# from the catalog.  These are the flags the mask functions below may need, beyond the ones the
+# tasks in base_tasks.py already read.
+mask_flags = ['calib.psf.used', 'calib.psf.used.any', 'flux.psf.flags']
+
+
+def MaskGalaxy(data, config, flags=None):
     """
     Given ``data``, an LSST source catalog, return a NumPy boolean array describing which rows
     correspond to galaxies.
     """
     # Will have to be more careful/clever about this when classification.extendedness is
-    # continuous. These arrays are generally contiguous in memory--so we can just index them like a
-    # NumPy recarray.
-    try:
-        return data['classification.extendedness'] == 1
-    except LsstCppException:
-        # But sometimes we've already masked the array--this will work in that case (but is slower
-        # than above if the above is possible).
-        key = data.schema.find('classification.extendedness').key
-        return numpy.array([src[key] == 1 for src in data])
+    # continuous.
+    return GetColumn(data, 'classification.extendedness') == 1
 
 
-def MaskStar(data, config):
+def MaskStar(data, config, flags=None):
     """
     Given ``data``, an LSST source catalog, return a NumPy boolean array describing which rows
     correspond to stars.
     """
-    try:
-        return data['classification.extendedness'] == 0
-    except LsstCppException:
-        key = data.schema.find('classification.extendedness').key
-        return numpy.array([src[key] == 0 for src in data])
+    return GetColumn(data, 'classification.extendedness') == 0
 
 
-def MaskBrightStar(data, config):
+def MaskBrightStar(data, config, flags=None):
     """
     Given ``data``, an LSST source catalog, return a NumPy boolean array describing which rows
     correspond to bright stars according to a given S/N cutoff set by
     ``config.bright_star_sn_cutoff``.
     """
-    star_mask = MaskStar(data, config)
-    key_psf = data.schema.find('flux.psf').key
-    key_psf_err = data.schema.find('flux.psf.err').key
-    bright_mask = (numpy.array([src[key_psf]/src[key_psf_err] for src in data]) >
+    star_mask = MaskStar(data, config, flags)
+    bright_mask = (GetColumn(data, 'flux.psf')/GetColumn(data, 'flux.psf.err') >
                    config.bright_star_sn_cutoff)
     return numpy.logical_and(star_mask, bright_mask)
 
 
-def MaskPSFStar(data, config):
+def MaskPSFStar(data, config, flags=None):
     """
     Given ``data``, an LSST source catalog, return a NumPy boolean array describing which rows
     correspond to the stars used to determine the PSF.
     """
-    try:
-        return data['calib.psf.used'] == True
-    except LsstCppException:
-        try:
-            key = data.schema.find('calib.psf.used').key
-        except KeyError:
-            key = data.schema.find('calib.psf.used.any').key
-        key_shape = data.schema.find('shape.sdss.flags').key
-        return numpy.logical_and(numpy.array([src.get(key) == True for src in data]),
-                                 numpy.array([src.get(key_shape) == False for src in data]))
+    # Older catalogs call the PSF star flag calib.psf.used.any
+    for psf_used in ['calib.psf.used', 'calib.psf.used.any']:
+        if psf_used in data.schema:
+            break
+    else:
+        raise KeyError('Neither calib.psf.used nor calib.psf.used.any is in the catalog schema, so '
+                       'the PSF stars cannot be selected')
+    if flags is not None:
+        return flags.getMask(keep_true=[psf_used])
+    return GetColumn(data, psf_used) == True
+
+
+def ConfigFingerprint(config):
+    """
+    Return a hashable object identifying the values of the fields of an LSST config object, so
+    that things computed from a config can be cached.
+    """
+    return repr(sorted(config.toDict().items()))
 
 # Map the object type strings onto the above functions.
 mask_dict = {'galaxy': MaskGalaxy,
@@ -138,19 +161,43 @@ class BaseSysTestAdapter(object):
         self.mask_funcs = [mask_dict[obj_type] for obj_type in self.objects_list]
 
 
-    def getMasks(self, data, config):
+    def getMasks(self, data, config, flags=None, mask_cache=None, config_fingerprint=None):
         """
         Given ``data``, a source catalog from the LSST pipeline, return a list of masks.  Each
         element of the list is a mask corresponding to a particular object type, such as "star" or
         "galaxy."
+
+        Most tests use the same few object types, so the masks can be shared between tests by
+        passing the same ``mask_cache`` dict (one per catalog) to each test's :func:`getMasks`.
+        Each mask is then computed once per mask function and config; the masks returned are
+        the cached arrays themselves, so they are read-only.
         
-        :param data:  An LSST source catalog.
-        :returns:     A list of NumPy arrays; each array is made up of bools that can be broadcast
-                      to index the data, returning only the rows that meet the requirements of the
-                      mask.
+        :param data:       An LSST source catalog.
+        :param flags:      A :class:`stile.stile_utils.PackedFlags` object containing the flags of
+                           ``data``, or None to read them from ``data``. [default: None]
+        :param mask_cache: A dict of masks already computed for ``data``, or None to compute all
+                           the masks. [default: None]
+        :param config_fingerprint: The :func:`ConfigFingerprint` of ``config``, computed once by
+                           the caller rather than on every call. [default: None, to compute it
+                           here if ``mask_cache`` is given]
+        :returns:          A list of NumPy arrays; each array is made up of bools that can be
+                           broadcast to index the data, returning only the rows that meet the
+                           requirements of the mask.
         """
-        return [(obj, mask_func(data, config))
-                for obj, mask_func in zip(self.objects_list, self.mask_funcs)]
+        if mask_cache is None:
+            return [(obj, mask_func(data, config, flags))
+                    for obj, mask_func in zip(self.objects_list, self.mask_funcs)]
+        if config_fingerprint is None:
+            config_fingerprint = ConfigFingerprint(config)
+        masks = []
+        for obj, mask_func in zip(self.objects_list, self.mask_funcs):
+            key = (mask_func, config_fingerprint)
+            if key not in mask_cache:
+                mask = numpy.asarray(mask_func(data, config, flags))
+                mask.flags.writeable = False
+                mask_cache[key] = mask
+            masks.append((obj, mask_cache[key]))
+        return masks
 
 
     def getRequiredColumns(self):
@@ -206,9 +253,12 @@ class ShapeSysTestAdapter(BaseSysTestAdapter):
         return return_reqs
 
     def fixArray(self, array):
-        for field in self.shape_fields:
-            if field in array.dtype.names:
-                array[field] = array[field+'_'+self.shape_type]
+        fields = [field for field in self.shape_fields if field in array.dtype.names]
+        # Arrays shared between tests through a ColumnStore are read-only, so copy those first
+        if fields and not array.flags.writeable:
+            array = array.copy()
+        for field in fields:
+            array[field] = array[field+'_'+self.shape_type]
         return array
 
     def __call__(self, task_config, *data, **kwargs):
@@ -271,6 +321,15 @@ class Rho1Adapter(ShapeSysTestAdapter):
         self.setupMasks()
 
 
+class RhoStatisticsAdapter(ShapeSysTestAdapter):
+    def __init__(self, config):
+        self.shape_type = 'sky'
+        self.config = config
+        self.sys_test = sys_tests.RhoStatisticsSysTest()
+        self.name = self.sys_test.short_name
+        self.setupMasks()
+
+
 class StatsPSFFluxAdapter(ShapeSysTestAdapter):
     """
     Adapter for the :class:`StatSysTest`.  See the documentation for that class or
@@ -286,14 +345,11 @@ class StatsPSFFluxAdapter(ShapeSysTestAdapter):
         self.mask_funcs = [self.MaskPSFFlux]
         self.objects_list = ['galaxy']
 
-    def MaskPSFFlux(self, data, config):
-        base_mask = mask_dict['galaxy'](data, config)
-        try:
-            additional_mask = data['flux.psf.flags'] == 0
-        except LsstCppException:
-            key = data.schema.find('flux.psf.flags').key
-            additional_mask = numpy.array([src.get(key) == False for src in data])
-        return numpy.logical_and(base_mask, additional_mask)
+    def MaskPSFFlux(self, data, config, flags=None):
+        base_mask = mask_dict['galaxy'](data, config, flags)
+        if flags is not None:
+            return numpy.logical_and(base_mask, flags.getMask(keep_false=['flux.psf.flags']))
+        return numpy.logical_and(base_mask, GetColumn(data, 'flux.psf.flags') == False)
 
     def getRequiredColumns(self):
         return (('flux.psf',),)
@@ -481,6 +537,7 @@ adapter_registry.register("StarXGalaxyShear", StarXGalaxyShearAdapter)
 adapter_registry.register("StarXStarShear", StarXStarShearAdapter)
 adapter_registry.register("StarXStarSizeResidual", StarXStarSizeResidualAdapter)
 adapter_registry.register("Rho1", Rho1Adapter)
+adapter_registry.register("RhoStatistics", RhoStatisticsAdapter)
 adapter_registry.register("WhiskerPlotStar", WhiskerPlotStarAdapter)
 adapter_registry.register("WhiskerPlotPSF", WhiskerPlotPSFAdapter)
 adapter_registry.register("WhiskerPlotResidual", WhiskerPlotResidualAdapter)
@@ -0,0 +1,107 @@
+"""
+sys_test_runner.py: Runs the sys test adapters of the HSC tasks on their input arrays, optionally in
+a pool of worker processes.
+"""
+import multiprocessing
+from .. import sys_tests
+
+
+# The sys tests and their input arrays for RunSysTests.  This is module-level so that forked worker
+# processes inherit it instead of receiving pickled copies.
+_sys_test_jobs = []
+
+
+class _SingleThreadConfig(object):
+    """
+    A view of a task config whose ``treecorr_kwargs`` limit TreeCorr to one OpenMP thread, for sys
+    tests run in forked worker processes (see :func:`RunSysTests`).
+    """
+    def __init__(self, config):
+        self._config = config
+
+    def __getattr__(self, name):
+        value = getattr(self._config, name)
+        if name == 'treecorr_kwargs':
+            value = dict(value or {})
+            value['num_threads'] = 1
+        return value
+
+
+def _runSysTest(args):
+    """
+    Run the sys test ``_sys_test_jobs[index]`` and return its results and (if it has a
+    ``getData()`` method) its output data.
+
+    :param args: A tuple of (index, single_thread), where ``single_thread`` says whether to limit
+                 TreeCorr to one OpenMP thread.
+    """
+    index, single_thread = args
+    sys_test, config, new_catalogs = _sys_test_jobs[index]
+    if single_thread:
+        config = _SingleThreadConfig(config)
+    results = sys_test(config, *new_catalogs)
+    if hasattr(sys_test.sys_test, 'getData'):
+        return results, sys_test.sys_test.getData()
+    return results, None
+
+
+def _makesFigure(sys_test):
+    """
+    Return True if the sys test adapter ``sys_test`` returns a matplotlib figure when called.
+    """
+    return isinstance(sys_test.sys_test, (sys_tests.BaseWhiskerPlotSysTest,
+                                          sys_tests.BaseScatterPlotSysTest,
+                                          sys_tests.HistogramSysTest))
+
+
+def RunSysTests(jobs, task_config, n_processes=1):
+    """
+    Run sys test adapters (as used by the HSC tasks) on their input arrays, using up to
+    ``n_processes`` processes.
+
+    The tests are independent of each other, so with more than one process the tests that compute
+    data (such as correlation functions) are run by a pool of forked workers, while the tests that
+    draw figures are run in this process at the same time, so that no figures have to be sent
+    between processes.  The workers inherit the sys tests and their input arrays from this process
+    (see :data:`_sys_test_jobs`) rather than having them pickled, and only the results are sent
+    back.  OpenMP can't start new threads in a forked process once the parent process has used it,
+    so the workers limit TreeCorr to one thread, as :func:`processCFs
+    <stile.sys_tests.BaseCorrelationFunctionSysTest.processCFs>` does.  Since the workers are
+    forked, no other threads (such as ones loading catalogs) should be running when this is called:
+    a worker could inherit a lock one of them was holding.
+
+    :param jobs:        A list of ``(sys_test, new_catalogs)`` pairs, where ``sys_test`` is a sys
+                        test adapter and ``new_catalogs`` is the list of arrays to call it with.
+    :param task_config: The task config to call the sys tests with.
+    :param n_processes: The number of processes to use. [default: 1]
+    :returns:           A list, in the same order as ``jobs``, of ``(results, output)`` pairs:
+                        whatever the sys test returned, and the result of its ``getData()`` method
+                        if it has one (else None).
+    """
+    global _sys_test_jobs
+    _sys_test_jobs = [(sys_test, task_config, new_catalogs) for sys_test, new_catalogs in jobs]
+    try:
+        worker_indices = [i for i, (sys_test, new_catalogs) in enumerate(jobs)
+                          if not _makesFigure(sys_test)]
+        n_processes = min(n_processes, len(worker_indices))
+        if n_processes <= 1:
+            return [_runSysTest((i, False)) for i in range(len(jobs))]
+        results = [None]*len(jobs)
+        pool = multiprocessing.Pool(n_processes)
+        try:
+            pending = pool.map_async(_runSysTest, [(i, True) for i in worker_indices],
+                                     chunksize=1)
+            pool.close()
+            for i in range(len(jobs)):
+                if i not in worker_indices:
+                    results[i] = _runSysTest((i, False))
+            for i, result in zip(worker_indices, pending.get()):
+                results[i] = result
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return results
+    finally:
+        _sys_test_jobs = []
@@ -3,6 +3,7 @@ stile_utils.py: Various utilities for the Stile pipeline.  Includes input parsin
 numerical helper functions.
 """
 
+import hashlib
 import numpy
 
 
@@ -17,7 +18,7 @@ def Parser():
     return p
 
 
-def FormatArray(d, fields=None):
+def FormatArray(d, fields=None, copy=True):
     """
     Turn a regular NumPy array of arbitrary types into a formatted array, with optional field name
     description.
@@ -34,6 +35,10 @@ def FormatArray(d, fields=None):
                    keys should replace (or, if the array is already formatted, the existing field
                    names the keys should replace); alternately, a list with the same length as the
                    rows of ``d``. [default: None]
+    :param copy:   Whether an unformatted ``d`` is always copied into the returned array.  If
+                   False and ``d`` is a C-contiguous, native byte order NumPy array, the returned
+                   array is a view of the same memory, so changing either one changes the other.
+                   (An array that is already formatted is never copied.) [default: True]
     :returns:      A formatted numpy array with the same shape as ``d`` except that the innermost
                    dimension has turned into a record field if it was not already one, optionally
                    with field names appropriately replaced.
@@ -55,23 +60,40 @@ def FormatArray(d, fields=None):
         # records/fields.  So we need to reformat the array.  Given the difficulty of generating
         # an individual dtype for each field, we'll just use the dtype of the overall array for
         # every entry, which involves no casting of types.
+        original_d = d
         d_shape = d.shape
         if len(d_shape) == 1:  # Assume this was a single row (not a set of 1-column rows)
             d = numpy.array([d])
             d_shape = d.shape
-        # Cast this into a 2-d array
+        # Cast this into a 2-d array, in native byte order (so the dtype string below, which has no
+        # byte order information for most types, describes the data correctly)
         new_d = d.reshape(-1, d_shape[-1])
+        if not new_d.dtype.isnative:
+            new_d = new_d.astype(new_d.dtype.newbyteorder('='))
+        n_fields = new_d.shape[1]
         # Generate the dtype string
-        if isinstance(d.dtype, str):
-            dtype = ','.join([d.dtype]*len(d[0]))
+        dtype_char = new_d.dtype.char
+        if isinstance(new_d.dtype, str):
+            dtype = ','.join([new_d.dtype]*n_fields)
         else:
-            dtype_char = d.dtype.char
             if dtype_char == 'S' or dtype_char == 'O' or dtype_char == 'V' or dtype_char == 'U':
-                dtype = ','.join([d.dtype.str]*len(new_d[0]))  # need the width as well as the char
+                dtype = ','.join([new_d.dtype.str]*n_fields)  # need the width as well as the char
             else:
-                dtype = ','.join([dtype_char]*len(new_d[0]))
-        # Make a new array with each row turned into a tuple and the correct dtype
-        d = numpy.array([tuple(nd) for nd in new_d], dtype=dtype)
+                dtype = ','.join([dtype_char]*n_fields)
+        if dtype_char == 'O':
+            # Object arrays can't be reinterpreted as records, so copy them in column by column.
+            d = numpy.empty(len(new_d), dtype=dtype)
+            for i, name in enumerate(d.dtype.names):
+                d[name] = new_d[:, i]
+        else:
+            # Every field has the same type as the original array, so each row of a C-contiguous
+            # 2-d block is already laid out exactly like a record: we can just reinterpret the
+            # memory as records instead of building a tuple for every row.  The data is copied
+            # only if it wasn't contiguous to begin with, or if the caller asked for a copy and it
+            # hasn't been copied already.
+            if copy and numpy.may_share_memory(new_d, original_d):
+                new_d = new_d.copy()
+            d = numpy.ascontiguousarray(new_d).view(dtype).reshape(-1)
         if len(d_shape) > 1:
             # If this was a more-than-2d array, reshape it back to that original form, minus the
             # dimension we turned into a record (which will no longer appear in the shape).
@@ -91,6 +113,464 @@ def FormatArray(d, fields=None):
     return d
 
 
+def InterpolateJacobians(jacobian_func, x, y, tolerance=1.E-6, grid_spacing=512.,
+                         min_grid_spacing=8.):
+    """
+    Evaluate a smoothly-varying 2x2 Jacobian, such as the local linear approximation to a WCS, at
+    many positions at once.
+
+    Rather than calling ``jacobian_func`` once per position, this evaluates it on a coarse grid
+    covering the positions and bilinearly interpolates the grid to every position.  To check the
+    interpolation, the Jacobian is also evaluated at the center of every grid cell (the worst
+    place for bilinear interpolation) and compared to the interpolated value there; if any element
+    differs by more than ``tolerance`` times the largest element of the Jacobian, the grid spacing
+    is reduced (by at least a factor of 2) and the process repeated.  If the grid would need at
+    least as many evaluations as there are positions, or would be finer than ``min_grid_spacing``,
+    the Jacobian is evaluated at every position instead.
+
+    :param jacobian_func:    A function taking scalar ``x`` and ``y`` and returning the Jacobian
+                             at that position as a 2x2 array-like object.
+    :param x:                A NumPy array of x positions.
+    :param y:                A NumPy array of y positions.
+    :param tolerance:        The relative accuracy required of the interpolated Jacobians, or 0 to
+                             evaluate the Jacobian at every position. [default: 1.E-6]
+    :param grid_spacing:     The initial spacing of the grid, in the units of ``x`` and ``y``.
+                             [default: 512.]
+    :param min_grid_spacing: The finest grid spacing to try before evaluating the Jacobian at every
+                             position. [default: 8.]
+    :returns:                A NumPy array with shape ``(len(x), 2, 2)`` containing the Jacobian
+                             at every position.
+    """
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    n_points = len(x)
+
+    def evaluate(xs, ys):
+        jacobians = numpy.empty((len(xs), 2, 2))
+        for i, (xi, yi) in enumerate(zip(xs, ys)):
+            jacobians[i] = jacobian_func(xi, yi)
+        return jacobians
+
+    if n_points == 0 or tolerance <= 0:
+        return evaluate(x, y)
+    x_min, x_max = x.min(), x.max()
+    y_min, y_max = y.min(), y.max()
+    # Give the grid a nonzero size even if all the points are in a line
+    x_span = max(x_max-x_min, min_grid_spacing)
+    y_span = max(y_max-y_min, min_grid_spacing)
+    while grid_spacing >= min_grid_spacing:
+        nx = int(numpy.ceil(x_span/grid_spacing))
+        ny = int(numpy.ceil(y_span/grid_spacing))
+        if (nx+1)*(ny+1) + nx*ny >= n_points:
+            break
+        dx = x_span/nx
+        dy = y_span/ny
+        grid_x, grid_y = numpy.meshgrid(x_min+dx*numpy.arange(nx+1), y_min+dy*numpy.arange(ny+1),
+                                        indexing='ij')
+        grid = evaluate(grid_x.ravel(), grid_y.ravel()).reshape(nx+1, ny+1, 2, 2)
+        center_x, center_y = numpy.meshgrid(x_min+dx*(numpy.arange(nx)+0.5),
+                                            y_min+dy*(numpy.arange(ny)+0.5), indexing='ij')
+        centers = evaluate(center_x.ravel(), center_y.ravel()).reshape(nx, ny, 2, 2)
+        # Bilinear interpolation at a cell center is just the mean of the four corners
+        interpolated_centers = 0.25*(grid[:-1, :-1]+grid[1:, :-1]+grid[:-1, 1:]+grid[1:, 1:])
+        scale = max(numpy.abs(grid).max(), numpy.abs(centers).max())
+        error = numpy.abs(interpolated_centers-centers).max()
+        if error <= tolerance*scale:
+            ix = numpy.clip(((x-x_min)/dx).astype(int), 0, nx-1)
+            iy = numpy.clip(((y-y_min)/dy).astype(int), 0, ny-1)
+            fx = ((x-x_min)/dx - ix)[:, numpy.newaxis, numpy.newaxis]
+            fy = ((y-y_min)/dy - iy)[:, numpy.newaxis, numpy.newaxis]
+            return ((1.-fx)*(1.-fy)*grid[ix, iy] + fx*(1.-fy)*grid[ix+1, iy] +
+                    (1.-fx)*fy*grid[ix, iy+1] + fx*fy*grid[ix+1, iy+1])
+        # The interpolation error goes as the square of the grid spacing, so we can estimate the
+        # spacing we need rather than trying every factor of 2 on the way there.
+        grid_spacing *= min(0.5, 0.9*numpy.sqrt(tolerance*scale/error))
+    return evaluate(x, y)
+
+
+def MomentTransformMatrices(jacobians):
+    """
+    Make the matrices that transform second moments ``(ixx, iyy, ixy)`` under local linear
+    transformations.  A moment matrix :math:`I` transforms as :math:`J I J^T` for a Jacobian
+    :math:`J`, which is linear in the three independent moments.
+
+    :param jacobians: A NumPy array of shape ``(N, 2, 2)`` containing the Jacobian for each
+                      object, such as the output of :func:`InterpolateJacobians`.
+    :returns:         A NumPy array of shape ``(N, 3, 3)``.
+    """
+    jacobians = numpy.asarray(jacobians, dtype=float)
+    j00, j01 = jacobians[:, 0, 0], jacobians[:, 0, 1]
+    j10, j11 = jacobians[:, 1, 0], jacobians[:, 1, 1]
+    matrices = numpy.empty((len(jacobians), 3, 3))
+    matrices[:, 0] = numpy.array([j00**2, j01**2, 2.*j00*j01]).T
+    matrices[:, 1] = numpy.array([j10**2, j11**2, 2.*j10*j11]).T
+    matrices[:, 2] = numpy.array([j00*j10, j01*j11, j00*j11+j01*j10]).T
+    return matrices
+
+
+def TransformMoments(moments, jacobians, covariances=None):
+    """
+    Transform second moments, and optionally their covariance matrices, by local linear
+    transformations.
+
+    The moments are ordered ``(ixx, iyy, ixy)``, as in the covariance matrices of LSST shape
+    measurements.  ``moments`` may hold several sets of moments for each object (eg the object
+    and its PSF), in which case they are all transformed by that object's Jacobian at once.
+
+    :param moments:     A NumPy array of shape ``(N, 3)`` or ``(N, K, 3)``.
+    :param jacobians:   A NumPy array of shape ``(N, 2, 2)`` containing the Jacobian for each
+                        object, such as the output of :func:`InterpolateJacobians`.
+    :param covariances: A NumPy array of shape ``(N, 3, 3)`` containing a covariance matrix of
+                        moments for each object, or None. [default: None]
+    :returns:           A tuple of the transformed moments, with the same shape as ``moments``,
+                        and the transformed covariance matrices (or None if ``covariances`` was
+                        None).
+    """
+    matrices = MomentTransformMatrices(jacobians)
+    moments = numpy.einsum('nij,n...j->n...i', matrices, moments)
+    if covariances is not None:
+        covariances = numpy.einsum('nij,njk->nik', matrices, covariances)
+        covariances = numpy.einsum('nik,nlk->nil', covariances, matrices)
+    return moments, covariances
+
+
+def EvaluatePolynomial2D(x, y, coefficients, x_orders, y_orders, chebyshev=False):
+    """
+    Evaluate a 2D polynomial given as a list of terms ``coefficients[i] * P_{x_orders[i]}(x) *
+    P_{y_orders[i]}(y)`` over whole arrays of positions.  ``P_n`` is either the monomial ``x**n``
+    or, if ``chebyshev`` is True, the Chebyshev polynomial of the first kind ``T_n``.
+
+    The terms are gathered into a coefficient matrix and evaluated with the nested Horner (or
+    Clenshaw, for Chebyshev polynomials) schemes in :mod:`numpy.polynomial`, so the cost is a few
+    array operations per order rather than a Python call per position.
+
+    :param x:            A NumPy array of x positions (already scaled to the polynomial's domain).
+    :param y:            A NumPy array of y positions, the same shape as ``x``.
+    :param coefficients: An iterable of coefficients, one per term.
+    :param x_orders:     An iterable of the order in x of each term.
+    :param y_orders:     An iterable of the order in y of each term.
+    :param chebyshev:    Whether the terms are Chebyshev polynomials rather than monomials.
+                         [default: False]
+    :returns:            A NumPy array, the same shape as ``x``, of the polynomial's values.
+    """
+    x_orders = numpy.asarray(x_orders, dtype=int)
+    y_orders = numpy.asarray(y_orders, dtype=int)
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    if len(x_orders) == 0:
+        return numpy.zeros(numpy.broadcast(x, y).shape)
+    coefficient_matrix = numpy.zeros((x_orders.max()+1, y_orders.max()+1))
+    # add.at, not assignment, so repeated (x_order, y_order) pairs are summed like separate terms
+    numpy.add.at(coefficient_matrix, (x_orders, y_orders), coefficients)
+    if chebyshev:
+        return numpy.polynomial.chebyshev.chebval2d(x, y, coefficient_matrix)
+    else:
+        return numpy.polynomial.polynomial.polyval2d(x, y, coefficient_matrix)
+
+
+class PackedFlags(object):
+    """
+    A set of boolean flag columns for a catalog, packed into the bits of ``uint64`` words so that
+    any combination of flags can be checked with a single vectorized AND and comparison per 64
+    flags, instead of one array operation per flag.
+
+    Masks are cached, so asking for the same combination of flags again (eg once per systematics
+    test) costs only a copy.  A subset of the rows can be selected with :func:`select` without
+    repacking the flags; masks for the subset are taken from the cached masks of the full set.
+
+    :param flags: A list of ``(name, column)`` pairs, where each ``column`` is an array-like object
+                  whose nonzero entries mean the flag is set.  All columns must have the same
+                  length.
+    """
+    def __init__(self, flags):
+        self.names = []
+        self._bits = {}
+        columns = []
+        for name, column in flags:
+            if name not in self._bits:
+                self._bits[name] = len(self.names)
+                self.names.append(name)
+                columns.append(numpy.asarray(column) != 0)
+        lengths = set([len(column) for column in columns])
+        if len(lengths) > 1:
+            raise ValueError('Flag columns have different lengths: %s'%sorted(lengths))
+        self._n_rows = lengths.pop() if lengths else 0
+        self._words = numpy.zeros(((len(self.names)+63)//64, self._n_rows), dtype=numpy.uint64)
+        for i, column in enumerate(columns):
+            self._words[i//64] |= column.astype(numpy.uint64) << numpy.uint64(i%64)
+        self._masks = {}
+        self._source = None
+        self._rows = None
+
+    def __len__(self):
+        return self._n_rows
+
+    def __contains__(self, name):
+        return name in self._bits
+
+    def getMask(self, keep_false=(), keep_true=()):
+        """
+        Return a boolean mask which is True for the rows where none of the flags in ``keep_false``
+        and all of the flags in ``keep_true`` are set.
+
+        :param keep_false: An iterable of the names of flags which must not be set.
+        :param keep_true:  An iterable of the names of flags which must be set.
+        :returns:          A NumPy array of bools.
+        :raises KeyError:  If any of the flags weren't packed (eg because they aren't in the
+                           catalog's schema).
+        """
+        keep_false = tuple(sorted(set(keep_false)))
+        keep_true = tuple(sorted(set(keep_true)))
+        missing = [name for name in keep_false+keep_true if name not in self._bits]
+        if missing:
+            raise KeyError('Flags %s were not read; are they in the catalog schema?'%missing)
+        if set(keep_false) & set(keep_true):
+            raise ValueError('Flags %s must be both set and unset'%
+                             sorted(set(keep_false) & set(keep_true)))
+        key = (keep_false, keep_true)
+        if key not in self._masks:
+            if self._source is not None:
+                mask = self._source.getMask(keep_false, keep_true)[self._rows]
+            else:
+                mask = numpy.ones(self._n_rows, dtype=bool)
+                for i, word in enumerate(self._words):
+                    # The bits we check in this word, and the values we want them to have
+                    check_bits = 0
+                    set_bits = 0
+                    for name in keep_false+keep_true:
+                        if self._bits[name]//64 == i:
+                            check_bits |= 1 << (self._bits[name]%64)
+                            if name in keep_true:
+                                set_bits |= 1 << (self._bits[name]%64)
+                    if check_bits:
+                        mask &= (word & numpy.uint64(check_bits)) == numpy.uint64(set_bits)
+            self._masks[key] = mask
+        return self._masks[key].copy()
+
+    def select(self, rows):
+        """
+        Return the flags for a subset of the rows.
+
+        :param rows: A boolean mask or an array of indices selecting the rows.
+        :returns:    A :class:`PackedFlags` object for those rows.
+        """
+        rows = numpy.asarray(rows)
+        subset = PackedFlags([])
+        subset.names = self.names
+        subset._bits = self._bits
+        subset._source = self
+        subset._rows = rows
+        subset._n_rows = numpy.count_nonzero(rows) if rows.dtype == bool else len(rows)
+        return subset
+
+
+class ColumnStore(object):
+    """
+    A cache of masked columns, and of the arrays made from them, shared by the systematics tests in
+    a single run.  Many tests use the same object type, and therefore the same mask, and many of
+    the same columns; with this store each masked column is only made once, and tests asking for
+    exactly the same columns with the same mask all get the same array.
+
+    Masks are identified by their contents (see :func:`maskKey`), so equal masks computed
+    separately for different tests are recognized as the same.  Everything returned by the store
+    is shared, so it is made read-only; callers that need to modify the data should copy it first.
+    """
+    def __init__(self):
+        self._columns = {}
+        self._arrays = {}
+        self.column_reuses = 0
+        self.array_reuses = 0
+
+    @staticmethod
+    def maskKey(mask):
+        """
+        Return a hashable key identifying the contents of a boolean mask.
+
+        :param mask: A NumPy array of bools, or a list of them (eg one per catalog), in which case
+                     the key is a tuple of the keys of the individual masks.
+        :returns:    A hashable object which is the same for masks with the same contents.
+        """
+        if isinstance(mask, (list, tuple)):
+            return tuple([ColumnStore.maskKey(m) for m in mask])
+        mask = numpy.asarray(mask, dtype=bool)
+        return (len(mask), hashlib.sha1(numpy.packbits(mask).tostring()).hexdigest())
+
+    @staticmethod
+    def _setReadOnly(column):
+        if isinstance(column, list):
+            for c in column:
+                c.flags.writeable = False
+        else:
+            column.flags.writeable = False
+
+    @staticmethod
+    def _nbytes(column):
+        if isinstance(column, list):
+            return sum([c.nbytes for c in column])
+        return column.nbytes
+
+    def getColumn(self, mask_key, column, make_column):
+        """
+        Return a masked column, making it with ``make_column`` if it is not already in the store.
+
+        :param mask_key:    The key of the mask, from :func:`maskKey`.
+        :param column:      The name of the column.
+        :param make_column: A function taking the column name and returning the masked column, as
+                            a NumPy array or a list of NumPy arrays, or None if the column is not
+                            available.
+        :returns:           The (read-only) masked column, or None.
+        """
+        key = (mask_key, column)
+        if key in self._columns:
+            self.column_reuses += 1
+        else:
+            value = make_column(column)
+            if value is not None:
+                self._setReadOnly(value)
+            self._columns[key] = value
+        return self._columns[key]
+
+    def getArray(self, mask_key, columns, make_column, make_array):
+        """
+        Return an array containing the given masked columns, making it if no array with this mask
+        and set of columns is already in the store.
+
+        :param mask_key:    The key of the mask, from :func:`maskKey`.
+        :param columns:     An iterable of column names.  Repeats and order don't matter.
+        :param make_column: A function taking a column name and returning the masked column, as
+                            for :func:`getColumn`.  Columns for which it returns None are left out.
+        :param make_array:  A function taking a dict of ``(column name, masked column)`` pairs and
+                            returning an array.
+        :returns:           The (read-only) array returned by ``make_array``.
+        """
+        key = (mask_key, frozenset(columns))
+        if key in self._arrays:
+            self.array_reuses += 1
+        else:
+            column_dict = {}
+            for column in key[1]:
+                value = self.getColumn(mask_key, column, make_column)
+                if value is not None:
+                    column_dict[column] = value
+            array = make_array(column_dict)
+            array.flags.writeable = False
+            self._arrays[key] = array
+        return self._arrays[key]
+
+    def summary(self):
+        """
+        Return a dict describing the contents of the store: the number of masked columns and arrays
+        (``n_columns``, ``n_arrays``), the memory they use in bytes (``column_bytes``,
+        ``array_bytes``), and how many times a stored column or array was reused instead of being
+        made again (``column_reuses``, ``array_reuses``).
+        """
+        return {'n_columns': len(self._columns),
+                'n_arrays': len(self._arrays),
+                'column_bytes': sum([self._nbytes(c) for c in self._columns.values()
+                                     if c is not None]),
+                'array_bytes': sum([a.nbytes for a in self._arrays.values()]),
+                'column_reuses': self.column_reuses,
+                'array_reuses': self.array_reuses}
+
+    def clear(self):
+        """Remove everything from the store and reset the reuse counts."""
+        self.__init__()
+
+
+def _loadOrFail(args):
+    load_func, item, skip_exceptions = args
+    try:
+        return True, load_func(item)
+    except skip_exceptions as e:
+        return False, e
+
+
+class PendingLoad(object):
+    """
+    The result of a :func:`LoadConcurrently` call that is still running in the background.  Call
+    :func:`get` to wait for it and retrieve the results, or :func:`terminate` to abandon it.
+    """
+    def __init__(self, items, async_result, pool):
+        self.items = items
+        self._async_result = async_result
+        self._pool = pool
+
+    def ready(self):
+        """Return True if all the items have been loaded (or failed to load)."""
+        return self._async_result.ready()
+
+    def get(self):
+        """
+        Wait for all the items to load, then return the results as described in
+        :func:`LoadConcurrently`.  Any exception not in ``skip_exceptions`` is raised here, and
+        the items not yet loaded are abandoned.
+        """
+        try:
+            results = self._async_result.get()
+        finally:
+            # get() has returned (or raised), so there's nothing left for the workers to do
+            self.terminate()
+        loaded = []
+        failed = []
+        for item, (ok, value) in zip(self.items, results):
+            if ok:
+                loaded.append((item, value))
+            else:
+                failed.append((item, value))
+        return loaded, failed
+
+    def terminate(self):
+        """
+        Abandon any items not yet loaded, and wait for those already being loaded to finish, so
+        that nothing is left running in the background.
+        """
+        self._pool.terminate()
+        self._pool.join()
+
+
+def LoadConcurrently(load_func, items, n_workers=4, skip_exceptions=(RuntimeError,), wait=True):
+    """
+    Call ``load_func`` on each of ``items`` using a bounded pool of threads.  This is meant for
+    I/O-bound work such as reading many catalogs, where the threads spend most of their time
+    waiting on the file system rather than holding the GIL.
+
+    Items whose load raises one of ``skip_exceptions`` are left out of the results (and reported
+    separately) rather than stopping the whole load; any other exception is raised.  The results
+    are in the same order as ``items``.
+
+    :param load_func:       A function taking one item and returning the loaded object.
+    :param items:           An iterable of items to load.
+    :param n_workers:       The largest number of items to load at once; if 1 (and ``wait`` is
+                            True), the items are loaded one at a time in this thread. [default: 4]
+    :param skip_exceptions: An exception class, or tuple of them, meaning an item could not be
+                            loaded and should be skipped. [default: ``(RuntimeError,)``]
+    :param wait:            If True, wait for all the items to be loaded; if False, start loading
+                            them in the background and return at once. [default: True]
+    :returns:               If ``wait`` is True, a tuple of two lists: ``(item, loaded object)``
+                            pairs for the items that were loaded, and ``(item, exception)`` pairs
+                            for those that were skipped.  If ``wait`` is False, a
+                            :class:`PendingLoad` whose :func:`get <PendingLoad.get>` method returns
+                            the same tuple.
+    """
+    items = list(items)
+    args = [(load_func, item, skip_exceptions) for item in items]
+    if wait and (n_workers <= 1 or len(items) < 2):
+        results = [_loadOrFail(arg) for arg in args]
+        return ([(item, value) for item, (ok, value) in zip(items, results) if ok],
+                [(item, value) for item, (ok, value) in zip(items, results) if not ok])
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(n_workers, len(items))))
+    # One item per task, so that abandoning the load leaves as few items running as possible
+    try:
+        pending = PendingLoad(items, pool.map_async(_loadOrFail, args, chunksize=1), pool)
+    finally:
+        # The workers finish the items already submitted, then exit
+        pool.close()
+    if wait:
+        return pending.get()
+    return pending
+
+
 class Stats:
     """A Stats object can carry around and output the statistics of some array.
 
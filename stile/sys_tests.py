@@ -29,15 +29,23 @@ THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 
+import atexit
 import numpy
 import stile
 import stile_utils
 try:
     import treecorr
     from treecorr.corr2 import corr2_valid_params
+    from distutils.version import LooseVersion
     has_treecorr = True
+    # The parameters that affect a Catalog, for the CatalogCache keys.  Not every version of
+    # TreeCorr makes these public; without them, all the TreeCorr parameters are used.
+    catalog_valid_params = getattr(treecorr.catalog, 'Catalog_valid_params', corr2_valid_params)
+    # Versions are compared as numbers, not strings, so that eg 3.10 comes after 3.1.
+    old_treecorr = LooseVersion(treecorr.version) < LooseVersion('3.1')
 except ImportError:
     has_treecorr = False
+    old_treecorr = False
     import warnings
     warnings.warn("treecorr package cannot be imported. You may "+
                   "wish to install it if you would like to use the correlation functions within "+
@@ -143,7 +151,7 @@ class PlotDetails(object):
         self.sigma_field = sigma_field  # 1-sigma error bar field
         self.y_title = y_title  # y-axis label
 
-if has_treecorr and treecorr.version < '3.1':
+if old_treecorr:
     treecorr_func_dict = {'gg': treecorr.G2Correlation,
                           'm2': treecorr.G2Correlation,
                           'ng': treecorr.NGCorrelation,
@@ -186,6 +194,7 @@ def CorrelationFunctionSysTest(type=None):
         - **Rho3**: rho3 statistics (autocorrelation of star shapes weighted by the residual size)
         - **Rho4**: rho4 statistics (correlation of residual star shapes weighted by residual size)
         - **Rho5**: rho5 statistics (correlation of star and PSF shapes weighted by the residual size)
+        - **RhoStatistics**: all five rho statistics at once
         - **None**: an empty BaseCorrelationFunctionSysTest class instance, which can be used for
           multiple types of correlation functions.  See the documentation for
           BaseCorrelationFunctionSysTest for more details.  Note that this type has a
@@ -226,10 +235,125 @@ def CorrelationFunctionSysTest(type=None):
         return Rho4SysTest()
     elif type=='Rho5':
         return Rho5SysTest()
+    elif type=='RhoStatistics':
+        return RhoStatisticsSysTest()
     else:
         raise ValueError('Unknown correlation function type %s given to type kwarg'%type)
 
 
+class CatalogCache(object):
+    """
+    A bounded least-recently-used cache of ``treecorr.Catalog`` objects, so that systematics tests
+    run on the same objects (for example, the PSF stars used by several of the star-star
+    correlation functions) reuse the same Catalog--and therefore the trees TreeCorr has already
+    built for it--rather than making a new one each time.
+
+    Catalogs are keyed by the content of the columns that go into them (along with which quantity
+    each column was used as) and the parts of the TreeCorr config that affect the Catalog itself.
+    Parameters that only affect the trees (such as the separation range) don't need to be part of
+    the key, since each Catalog keeps its own trees for each set of tree parameters; they are
+    left out when TreeCorr makes the list of Catalog parameters public
+    (``treecorr.catalog.Catalog_valid_params``), and are otherwise part of the key as well.
+
+    The numbers of cache ``hits`` and ``misses`` are kept as attributes.
+
+    :param max_size: The maximum number of Catalogs to keep. [default: 16]
+    """
+    def __init__(self, max_size=16):
+        import collections
+        self.max_size = max_size
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def makeKey(self, catalog_kwargs, config):
+        """
+        Make the cache key for a Catalog created with the given column and config kwargs.
+
+        :param catalog_kwargs: A dict of the column arrays (``ra``, ``g1``, etc) for the Catalog.
+        :param config:         The TreeCorr config dict for the Catalog, or None.
+        :returns:              A hashable key.
+        """
+        import hashlib
+        key = []
+        for name in sorted(catalog_kwargs):
+            column = numpy.ascontiguousarray(catalog_kwargs[name])
+            key.append((name, column.dtype.str, column.shape,
+                        hashlib.sha1(column.view(numpy.uint8)).hexdigest()))
+        if config:
+            # TreeCorr fills in defaults and standardizes values (such as units) in the config
+            # dicts it's given, so do the same to make sure equivalent configs match.
+            config = treecorr.config.merge_config(config, {}, catalog_valid_params)
+            key.append(tuple(sorted((k, repr(v)) for k, v in config.items())))
+        return tuple(key)
+
+    def get(self, key):
+        """
+        Return the Catalog for ``key`` (marking it as recently used), or None if there isn't one.
+        """
+        if key in self._cache:
+            self.hits += 1
+            catalog = self._cache.pop(key)
+            self._cache[key] = catalog
+            return catalog
+        self.misses += 1
+        return None
+
+    def add(self, key, catalog):
+        """
+        Add a Catalog to the cache, discarding the least recently used ones if the cache is full.
+        """
+        self._cache[key] = catalog
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        """
+        Empty the cache and reset the hit and miss counters.
+        """
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+# The cache used by all correlation function systematics tests.  TreeCorr's trees can't be deleted
+# safely once the interpreter has started tearing down modules, so empty the cache before that.
+catalog_cache = CatalogCache()
+atexit.register(catalog_cache.clear)
+
+# The jobs being run by BaseCorrelationFunctionSysTest.processCFs() in a process pool.  Worker
+# processes inherit this list when they are forked, so the catalogs don't need to be pickled.
+_parallel_cf_jobs = []
+
+# The quantities TreeCorr accumulates in a correlation function object when it is processed.  Only
+# these are sent back from worker processes, since not every version of TreeCorr can pickle the
+# correlation function objects themselves.
+_processed_cf_attributes = ['npairs', 'weight', 'xi', 'xi_im', 'xip', 'xim', 'xip_im', 'xim_im',
+                            'varxi', 'meanr', 'meanlogr', 'tot', '_coords', '_metric']
+
+
+def _processCF(args):
+    """
+    Process one correlation function for :func:`BaseCorrelationFunctionSysTest.processCFs`.
+
+    :param args: A tuple of a job (a ``(correlation_function, catalog1, catalog2)`` tuple, or an
+                 index into ``_parallel_cf_jobs``) and the number of OpenMP threads to use.
+    :returns:    The processed correlation function, or, for a job given by index (that is, in a
+                 worker process), a dict of its ``_processed_cf_attributes``.
+    """
+    job, num_threads = args
+    if not isinstance(job, tuple):
+        func, cat1, cat2 = _parallel_cf_jobs[job]
+        func.process(cat1, cat2, num_threads=num_threads)
+        return dict([(name, getattr(func, name)) for name in _processed_cf_attributes
+                     if hasattr(func, name)])
+    func, cat1, cat2 = job
+    func.process(cat1, cat2, num_threads=num_threads)
+    return func
+
+
 class BaseCorrelationFunctionSysTest(SysTest):
     """
     A base class for the Stile systematics tests that use correlation functions. This implements the
@@ -298,6 +422,19 @@ class BaseCorrelationFunctionSysTest(SysTest):
         ]
 
     def makeCatalog(self, data, config=None, use_as_k=None, use_chip_coords=False):
+        """
+        Make a ``treecorr.Catalog`` from a formatted data array, reusing an existing Catalog from
+        :data:`catalog_cache` if one was made from identical columns and Catalog config.
+
+        :param data:            A formatted data array (or a ``treecorr.Catalog``, or None, which
+                                are returned as-is).
+        :param config:          A TreeCorr config dict. [default: None]
+        :param use_as_k:        The field to use as the scalar ``k`` column. [default: None, meaning
+                                the field ``k`` if it exists]
+        :param use_chip_coords: Whether to use the chip coordinates ``x`` and ``y`` even if the
+                                sky coordinates ``ra`` and ``dec`` exist. [default: False]
+        :returns:               A ``treecorr.Catalog``.
+        """
         if data is None or isinstance(data, treecorr.Catalog):
             return data
         catalog_kwargs = {}
@@ -334,12 +471,17 @@ class BaseCorrelationFunctionSysTest(SysTest):
             if not hasattr(data, 'len') and isinstance(data, numpy.ndarray):
                 for key in catalog_kwargs:
                     catalog_kwargs[key] = numpy.array([catalog_kwargs[key]])
-        catalog_kwargs['config'] = config
-        return treecorr.Catalog(**catalog_kwargs)
+        key = catalog_cache.makeKey(catalog_kwargs, config)
+        catalog = catalog_cache.get(key)
+        if catalog is None:
+            catalog_kwargs['config'] = config
+            catalog = treecorr.Catalog(**catalog_kwargs)
+            catalog_cache.add(key, catalog)
+        return catalog
 
     def getCF(self, correlation_function_type, data, data2=None,
                     random=None, random2=None, use_as_k=None, use_chip_coords=False,
-                    config=None, **kwargs):
+                    config=None, parallel=None, n_workers=None, **kwargs):
         """
         Sets up and calls TreeCorr on the given set of data and possibly randoms.
 
@@ -373,6 +515,11 @@ class BaseCorrelationFunctionSysTest(SysTest):
         type.  The default is to use ``'compensated'`` if randoms are present and ``'simple'``
         otherwise.
 
+        When randoms are used, up to four TreeCorr correlation functions (data-data, data-random,
+        random-data and random-random) are computed.  These are independent, so they can be
+        computed concurrently by passing ``parallel='thread'`` or ``parallel='process'``; see
+        :func:`processCFs`.
+
         This function accepts all (self-consistent) sets of data, data2, random, and random2.
         Including ``data2`` and possibly ``random2`` will return a cross-correlation; otherwise
         the program returns an autocorrelation.  ``Random`` datasets are necessary for the **nn**
@@ -388,26 +535,28 @@ class BaseCorrelationFunctionSysTest(SysTest):
         :param data2:         Optional cross-correlation data set
         :param random:        Optional random dataset corresponding to `data`
         :param random2:       Optional random dataset corresponding to `data2`
+        :param parallel:      Whether to compute the separate TreeCorr correlation functions
+                              sequentially (None), in threads (``'thread'``), or in worker
+                              processes (``'process'``). [default: None]
+        :param n_workers:     The number of correlation functions to compute at once, if
+                              ``parallel`` is set. [default: None, meaning as many as possible]
         :param kwargs:        Any other TreeCorr parameters (will silently supercede anything in
-                              ``stile_args``).
+                              ``stile_args``).  If the TreeCorr output file name for this
+                              correlation function type (eg ``ng_file_name``) is given here or in
+                              ``config``, the TreeCorr output is also written to that file.
         :returns:             a numpy array of the TreeCorr outputs.
         """
-        import tempfile
-        import os
-
         if not correlation_function_type in treecorr_func_dict:
             raise ValueError('Unknown correlation function type: %s'%correlation_function_type)
 
-        handle, output_file = tempfile.mkstemp()
-
         # First, pull out the TreeCorr-relevant parameters from the stile_args dict, and add
         # anything passed as a kwarg to that dict.
-        if (random and len(random)) or (random2 and len(random2)):
-            treecorr_kwargs[correlation_function_type+'_statistic'] = \
-                treecorr_kwargs.get(correlation_function_type+'_statistic', 'compensated')
         treecorr_kwargs = stile.treecorr_utils.PickTreeCorrKeys(config)
         treecorr_kwargs.update(stile.treecorr_utils.PickTreeCorrKeys(kwargs))
         treecorr.config.check_config(treecorr_kwargs, corr2_valid_params)
+        # We only write the results to disk if the user asked for it; TreeCorr itself never sees
+        # the file name.
+        output_file = treecorr_kwargs.pop(correlation_function_type+'_file_name', None)
 
         if data is None:
             raise ValueError('Must include a data array!')
@@ -417,7 +566,7 @@ class BaseCorrelationFunctionSysTest(SysTest):
                 raise ValueError('Incorrect data types for correlation function: must have '
                                    'data and random, and random2 if data2.')
         elif correlation_function_type in ['gg', 'm2', 'kk']:
-            if random or random2:
+            if random is not None or random2 is not None:
                 print "Warning: randoms ignored for this correlation function type"
         elif correlation_function_type in ['ng', 'nm', 'nk']:
             if data2 is None:
@@ -446,73 +595,229 @@ class BaseCorrelationFunctionSysTest(SysTest):
         random2 = self.makeCatalog(random2, config=treecorr_kwargs, use_as_k=use_as_k,
                                             use_chip_coords=use_chip_coords)
 
-        treecorr_kwargs[correlation_function_type+'_file_name'] = output_file
-
-        func = treecorr_func_dict[correlation_function_type](treecorr_kwargs)
-        func.process(data, data2)
+        # The TreeCorr objects for the data correlation function, plus any random or auxiliary
+        # correlation functions needed to compute the final result, and the catalogs each of them
+        # processes.  They are independent of each other, so they can be processed in parallel.
+        funcs = {'func': None, 'func_random': None, 'func_gg': None, 'func_dd': None,
+                 'func_rr': None, 'func_dr': None, 'func_rd': None}
+        jobs = [('func', correlation_function_type, data, data2)]
         if correlation_function_type in ['ng', 'nm', 'nk']:
             comp_stat = {'ng': 'ng', 'nm': 'ng', 'nk': 'nk'}  # which _statistic kwarg to check
             if treecorr_kwargs.get(comp_stat[correlation_function_type]+'_statistic',
                self.compensateDefault(data, data2, random, random2)) == 'compensated':
-                func_random = treecorr_func_dict[correlation_function_type](treecorr_kwargs)
-                func_random.process(random, data2)
-            else:
-                func_random = None
+                jobs.append(('func_random', correlation_function_type, random, data2))
         elif correlation_function_type == 'norm':
-            func_gg = treecorr_func_dict['gg'](treecorr_kwargs)
-            func_gg.process(data2)
-            func_dd = treecorr_func_dict['nn'](treecorr_kwargs)
-            func_dd.process(data)
-            func_rr = treecorr_func_dict['nn'](treecorr_kwargs)
-            func_rr.process(data)
+            jobs += [('func_gg', 'gg', data2, None), ('func_dd', 'nn', data, None),
+                     ('func_rr', 'nn', random, None)]
             if treecorr_kwargs.get('nn_statistic',
                self.compensateDefault(data, data2, random, random2, both=True)) == 'compensated':
-                func_dr = treecorr_func_dict['nn'](treecorr_kwargs)
-                func_dr.process(data, random)
-            else:
-                func_dr = None
+                jobs.append(('func_dr', 'nn', data, random))
         elif correlation_function_type == 'nn':
-            func_random = treecorr_func_dict[correlation_function_type](treecorr_kwargs)
-            if len(random2):
-                func_random.process(random, random2)
-            else:
-                func_random.process(random)
-            if not len(data2):
-                func_rr = treecorr_func_dict['nn'](treecorr_kwargs)
-                func_rr.process(data, random)
-                if treecorr_kwargs.get(['nn_statistic'],
-                   self.compensateDefault(data, data2, random, random2, both=True)
-                   ) == 'compensated':
-                    func_dr = treecorr_func_dict['nn'](treecorr_kwargs)
-                    func_dr.process(data, random)
-                    func_rd = None
+            jobs.append(('func_rr', 'nn', random, random2))
+            if treecorr_kwargs.get('nn_statistic',
+               self.compensateDefault(data, data2, random, random2, both=True)) == 'compensated':
+                if data2 is None:
+                    jobs.append(('func_dr', 'nn', data, random))
                 else:
-                    func_dr = None
-                    func_rd = None
-            else:
-                func_rr = treecorr_func_dict['nn'](treecorr_kwargs)
-                func_rr.process(random, random2)
-                if treecorr_kwargs.get(['nn_statistic'],
-                   self.compensateDefault(data, data2, random, random2, both=True)
-                   ) == 'compensated':
-                    func_dr = treecorr_func_dict['nn'](treecorr_kwargs)
-                    func_dr.process(data, random2)
-                    func_rd = treecorr_func_dict['nn'](treecorr_kwargs)
-                    func_rd.process(random, data2)
+                    jobs += [('func_dr', 'nn', data, random2), ('func_rd', 'nn', random, data2)]
+        processed_funcs = self.processCFs(
+            [(treecorr_func_dict[func_type](treecorr_kwargs), cat1, cat2)
+             for key, func_type, cat1, cat2 in jobs],
+            parallel=parallel, n_workers=n_workers,
+            num_threads=treecorr_kwargs.get('num_threads'))
+        for (key, func_type, cat1, cat2), func in zip(jobs, processed_funcs):
+            funcs[key] = func
+
+        if output_file:
+            self.writeCF(output_file, correlation_function_type, **funcs)
+        if old_treecorr:
+            # Older versions of TreeCorr don't keep the same in-memory quantities, so we go through
+            # their output files instead.
+            return self.readCF(correlation_function_type, **funcs)
+        return self.makeCFArray(correlation_function_type, **funcs)
+
+    def processCFs(self, jobs, parallel=None, n_workers=None, num_threads=None):
+        """
+        Call ``process()`` on a list of TreeCorr correlation function objects, either one after
+        another or concurrently.
+
+        With ``parallel='thread'``, the correlation functions are processed in a thread pool;
+        TreeCorr releases the GIL while it computes, so the threads run at the same time.  With
+        ``parallel='process'``, they are processed in a forked pool of worker processes, which
+        inherit the catalogs rather than having them pickled, and only the accumulated pair counts,
+        weights and correlation functions are sent back and copied into the correlation function
+        objects in ``jobs``.
+
+        TreeCorr also uses OpenMP threads within each correlation function.  The thread budget
+        ``num_threads`` is shared between the workers so that running several correlation
+        functions at once doesn't oversubscribe the machine: with threads, each worker gets an
+        equal share of it, and with processes, there are (by default) ``num_threads`` workers
+        using one OpenMP thread each.  (OpenMP can't start new threads in a forked process once the
+        parent process has used it, so worker processes always use a single OpenMP thread.)
+
+        :param jobs:        A list of ``(correlation_function, catalog1, catalog2)`` tuples, where
+                            ``catalog2`` is None for an autocorrelation.
+        :param parallel:    None, ``'thread'`` or ``'process'`` (see above). [default: None]
+        :param n_workers:   The number of correlation functions to process at once. [default:
+                            None, meaning the smaller of the number of jobs and ``num_threads``]
+        :param num_threads: The total number of OpenMP threads TreeCorr may use. [default: None,
+                            meaning the number of cores]
+        :returns:           A list of the processed correlation function objects, in the same
+                            order as ``jobs``.
+        """
+        global _parallel_cf_jobs
+        if parallel not in [None, 'thread', 'process']:
+            raise ValueError("parallel must be None, 'thread' or 'process', not %s"%parallel)
+        if parallel is None or len(jobs) < 2:
+            return [_processCF((job, num_threads)) for job in jobs]
+        import multiprocessing
+        if num_threads is None or num_threads <= 0:
+            num_threads = multiprocessing.cpu_count()
+        if n_workers is None:
+            n_workers = num_threads
+        n_workers = max(1, min(n_workers, len(jobs)))
+        if parallel == 'thread':
+            from multiprocessing.pool import ThreadPool
+            job_threads = max(1, num_threads//n_workers)
+            pool = ThreadPool(n_workers)
+            try:
+                return pool.map(_processCF, [(job, job_threads) for job in jobs])
+            finally:
+                pool.terminate()
+                pool.join()
+        _parallel_cf_jobs = jobs
+        try:
+            pool = multiprocessing.Pool(n_workers)
+            try:
+                processed = pool.map(_processCF, [(i, 1) for i in range(len(jobs))])
+            finally:
+                # map() has returned (or raised), so there's nothing left for the workers to do
+                pool.terminate()
+                pool.join()
+        finally:
+            _parallel_cf_jobs = []
+        for (func, cat1, cat2), attributes in zip(jobs, processed):
+            for name, value in attributes.items():
+                setattr(func, name, value)
+        return [func for func, cat1, cat2 in jobs]
+
+    def makeCFArray(self, correlation_function_type, func, func_random=None, func_gg=None,
+                    func_dd=None, func_rr=None, func_dr=None, func_rd=None):
+        """
+        Build the array of results directly from the in-memory quantities of the TreeCorr
+        correlation function objects, rather than writing them to disk and reading them back in.
+        The field names are the same as the column names TreeCorr uses in its output files.
+
+        :param correlation_function_type: The type of correlation function (see :func:`getCF`).
+        :param func:          The TreeCorr correlation function object for the data.
+        :param func_random:   For **ng**, **nm** and **nk**, the correlation function using the
+                              random catalog in place of the first data set, if any.
+        :param func_gg:       For **norm**, the shear-shear correlation function.
+        :param func_dd:       For **norm**, the data-data count correlation function.
+        :param func_rr:       For **nn** and **norm**, the random-random count correlation
+                              function.
+        :param func_dr:       For **nn** and **norm**, the data-random count correlation function,
+                              if any.
+        :param func_rd:       For **nn**, the random-data count correlation function, if any.
+        :returns:             A formatted NumPy array of the results.
+        """
+        if correlation_function_type == 'm2':
+            mapsq, mapsq_im, mxsq, mxsq_im, varmapsq = func.calculateMapSq()
+            gamsq, vargamsq = func.calculateGamSq()
+            col_names = ['R', 'Mapsq', 'Mxsq', 'MMxa', 'MMxb', 'sig_map', 'Gamsq', 'sig_gam']
+            columns = [func.rnom, mapsq, mxsq, mapsq_im, -mxsq_im, numpy.sqrt(varmapsq),
+                       gamsq, numpy.sqrt(vargamsq)]
+        elif correlation_function_type == 'nm':
+            nmap, nmx, varnmap = func.calculateNMap(rg=func_random)
+            col_names = ['R', 'NMap', 'NMx', 'sig_nmap']
+            columns = [func.rnom, nmap, nmx, numpy.sqrt(varnmap)]
+        elif correlation_function_type == 'norm':
+            nmap, nmx, varnmap = func.calculateNMap(rg=func_random)
+            mapsq, mapsq_im, mxsq, mxsq_im, varmapsq = func_gg.calculateMapSq()
+            nsq, varnsq = func_dd.calculateNapSq(func_rr, dr=func_dr)
+            nmnorm = nmap**2/(nsq*mapsq)
+            varnmnorm = nmnorm**2*(4.*varnmap/nmap**2 + varnsq/nsq**2 + varmapsq/mapsq**2)
+            nnnorm = nsq/mapsq
+            varnnnorm = nnnorm**2*(varnsq/nsq**2 + varmapsq/mapsq**2)
+            col_names = ['R', 'NMap', 'NMx', 'sig_nmap', 'Napsq', 'sig_napsq', 'Mapsq',
+                         'sig_mapsq', 'NMap_norm', 'sig_norm', 'Nsq_Mapsq', 'sig_nn_mm']
+            columns = [func.rnom, nmap, nmx, numpy.sqrt(varnmap), nsq, numpy.sqrt(varnsq),
+                       mapsq, numpy.sqrt(varmapsq), nmnorm, numpy.sqrt(varnmnorm),
+                       nnnorm, numpy.sqrt(varnnnorm)]
         else:
-            func_random = None
+            col_names = ['R_nom', 'meanR', 'meanlogR']
+            columns = [func.rnom, func.meanr, func.meanlogr]
+            if correlation_function_type == 'nn':
+                xi, varxi = func.calculateXi(func_rr, func_dr, func_rd)
+                col_names += ['xi', 'sigma_xi', 'DD', 'RR']
+                columns += [xi, numpy.sqrt(varxi), func.weight,
+                            func_rr.weight*(func.tot/func_rr.tot)]
+                if func_dr is not None and func_rd is not None:
+                    col_names += ['DR', 'RD']
+                    columns += [func_dr.weight*(func.tot/func_dr.tot),
+                                func_rd.weight*(func.tot/func_rd.tot)]
+                elif func_dr is not None:
+                    col_names += ['DR']
+                    columns += [func_dr.weight*(func.tot/func_dr.tot)]
+                col_names += ['npairs']
+                columns += [func.npairs]
+            else:
+                if correlation_function_type == 'gg':
+                    col_names += ['xip', 'xim', 'xip_im', 'xim_im', 'sigma_xi']
+                    columns += [func.xip, func.xim, func.xip_im, func.xim_im,
+                                numpy.sqrt(func.varxi)]
+                elif correlation_function_type == 'ng':
+                    xi, xi_im, varxi = func.calculateXi(func_random)
+                    col_names += ['gamT', 'gamX', 'sigma']
+                    columns += [xi, xi_im, numpy.sqrt(varxi)]
+                elif correlation_function_type == 'nk':
+                    xi, varxi = func.calculateXi(func_random)
+                    col_names += ['kappa', 'sigma']
+                    columns += [xi, numpy.sqrt(varxi)]
+                elif correlation_function_type == 'kk':
+                    col_names += ['xi', 'sigma_xi']
+                    columns += [func.xi, numpy.sqrt(func.varxi)]
+                elif correlation_function_type == 'kg':
+                    col_names += ['kgamT', 'kgamX', 'sigma']
+                    columns += [func.xi, func.xi_im, numpy.sqrt(func.varxi)]
+                col_names += ['weight', 'npairs']
+                columns += [func.weight, func.npairs]
+        results = numpy.zeros(len(columns[0]), dtype=[(name, float) for name in col_names])
+        for name, column in zip(col_names, columns):
+            results[name] = column
+        return results
+
+    def writeCF(self, output_file, correlation_function_type, func, func_random=None,
+                func_gg=None, func_dd=None, func_rr=None, func_dr=None, func_rd=None):
+        """
+        Write the TreeCorr output file for the given correlation function objects to
+        ``output_file``.  The arguments are the same as for :func:`makeCFArray`.
+        """
         if correlation_function_type == 'm2':
             func.writeMapSq(output_file)
         elif correlation_function_type == 'nm':
             func.writeNMap(output_file, func_random)
         elif correlation_function_type == 'norm':
-            func.writeNorm(output_file, func_gg, func_dd, func_rr, func_dr, func_rg)
+            func.writeNorm(output_file, func_gg, func_dd, func_rr, func_dr, func_random)
         elif correlation_function_type == 'nn':
             func.write(output_file, func_rr, func_dr, func_rd)
         elif func_random:
             func.write(output_file, func_random)
         else:
             func.write(output_file)
+
+    def readCF(self, correlation_function_type, **kwargs):
+        """
+        Write the TreeCorr output for the given correlation function objects to a temporary file
+        and read it back in.  The arguments are the same as for :func:`makeCFArray`.  This is only
+        used for versions of TreeCorr which don't keep the same in-memory quantities as the
+        current version.
+        """
+        import tempfile
+        import os
+
+        handle, output_file = tempfile.mkstemp()
+        self.writeCF(output_file, correlation_function_type, **kwargs)
         results = stile.ReadTreeCorrResultsFile(output_file)
         os.close(handle)
         os.remove(output_file)
@@ -524,10 +829,10 @@ class BaseCorrelationFunctionSysTest(SysTest):
         indicates that both data sets if present must have randoms; the default, False, means only
         the first data set must have an associated random.
         """
-        if not random or (random and not len(random)):  # No random
+        if random is None or not random.nobj:  # No random
             return 'simple'
-        elif both and data2 and len(data2):  # Second data set exists and must have a random
-            if random2 and len(random2):
+        elif both and data2 is not None and data2.nobj:  # Second data set must have a random
+            if random2 is not None and random2.nobj:
                 return 'compensated'
             else:
                 return 'simple'
@@ -935,6 +1240,161 @@ class Rho5SysTest(BaseCorrelationFunctionSysTest):
                           config=config, **kwargs)
 
 
+class RhoStatisticsSysTest(BaseCorrelationFunctionSysTest):
+    """
+    Compute all five rho statistics together.  This gives the same results as running
+    :class:`Rho1SysTest` through :class:`Rho5SysTest` separately, but the three derived shear
+    fields (residual star shapes, PSF shapes, and PSF shapes weighted by the residual size) are
+    computed only once, and each of them gets a single TreeCorr catalog (and therefore a single
+    set of trees) shared by all the correlation functions that use it.
+
+    The five correlation functions are independent, so they can also be computed concurrently by
+    calling this object with ``parallel='thread'`` or ``parallel='process'``; see
+    :func:`processCFs`, which shares the TreeCorr ``num_threads`` budget between them.
+
+    The results are returned as a single array.  The ``R_nom`` column is shared by all the rho
+    statistics; every other TreeCorr output column appears once for each rho statistic, with the
+    name of the statistic appended (eg ``xip_rho1``, ``meanR_rho1``, ..., ``xip_rho5``).  Use
+    :func:`getRho` to get the results for a single rho statistic in the same format as the
+    individual Rho*SysTest classes return.
+
+    Randoms are ignored, as for any shear-shear correlation function, and writing the TreeCorr
+    output files directly (``gg_file_name``) is not supported.
+    """
+    short_name = 'rho_stats'
+    long_name = 'Rho statistics 1-5 (Correlations of PSF shapes and residuals)'
+    objects_list = ['star PSF']
+    required_quantities = [('ra', 'dec', 'g1', 'g2', 'sigma',
+                            'psf_g1', 'psf_g2', 'psf_sigma', 'w')]
+    rho_names = ['rho1', 'rho2', 'rho3', 'rho4', 'rho5']
+
+    def makeShapeData(self, data):
+        """
+        Make arrays of the three derived shear fields used by the rho statistics.
+
+        :param data: An array with the ``required_quantities`` of this test.
+        :returns:    A dict of formatted arrays with ``ra``, ``dec``, ``g1``, ``g2`` and ``w``
+                     fields, containing residual star shapes (key ``'residual'``), PSF shapes
+                     (``'psf'``), and PSF shapes weighted by the residual size (``'size'``).
+        """
+        names = ['ra', 'dec', 'g1', 'g2', 'w']
+        size_weight = (data['sigma']-data['psf_sigma'])/data['psf_sigma']
+        return {'residual': numpy.rec.fromarrays([data['ra'], data['dec'],
+                                                  data['g1']-data['psf_g1'],
+                                                  data['g2']-data['psf_g2'], data['w']],
+                                                 names=names),
+                'psf': numpy.rec.fromarrays([data['ra'], data['dec'], data['psf_g1'],
+                                             data['psf_g2'], data['w']], names=names),
+                'size': numpy.rec.fromarrays([data['ra'], data['dec'],
+                                              data['psf_g1']*size_weight,
+                                              data['psf_g2']*size_weight, data['w']],
+                                             names=names)}
+
+    def __call__(self, data, data2=None, random=None, random2=None, config=None, parallel=None,
+                 n_workers=None, **kwargs):
+        if random is not None or random2 is not None:
+            print "Warning: randoms ignored for this correlation function type"
+        treecorr_kwargs = stile.treecorr_utils.PickTreeCorrKeys(config)
+        treecorr_kwargs.update(stile.treecorr_utils.PickTreeCorrKeys(kwargs))
+        treecorr.config.check_config(treecorr_kwargs, corr2_valid_params)
+        treecorr_kwargs.pop('gg_file_name', None)
+
+        catalogs = dict([(key, self.makeCatalog(value, config=dict(treecorr_kwargs)))
+                         for key, value in self.makeShapeData(data).items()])
+        if data2 is None:
+            catalogs2 = catalogs
+        else:
+            catalogs2 = dict([(key, self.makeCatalog(value, config=dict(treecorr_kwargs)))
+                              for key, value in self.makeShapeData(data2).items()])
+        # The two catalogs for each rho statistic.  rho1 and rho3 are autocorrelations unless
+        # there is a second data set.
+        catalog_pairs = [(catalogs['residual'], None if data2 is None else catalogs2['residual']),
+                         (catalogs['psf'], catalogs2['residual']),
+                         (catalogs['size'], None if data2 is None else catalogs2['size']),
+                         (catalogs['residual'], catalogs2['size']),
+                         (catalogs['psf'], catalogs2['size'])]
+        # TreeCorr fills in defaults in the config dicts it's given, so each correlation function
+        # gets its own copy.
+        funcs = self.processCFs(
+            [(treecorr_func_dict['gg'](dict(treecorr_kwargs)), cat1, cat2)
+             for cat1, cat2 in catalog_pairs],
+            parallel=parallel, n_workers=n_workers,
+            num_threads=treecorr_kwargs.get('num_threads'))
+        if old_treecorr:
+            rho_results = [self.readCF('gg', func=func) for func in funcs]
+        else:
+            rho_results = [self.makeCFArray('gg', func) for func in funcs]
+
+        r_field = rho_results[0].dtype.names[0]
+        dtype = [(r_field, rho_results[0].dtype[r_field])]
+        for rho_name, rho_result in zip(self.rho_names, rho_results):
+            dtype += [(name+'_'+rho_name, rho_result.dtype[name])
+                      for name in rho_result.dtype.names if name != r_field]
+        results = numpy.zeros(len(rho_results[0]), dtype=dtype)
+        results[r_field] = rho_results[0][r_field]
+        for rho_name, rho_result in zip(self.rho_names, rho_results):
+            for name in rho_result.dtype.names:
+                if name != r_field:
+                    results[name+'_'+rho_name] = rho_result[name]
+        return results
+
+    def getRho(self, results, rho_name):
+        """
+        Return the results for a single rho statistic.
+
+        :param results:  The array returned by this object.
+        :param rho_name: Which rho statistic to return (``'rho1'``, ..., ``'rho5'``).
+        :returns:        An array in the same format as the output of the corresponding
+                         Rho*SysTest class.
+        """
+        if rho_name not in self.rho_names:
+            raise ValueError('Unknown rho statistic %s'%rho_name)
+        suffix = '_'+rho_name
+        r_field = results.dtype.names[0]
+        names = [r_field] + [name for name in results.dtype.names if name.endswith(suffix)]
+        rho_results = numpy.zeros(len(results), dtype=[(name[:-len(suffix)] if name != r_field
+                                                        else name, results.dtype[name])
+                                                       for name in names])
+        for name, new_name in zip(names, rho_results.dtype.names):
+            rho_results[new_name] = results[name]
+        return rho_results
+
+    def plot(self, results, log_yscale=False, plot_bmode=True):
+        """
+        Plot the rho statistics returned by this object: :math:`\\xi_+` for all five statistics on
+        one panel and, if ``plot_bmode``, :math:`\\xi_-` on a second.
+
+        :param results:    The array returned by this object.
+        :param log_yscale: Whether to use a logarithmic y-scale [default: False]
+        :param plot_bmode: Whether to plot :math:`\\xi_-` as well [default: True]
+        :returns:          A matplotlib ``Figure`` which may be written to a file with
+                           :func:`.savefig()`, if matplotlib can be imported; else None.
+        """
+        if not has_matplotlib:
+            return None
+        rho1 = self.getRho(results, 'rho1')
+        if 'xip' in rho1.dtype.names:
+            xi_fields = [('xip', r'$\xi_+$'), ('xim', r'$\xi_-$')]
+        else:
+            xi_fields = [('xi+', r'$\xi_+$'), ('xi-', r'$\xi_-$')]
+        if not plot_bmode:
+            xi_fields = xi_fields[:1]
+        fig = plt.figure()
+        fig.subplots_adjust(hspace=0)
+        for i, (xi_field, xi_title) in enumerate(xi_fields):
+            ax = fig.add_subplot(len(xi_fields), 1, i+1)
+            for rho_name in self.rho_names:
+                rho = self.getRho(results, rho_name)
+                r = 'meanR' if 'meanR' in rho.dtype.names else rho.dtype.names[0]
+                ax.errorbar(rho[r], rho[xi_field], yerr=rho['sigma_xi'], label=rho_name)
+            ax.set_xscale('log')
+            ax.set_yscale('log' if log_yscale else 'linear')
+            ax.set_ylabel(xi_title)
+            ax.legend()
+        ax.set_xlabel(r)
+        return fig
+
+
 class GalaxyDensityCorrelationSysTest(BaseCorrelationFunctionSysTest):
     """
     Compute the galaxy position autocorrelations.
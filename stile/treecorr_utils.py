@@ -102,7 +102,7 @@ def ReadTreeCorrResultsFile(file_name):
         fields = f.readline().split()
     fields = fields[1:]
     fields = [field for field in fields if field != '.']
-    return stile_utils.FormatArray(output, fields=fields)
+    return stile_utils.FormatArray(output, fields=fields, copy=False)
 
 
 def PickTreeCorrKeys(input_dict):
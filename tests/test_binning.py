@@ -382,6 +382,41 @@ class TestBinning(unittest.TestCase):
             self.assertTrue(compare_single_bin(rpair[1], epair[1]))
         self.assertRaises(TypeError, stile.ExpandBinList, bin_obj0, bin_obj1)
 
+    def test_BinAssigner(self):
+        """Test that BinAssigner picks out the same data as applying each SingleBin in turn."""
+        numpy.random.seed(42)
+        data = numpy.array([tuple(row) for row in numpy.random.uniform(-1, 7, size=(1000, 3))],
+                           dtype=[('field_0', float), ('field_1', float), ('field_2', float)])
+        data['field_0'][:5] = [0, 3, 6, numpy.nan, -0.5]  # bin edges, a NaN, and out of range
+        bool_function = lambda x, n: (x['field_2'] >= n) & (x['field_2'] < n+0.5)
+        bin_lists = [stile.BinStep('field_0', low=0, high=6, n_bins=4),
+                     [stile.BinStep('field_0', low=0, high=6, step=1.5),
+                      stile.BinList('field_1', [6, 4, 1, 0])],
+                     [stile.BinStep('field_1', low=0.1, high=6, n_bins=3, use_log=True),
+                      stile.BinFunction(lambda x: numpy.floor(x['field_0']), n_bins=4),
+                      stile.BinStep('field_2', low=6, high=0, step=-2)],
+                     [stile.BinFunction(bool_function, n_bins=5, returns_bools=True),
+                      stile.BinList('field_0', [0, 2, 3])]]
+        for bin_list in bin_lists:
+            assigner = stile.BinAssigner(bin_list, data)
+            expanded_bin_list = stile.ExpandBinList(bin_list)
+            self.assertEqual(len(assigner), len(expanded_bin_list))
+            n_in_bins = 0
+            for i, ((bins, bin_data), expected_bins) in enumerate(zip(assigner,
+                                                                      expanded_bin_list)):
+                expected_data = data
+                for bin in expected_bins:
+                    expected_data = bin(expected_data)
+                numpy.testing.assert_equal(bin_data, expected_data)
+                numpy.testing.assert_equal(data[assigner.getIndices(i)], expected_data)
+                self.assertEqual([b.short_name for b in bins],
+                                 [b.short_name for b in expected_bins])
+                n_in_bins += len(bin_data)
+            self.assertEqual(n_in_bins, numpy.sum(assigner.bin_index >= 0))
+        overlapping = stile.BinFunction(lambda x, n: x['field_0'] > n, n_bins=2,
+                                        returns_bools=True)
+        self.assertRaises(ValueError, stile.BinAssigner, overlapping, data)
+
 
 if __name__ == '__main__':
     unittest.main()
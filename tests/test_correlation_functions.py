@@ -81,10 +81,181 @@ class TestCorrelationFunctions(unittest.TestCase):
         results3 = realshear(lens_data, source_data, config=stile_args)
         numpy.testing.assert_equal(results, results3)
 
+    def test_inMemoryResults(self):
+        """Test that getCF() builds the same results in memory that TreeCorr writes to disk."""
+        import tempfile
+        numpy.random.seed(314)
+        n = 500
+        stile_args = {'min_sep': 1., 'max_sep': 20., 'nbins': 5}
+        data = numpy.rec.fromarrays([numpy.random.uniform(0, 50, size=n),
+                                     numpy.random.uniform(0, 50, size=n),
+                                     numpy.random.normal(0, 0.2, size=n),
+                                     numpy.random.normal(0, 0.2, size=n),
+                                     numpy.random.normal(0, 0.2, size=n)],
+                                    names=['x', 'y', 'g1', 'g2', 'k'])
+        data2 = numpy.rec.fromarrays([numpy.random.uniform(0, 50, size=n),
+                                      numpy.random.uniform(0, 50, size=n),
+                                      numpy.random.normal(0, 0.2, size=n),
+                                      numpy.random.normal(0, 0.2, size=n),
+                                      numpy.random.normal(0, 0.2, size=n)],
+                                     names=['x', 'y', 'g1', 'g2', 'k'])
+        random = numpy.rec.fromarrays([numpy.random.uniform(0, 50, size=2*n),
+                                       numpy.random.uniform(0, 50, size=2*n)],
+                                      names=['x', 'y'])
+        cf = stile.sys_tests.CorrelationFunctionSysTest()
+        handle, file_name = tempfile.mkstemp()
+        for cf_type, args in [('ng', (data, data2)), ('ng', (data, data2, random)),
+                              ('gg', (data,)), ('nk', (data, data2)), ('kk', (data,)),
+                              ('kg', (data, data2)), ('m2', (data,)), ('nm', (data, data2)),
+                              ('nn', (data, None, random)), ('nn', (data, data, random, random))]:
+            kwargs = {cf_type+'_file_name': file_name}
+            kwargs.update(stile_args)
+            results = cf.getCF(cf_type, *args, **kwargs)
+            file_results = stile.ReadTreeCorrResultsFile(file_name)
+            self.assertEqual(results.dtype.names, file_results.dtype.names)
+            for name in results.dtype.names:
+                numpy.testing.assert_allclose(results[name], file_results[name],
+                                              rtol=1.E-3, atol=1.E-8)
+            # And without writing anything to disk
+            numpy.testing.assert_equal(results, cf.getCF(cf_type, *args, **stile_args))
+        os.close(handle)
+        os.remove(file_name)
+
+    def test_parallelCF(self):
+        """Test that getCF() gives the same results when the pair counts are done in parallel."""
+        numpy.random.seed(1618)
+        n = 300
+        stile_args = {'min_sep': 1., 'max_sep': 20., 'nbins': 5, 'num_threads': 2}
+
+        def makeData(size):
+            return numpy.rec.fromarrays([numpy.random.uniform(0, 50, size=size),
+                                         numpy.random.uniform(0, 50, size=size),
+                                         numpy.random.normal(0, 0.2, size=size),
+                                         numpy.random.normal(0, 0.2, size=size),
+                                         numpy.random.normal(0, 0.2, size=size)],
+                                        names=['x', 'y', 'g1', 'g2', 'k'])
+        data, data2, random, random2 = makeData(n), makeData(n), makeData(2*n), makeData(2*n)
+        cf = stile.sys_tests.CorrelationFunctionSysTest()
+        for cf_type, args in [('nn', (data, None, random)), ('nn', (data, data2, random, random2)),
+                              ('ng', (data, data2, random)), ('nk', (data, data2, random)),
+                              ('norm', (data, data2, random))]:
+            results = cf.getCF(cf_type, *args, **stile_args)
+            for parallel, n_workers in [('thread', None), ('thread', 2), ('process', None),
+                                        ('process', 3)]:
+                # The sums can be done in a different order with a different number of threads
+                parallel_results = cf.getCF(cf_type, parallel=parallel, n_workers=n_workers,
+                                            *args, **stile_args)
+                self.assertEqual(results.dtype.names, parallel_results.dtype.names)
+                for name in results.dtype.names:
+                    numpy.testing.assert_allclose(results[name], parallel_results[name],
+                                                  rtol=1.E-10)
+        self.assertRaises(ValueError, cf.getCF, 'nn', data, None, random, parallel='mpi',
+                          **stile_args)
+        # Worker processes only send back the accumulated quantities, which are copied into the
+        # correlation function objects given to processCFs
+        catalog = cf.makeCatalog(data)
+        funcs = [treecorr.GGCorrelation(min_sep=1., max_sep=20., nbins=5) for i in range(2)]
+        processed = cf.processCFs([(func, catalog, None) for func in funcs], parallel='process')
+        self.assertTrue(all([p is f for p, f in zip(processed, funcs)]))
+        expected = treecorr.GGCorrelation(min_sep=1., max_sep=20., nbins=5)
+        expected.process(catalog)
+        for func in funcs:
+            numpy.testing.assert_allclose(func.xip, expected.xip, rtol=1.E-10)
+            numpy.testing.assert_equal(func.npairs, expected.npairs)
+
+    def test_catalogCache(self):
+        """Test that makeCatalog reuses Catalogs made from the same data and config."""
+        numpy.random.seed(27)
+        data = numpy.rec.fromarrays([numpy.random.uniform(0, 1, size=100),
+                                     numpy.random.uniform(0, 1, size=100),
+                                     numpy.random.normal(0, 0.2, size=100),
+                                     numpy.random.normal(0, 0.2, size=100)],
+                                    names=['ra', 'dec', 'g1', 'g2'])
+        config = {'ra_units': 'degrees', 'dec_units': 'degrees', 'min_sep': 1, 'max_sep': 10,
+                  'sep_units': 'arcmin', 'nbins': 5}
+        cache = stile.sys_tests.catalog_cache
+        cache.clear()
+        cf = stile.sys_tests.StarXStarShearSysTest()
+        catalog = cf.makeCatalog(data, config=config)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        # A copy of the data, and an equivalent config, should give back the same Catalog.  When
+        # TreeCorr says which parameters affect a Catalog, configs that only differ in the
+        # separations are equivalent too.
+        other_config = config.copy()
+        if stile.sys_tests.catalog_valid_params is not stile.sys_tests.corr2_valid_params:
+            other_config['max_sep'] = 20
+        self.assertTrue(cf.makeCatalog(data.copy(), config=other_config) is catalog)
+        self.assertTrue(stile.sys_tests.Rho1SysTest().makeCatalog(data, config=config) is catalog)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        # But different data, different Catalog config, or a different use of the columns, shouldn't
+        other_data = data.copy()
+        other_data['g1'][0] += 0.1
+        other_config['ra_units'] = 'radians'
+        for args, kwargs in [((other_data,), {'config': config}),
+                             ((data,), {'config': other_config}),
+                             ((data,), {'config': config, 'use_as_k': 'g1'})]:
+            self.assertFalse(cf.makeCatalog(*args, **kwargs) is catalog)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        self.assertEqual(len(cache), 4)
+        # The least recently used Catalogs should be dropped when the cache is full
+        cache.max_size = 2
+        cf.makeCatalog(data, config=config)
+        cf.makeCatalog(data[:50], config=config)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cf.makeCatalog(data, config=config) is catalog)
+        self.assertFalse(cf.makeCatalog(other_data, config=config) is catalog)
+        self.assertEqual((cache.hits, cache.misses), (4, 6))
+        cache.max_size = 16
+        cache.clear()
+
+    def test_rhoStatistics(self):
+        """Test that RhoStatisticsSysTest agrees with the individual Rho*SysTests."""
+        numpy.random.seed(2718)
+        n = 300
+        config = {'ra_units': 'degrees', 'dec_units': 'degrees', 'min_sep': 1, 'max_sep': 30,
+                  'sep_units': 'arcmin', 'nbins': 5}
+
+        def makeData():
+            return numpy.rec.fromarrays([numpy.random.uniform(0, 1, size=n),
+                                         numpy.random.uniform(0, 1, size=n),
+                                         numpy.random.normal(0, 0.1, size=n),
+                                         numpy.random.normal(0, 0.1, size=n),
+                                         numpy.random.normal(2., 0.1, size=n),
+                                         numpy.random.normal(0, 0.1, size=n),
+                                         numpy.random.normal(0, 0.1, size=n),
+                                         numpy.random.normal(2., 0.1, size=n),
+                                         numpy.ones(n)],
+                                        names=['ra', 'dec', 'g1', 'g2', 'sigma', 'psf_g1',
+                                               'psf_g2', 'psf_sigma', 'w'])
+        data = makeData()
+        data2 = makeData()
+        rho_stats = stile.CorrelationFunctionSysTest('RhoStatistics')
+        individual_tests = [stile.sys_tests.Rho1SysTest(), stile.sys_tests.Rho2SysTest(),
+                            stile.sys_tests.Rho3SysTest(), stile.sys_tests.Rho4SysTest(),
+                            stile.sys_tests.Rho5SysTest()]
+        for args in [(data,), (data, data2)]:
+            sequential_results = rho_stats(*args, config=config)
+            for parallel in ['thread', 'process']:
+                parallel_results = rho_stats(*args, config=config, parallel=parallel,
+                                             num_threads=2)
+                for name in sequential_results.dtype.names:
+                    numpy.testing.assert_allclose(sequential_results[name], parallel_results[name],
+                                                  rtol=1.E-10)
+            self.assertIn('xip_rho3', sequential_results.dtype.names)
+            for rho_name, test in zip(rho_stats.rho_names, individual_tests):
+                results = rho_stats.getRho(sequential_results, rho_name)
+                expected_results = test(*args, config=config)
+                self.assertEqual(results.dtype.names, expected_results.dtype.names)
+                for name in results.dtype.names:
+                    numpy.testing.assert_allclose(results[name], expected_results[name],
+                                                  rtol=1.E-10, atol=1.E-14)
+        self.assertRaises(ValueError, rho_stats.getRho, sequential_results, 'rho6')
+
     def test_generator(self):
         """Make sure the CorrelationFunctionSysTest() generator returns the right objects"""
         object_list = ['GalaxyShear', 'BrightStarShear', 'StarXGalaxyDensity',  'StarXGalaxyShear',
-                       'StarXStarShear', 'GalaxyDensityCorrelation', 'StarDensityCorrelation']
+                       'StarXStarShear', 'GalaxyDensityCorrelation', 'StarDensityCorrelation',
+                       'RhoStatistics']
         for object_type in object_list:
             object_1 = stile.CorrelationFunctionSysTest(object_type)
             object_2 = eval('stile.sys_tests.'+object_type+'SysTest()')
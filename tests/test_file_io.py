@@ -93,6 +93,66 @@ class TestFileIO(unittest.TestCase):
             numpy.testing.assert_equal(*helper.FormatSame(result, self.fits_table))
             self.assertRaises(IOError, stile.ReadFITSImage, 'test_data/data_table.dat')
 
+    def test_ReadFITSTableColumns(self):
+        """Test reading a subset of the columns of a FITS table, with and without memory-mapping."""
+        if stile.file_io.has_fits:
+            for memmap in [False, True]:
+                result = stile.ReadFITSTable('test_data/table.fits', memmap=memmap)
+                numpy.testing.assert_equal(*helper.FormatSame(result, self.fits_table))
+                result = stile.ReadFITSTable('test_data/table.fits', columns=['final', 'q'],
+                                             memmap=memmap)
+                self.assertEqual(result.dtype.names, ('final', 'q'))
+                numpy.testing.assert_equal(
+                    *helper.FormatSame(result, self.fits_table[['final', 'q']].astype(
+                                                                [('final', int), ('q', float)])))
+                result = stile.ReadFITSTable('test_data/two_tables.fits', hdu=2, columns=[1],
+                                             fields={'message': 0}, memmap=memmap)
+                self.assertEqual(result.dtype.names, ('message',))
+                numpy.testing.assert_equal(result['message'], self.fits_table['status'])
+                # Check that ReadTable passes the columns through, too
+                result = stile.ReadTable('test_data/table.fits', columns=['status'], memmap=memmap)
+                numpy.testing.assert_equal(result['status'], self.fits_table['status'])
+            # Memory-mapped data should stay valid after the file has been closed
+            result = stile.ReadFITSTable('test_data/two_tables.fits', memmap=True)
+            import gc
+            gc.collect()
+            numpy.testing.assert_equal(*helper.FormatSame(result, self.fits_table_2))
+
+    def test_IterTable(self):
+        """Test that reading a table in chunks gives the same result as reading it all at once."""
+        file_names = ['test_data/data_table.dat', 'test_data/table_with_string.dat']
+        if stile.file_io.has_fits:
+            file_names += ['test_data/table.fits', 'test_data/two_tables.fits']
+        for file_name in file_names:
+            expected = stile.ReadTable(file_name)
+            for chunk_rows in [1, 2, 3, 100]:
+                chunks = list(stile.IterTable(file_name, chunk_rows=chunk_rows))
+                for chunk in chunks:
+                    self.assertTrue(len(chunk) <= chunk_rows)
+                numpy.testing.assert_equal(*helper.FormatSame(numpy.concatenate(chunks), expected))
+        if stile.file_io.has_fits:
+            result = numpy.concatenate(list(stile.IterTable('test_data/two_tables.fits', hdu=2,
+                                                            chunk_rows=1, columns=['final', 'q'],
+                                                            fields={'new_final': 0})))
+            numpy.testing.assert_equal(result.dtype.names, ['new_final', 'q'])
+            numpy.testing.assert_equal(result['new_final'], self.fits_table['final'])
+            numpy.testing.assert_equal(result['q'], self.fits_table['q'])
+        # Columns whose inferred types differ from chunk to chunk should be merged like
+        # numpy.genfromtxt would do for the whole file
+        handle, file_name = tempfile.mkstemp()
+        with open(file_name, 'w') as f:
+            f.write('1 2 True 8\n1.5 2 False 9\n# comment\n3 200 1 ninety\n')
+        expected = stile.ReadTable(file_name, fields={'a': 0, 'b': 1})
+        result = numpy.concatenate(list(stile.IterTable(file_name, chunk_rows=1,
+                                                        fields={'a': 0, 'b': 1})))
+        self.assertEqual(result.dtype, expected.dtype)
+        numpy.testing.assert_equal(result, expected)
+        result = numpy.concatenate(list(stile.IterTable(file_name, chunk_rows=2, columns=[1, 3])))
+        numpy.testing.assert_equal(result, stile.ReadTable(file_name, usecols=[1, 3]))
+        os.close(handle)
+        os.remove(file_name)
+        self.assertRaises(ValueError, stile.IterTable, 'test_data/data_table.dat', chunk_rows=0)
+
     def test_ReadASCIITable(self):
         """Test the ability to read in an ASCII table."""
         # ReadASCIITable is a wrapper for numpy.genfromtxt() that turns things into formatted
@@ -106,6 +166,127 @@ class TestFileIO(unittest.TestCase):
         results = stile.ReadTable('test_data/table_with_string.dat')
         numpy.testing.assert_equal(results, self.table2_withstring)
 
+    def test_fastReadASCIITable(self):
+        """Test that the fast ASCII parser gives the same results as numpy.genfromtxt."""
+        handle, file_name = tempfile.mkstemp()
+        numpy.random.seed(12)
+        data = numpy.random.normal(size=(100, 4))
+        data[:, 0] = numpy.arange(100)
+
+        def writeFile(extra_lines=''):
+            with open(file_name, 'w') as f:
+                f.write('# x y z w\n\n')
+                numpy.savetxt(f, data, fmt='%d %.7f %.3e %.5g')
+                f.write(extra_lines)
+        writeFile()
+        expected = stile.FormatArray(numpy.genfromtxt(file_name, dtype=None))
+        self.assertEqual(expected.dtype[0], int)
+        # Use small byte ranges so the file is split into several pieces (parsed in parallel if
+        # there's more than one worker), and infer the types from only a few lines.
+        range_bytes = stile.file_io._fast_ascii_range_bytes
+        parallel_bytes = stile.file_io._fast_ascii_parallel_bytes
+        infer_lines = stile.file_io._fast_ascii_infer_lines
+        stile.file_io._fast_ascii_range_bytes = 500
+        stile.file_io._fast_ascii_parallel_bytes = 0
+        stile.file_io._fast_ascii_infer_lines = 10
+        try:
+            for n_workers in [1, 2]:
+                result = stile.file_io._fastReadASCIITable(file_name, n_workers=n_workers)
+                self.assertEqual(result.dtype, expected.dtype)
+                numpy.testing.assert_equal(result, expected)
+                result = stile.ReadASCIITable(file_name, n_workers=n_workers, fields={'id': 0})
+                numpy.testing.assert_equal(result['id'], expected['f0'])
+            # Files the fast parser can't handle should fall back to genfromtxt: non-integers
+            # (even integral ones) after the lines used to infer the types, a comment, and a blank
+            # line
+            for extra_lines, is_float in [('100.5 1 1 1\n', True), ('100.0 1 1 1\n', True),
+                                          ('1e2 1 1 1\n', True), ('100 1 1 1 # comment\n', False),
+                                          ('\n101 1 1 1\n', False)]:
+                writeFile(extra_lines)
+                for n_workers in [1, 2]:
+                    self.assertIsNone(stile.file_io._fastReadASCIITable(file_name,
+                                                                        n_workers=n_workers))
+                result = stile.ReadASCIITable(file_name)
+                numpy.testing.assert_equal(
+                    result, stile.FormatArray(numpy.genfromtxt(file_name, dtype=None)))
+                if is_float:
+                    self.assertEqual(result.dtype[0].kind, 'f')
+            # A short line followed by a long one has the right number of values in total, but
+            # shouldn't be read as two good lines.
+            writeFile('1 2\n3 4 5 6 7 8\n')
+            self.assertIsNone(stile.file_io._fastReadASCIITable(file_name, n_workers=2))
+            self.assertRaises(ValueError, stile.ReadASCIITable, file_name)
+        finally:
+            stile.file_io._fast_ascii_range_bytes = range_bytes
+            stile.file_io._fast_ascii_parallel_bytes = parallel_bytes
+            stile.file_io._fast_ascii_infer_lines = infer_lines
+        self.assertIsNone(stile.file_io._fastReadASCIITable('test_data/table_with_string.dat'))
+        self.assertIsNone(
+            stile.file_io._fastReadASCIITable('test_data/table_with_missing_field.dat'))
+        os.close(handle)
+        os.remove(file_name)
+
+    def test_Columnar(self):
+        """Test writing and reading tables in the columnar format, and using them as caches."""
+        temp_dir = tempfile.mkdtemp()
+        dir_name = os.path.join(temp_dir, 'table')
+        stile.WriteColumnar(dir_name, self.table2_withstring)
+        result = stile.ReadColumnar(dir_name)
+        self.assertEqual(result.dtype, self.table2_withstring.dtype)
+        numpy.testing.assert_equal(result, self.table2_withstring)
+        result = stile.ReadColumnar(dir_name, columns=['f3', 1], fields=['d', 's'])
+        numpy.testing.assert_equal(result.dtype.names, ['d', 's'])
+        numpy.testing.assert_equal(result['d'], self.table2_withstring['f3'])
+        numpy.testing.assert_equal(result['s'], self.table2_withstring['f1'])
+        result = stile.ReadColumnar(dir_name, columns=['f3', 1], fields={'d': 0},
+                                    as_columns=True)
+        self.assertEqual(list(result.keys()), ['d', 'f1'])
+        self.assertIsInstance(result['d'], numpy.memmap)
+        numpy.testing.assert_equal(result['d'], self.table2_withstring['f3'])
+        numpy.testing.assert_equal(result['f1'], self.table2_withstring['f1'])
+        self.assertRaises(TypeError, stile.WriteColumnar, dir_name, [1, 2])
+        self.assertRaises(IOError, stile.ReadColumnar, temp_dir)
+
+        # Now check the cache behavior of ReadTable
+        file_name = os.path.join(temp_dir, 'table.dat')
+        cache_name = stile.file_io._columnarCacheName(file_name)
+        stile.WriteASCIITable(file_name, self.table1)
+        expected = stile.ReadTable(file_name)
+        self.assertFalse(os.path.exists(cache_name))
+        result = stile.ReadTable(file_name, write_cache=True, fields={'r': 0})
+        self.assertTrue(os.path.exists(cache_name))
+        numpy.testing.assert_equal(result['r'], expected['f0'])
+        self.assertTrue(stile.file_io._isFreshColumnarCache(cache_name, file_name, {}))
+        # Different kwargs shouldn't use the cache
+        self.assertFalse(stile.file_io._isFreshColumnarCache(cache_name, file_name,
+                                                             {'usecols': [0, 1]}))
+        # Check that the cache is actually used, by putting something different in it
+        stile.WriteColumnar(cache_name, expected[::-1], source_file=file_name, read_kwargs={})
+        numpy.testing.assert_equal(stile.ReadTable(file_name), expected[::-1])
+        numpy.testing.assert_equal(stile.ReadTable(file_name, use_cache=False), expected)
+        result = stile.ReadTable(file_name, as_columns=True)
+        self.assertIsInstance(result['f0'], numpy.memmap)
+        numpy.testing.assert_equal(result['f0'], expected['f0'][::-1])
+        result = stile.ReadTable(file_name, use_cache=False, as_columns=True)
+        numpy.testing.assert_equal(result['f0'], expected['f0'])
+        # Touching the file without changing it keeps the cache valid (and records the new
+        # modification time, so the file isn't checksummed every time); changing it doesn't
+        os.utime(file_name, (0, 0))
+        numpy.testing.assert_equal(stile.ReadTable(file_name), expected[::-1])
+        manifest = stile.file_io._readColumnarManifest(cache_name)
+        self.assertEqual(manifest['source']['mtime'], 0)
+        stile.WriteASCIITable(file_name, self.table1[:-1])
+        numpy.testing.assert_equal(stile.ReadTable(file_name), expected[:-1])
+        # Kwargs that JSON can't represent can still be cached
+        result = stile.ReadTable(file_name, write_cache=True, converters={0: float})
+        numpy.testing.assert_equal(result, expected[:-1])
+        self.assertTrue(stile.file_io._isFreshColumnarCache(cache_name, file_name,
+                                                            {'converters': {0: float}}))
+        self.assertFalse(stile.file_io._isFreshColumnarCache(cache_name, file_name,
+                                                             {'converters': {0: int}}))
+        import shutil
+        shutil.rmtree(temp_dir)
+
     def test_WriteASCIITable(self):
         """Test the ability to write an ASCII table."""
         # Must be done after test_read_ASCII_table() since it uses the read_ASCII_table function!
@@ -137,6 +318,223 @@ class TestFileIO(unittest.TestCase):
             numpy.testing.assert_equal(self.table1.astype('f'), results.astype('f'))
             os.close(handle)
 
+    def test_AsyncWriter(self):
+        """Test writing tables and figures from a background thread."""
+        import shutil
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            writer = stile.AsyncWriter(max_queued=2)
+            table_names = [os.path.join(tmp_dir, 'table%i.dat'%i) for i in range(5)]
+            for table_name in table_names:
+                writer.writeASCIITable(table_name, self.table1, print_header=True)
+            fig = plt.figure()
+            plt.plot([1, 2], [3, 4])
+            fig_name = os.path.join(tmp_dir, 'fig.png')
+            writer.saveFigure(fig, fig_name)
+            writer.close()
+            for table_name in table_names:
+                results = stile.ReadASCIITable(table_name)
+                for field in self.table1.dtype.names:
+                    numpy.testing.assert_equal(results[field].astype('f'),
+                                               self.table1[field].astype('f'))
+            self.assertTrue(os.path.getsize(fig_name) > 0)
+            # The figure was closed after saving it
+            self.assertFalse(fig.number in plt.get_fignums())
+            self.assertRaises(RuntimeError, writer.writeASCIITable, table_names[0], self.table1)
+
+            # Errors are raised when the writer is closed, after the other writes are done
+            writer = stile.AsyncWriter()
+            writer.writeASCIITable(os.path.join(tmp_dir, 'no_such_dir', 'table.dat'), self.table1)
+            later_name = os.path.join(tmp_dir, 'later.dat')
+            writer.writeASCIITable(later_name, self.table1)
+            self.assertRaises(IOError, writer.close)
+            self.assertTrue(os.path.exists(later_name))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_ResultStore(self):
+        """Test storing result tables in, and expanding them from, a single file."""
+        import shutil
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            store_name = os.path.join(tmp_dir, 'results.npys')
+            store = stile.ResultStore(store_name)
+            self.assertEqual(len(store), 0)
+            for visit in [1228, 1230]:
+                for ccd in range(3):
+                    data = self.table1.copy()
+                    data['f0'] += visit+ccd
+                    store.write('rho1', {'visit': numpy.int64(visit), 'ccd': ccd}, data,
+                                file_name='rho1-%07d-%03d.dat'%(visit, ccd))
+            store.write('stats', {'visit': 1228, 'ccd': [0, 1, 2]}, self.table1[:2])
+            self.assertEqual(len(store), 7)
+            self.assertTrue(('rho1', {'visit': 1230, 'ccd': 2}) in store)
+            self.assertFalse(('rho1', {'visit': 1230, 'ccd': 3}) in store)
+            numpy.testing.assert_equal(store.read('rho1', visit=1230, ccd=1)['f0'],
+                                       self.table1['f0']+1231)
+            self.assertRaises(KeyError, store.read, 'rho1', visit=1230)
+            # Writing a table again replaces it
+            store.write('rho1', {'visit': 1228, 'ccd': 0}, self.table1[:1],
+                        file_name='rho1-%07d-%03d.dat'%(1228, 0))
+            self.assertEqual(len(store.read('rho1', visit=1228, ccd=0)), 1)
+
+            # A second store opened on the same file sees everything, and picks up later writes
+            other_store = stile.ResultStore(store_name)
+            self.assertEqual(len(other_store), 7)
+            numpy.testing.assert_equal(other_store.read('stats', visit=1228, ccd=(0, 1, 2)),
+                                       self.table1[:2])
+            store.write('stats', {'visit': 1230}, self.table1)
+            numpy.testing.assert_equal(other_store.read('stats', visit=1230), self.table1)
+            # An unfinished index line is ignored
+            with open(store_name+'.index', 'a') as f:
+                f.write('{"test_name": "partial"')
+            self.assertEqual(len(stile.ResultStore(store_name)), 8)
+
+            # Expand the tables that have file names back into separate files
+            output_dir = os.path.join(tmp_dir, 'expanded')
+            written = stile.ExpandResultStore(store_name, output_dir)
+            self.assertEqual(len(written), 6)
+            results = stile.ReadASCIITable(os.path.join(output_dir, 'rho1-0001230-002.dat'))
+            # (ASCII tables are written to limited precision)
+            numpy.testing.assert_allclose(results['f0'], self.table1['f0']+1232, rtol=1.E-5)
+            results = stile.ReadASCIITable(os.path.join(output_dir, 'rho1-0001228-000.dat'))
+            self.assertEqual(len(numpy.atleast_1d(results)), 1)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_OutputFingerprints(self):
+        """Test recording and checking the fingerprints of outputs."""
+        import shutil
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fingerprint_name = os.path.join(tmp_dir, 'fingerprints')
+            fingerprints = stile.OutputFingerprints(fingerprint_name)
+            data_id = {'visit': 1228, 'ccd': 49}
+            self.assertFalse(fingerprints.isCurrent('rho1', data_id, 'abc'))
+            output_name = os.path.join(tmp_dir, 'rho1-0001228-049.dat')
+            with open(output_name, 'w') as f:
+                f.write('1 2 3\n')
+            fingerprints.record('rho1', data_id, 'abc', outputs=['rho1-0001228-049.dat'])
+            self.assertTrue(fingerprints.isCurrent('rho1', data_id, 'abc'))
+            self.assertFalse(fingerprints.isCurrent('rho1', data_id, 'abd'))
+            self.assertFalse(fingerprints.isCurrent('rho1', {'visit': 1228, 'ccd': 50}, 'abc'))
+            # A new record replaces the old one, including when read from the file
+            fingerprints.record('rho1', data_id, 'abd', outputs=['rho1-0001228-049.dat'])
+            fingerprints = stile.OutputFingerprints(fingerprint_name)
+            self.assertFalse(fingerprints.isCurrent('rho1', data_id, 'abc'))
+            self.assertTrue(fingerprints.isCurrent('rho1', data_id, 'abd'))
+            # Outputs that have gone missing have to be remade
+            os.remove(output_name)
+            self.assertFalse(fingerprints.isCurrent('rho1', data_id, 'abd'))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_OutputFingerprintsFindStale(self):
+        """Test finding the tests that need to be rerun, as the HSC tasks do."""
+        import shutil
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fingerprints = stile.OutputFingerprints(os.path.join(tmp_dir, 'fingerprints'))
+            data_id = {'visit': 1228, 'ccd': 49}
+            test_configs = [('rho1', ''), ('stats', 'n_bins=10')]
+            stale, test_fingerprints = fingerprints.findStale(data_id, 'inputs', test_configs)
+            self.assertEqual(stale, ['rho1', 'stats'])
+            self.assertNotEqual(test_fingerprints['rho1'], test_fingerprints['stats'])
+            # rho1 writes a file; stats writes its table to a result store
+            with open(os.path.join(tmp_dir, 'rho1.dat'), 'w') as f:
+                f.write('1 2 3\n')
+            store = stile.ResultStore(os.path.join(tmp_dir, 'results.npys'))
+            store.write('stats', data_id, self.table1)
+            fingerprints.record('rho1', data_id, test_fingerprints['rho1'], outputs=['rho1.dat'])
+            fingerprints.record('stats', data_id, test_fingerprints['stats'],
+                                stores=['results.npys'])
+            self.assertEqual(fingerprints.findStale(data_id, 'inputs', test_configs)[0], [])
+            # Changing one test's config, or adding a test, only affects that test
+            self.assertEqual(
+                fingerprints.findStale(data_id, 'inputs', [('rho1', ''), ('stats', 'n_bins=20'),
+                                                           ('rho2', '')])[0], ['stats', 'rho2'])
+            # Changing the shared inputs affects every test
+            self.assertEqual(fingerprints.findStale(data_id, 'new inputs', test_configs)[0],
+                             ['rho1', 'stats'])
+            # A store that exists but doesn't hold the test's table isn't current
+            fingerprints.record('stats', {'visit': 1228, 'ccd': 50}, test_fingerprints['stats'],
+                                stores=['results.npys'])
+            self.assertFalse(fingerprints.isCurrent('stats', {'visit': 1228, 'ccd': 50},
+                                                    test_fingerprints['stats']))
+            # Stores passed in are reused, and those opened are added for the next call
+            stores = {}
+            self.assertTrue(fingerprints.isCurrent('stats', data_id, test_fingerprints['stats'],
+                                                   stores=stores))
+            store_name = os.path.join(tmp_dir, 'results.npys')
+            self.assertEqual(stores.keys(), [store_name])
+            opened_store = stores[store_name]
+            self.assertFalse(fingerprints.isCurrent('stats', {'visit': 1228, 'ccd': 50},
+                                                    test_fingerprints['stats'], stores=stores))
+            self.assertIs(stores[store_name], opened_store)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_ColumnCache(self):
+        """Test caching derived columns on disk, keyed by source ID."""
+        import shutil
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache_name = os.path.join(tmp_dir, 'cache')
+            ids = numpy.array([10, 11, 12, 13, 14])
+            cache = stile.ColumnCache(cache_name, ids, 'abc')
+            values, valid = cache.getColumn('mag')
+            self.assertTrue(numpy.all(numpy.isnan(values)))
+            self.assertTrue(numpy.all(valid))
+            cache.update('mag', numpy.array([True, True, False, True, False]), [20., 21., 22.],
+                         [True, False, True])
+            cache.update('g1_sky', [4], 0.1)
+            cache.write()
+
+            # Rows are matched up by source ID, and sources that weren't cached are left as nan
+            cache = stile.ColumnCache(cache_name, numpy.array([15, 13, 11, 10]), 'abc')
+            values, valid = cache.getColumn('mag')
+            numpy.testing.assert_equal(values, [numpy.nan, 22., 21., 20.])
+            numpy.testing.assert_equal(valid, [True, True, False, True])
+            numpy.testing.assert_equal(cache.getColumn('g1_sky')[0], [numpy.nan]*4)
+            # Adding a column keeps the cached columns that weren't read
+            cache.update('x', [0, 1], [1., 2.])
+            cache.write()
+            cache = stile.ColumnCache(cache_name, numpy.array([10, 11, 13, 14, 15]), 'abc')
+            numpy.testing.assert_equal(cache.getColumn('g1_sky')[0],
+                                       [numpy.nan, numpy.nan, numpy.nan, 0.1, numpy.nan])
+            numpy.testing.assert_equal(cache.getColumn('x')[0],
+                                       [numpy.nan, numpy.nan, 2., numpy.nan, 1.])
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['cache'])
+
+            # A cache made from different inputs is ignored
+            cache = stile.ColumnCache(cache_name, ids, 'def')
+            self.assertTrue(numpy.all(numpy.isnan(cache.getColumn('mag')[0])))
+
+            # A galaxy-shape test gets the same mask from a cold and a warm cache, even when the
+            # PSF columns computed alongside the shapes were flagged (as the HSC tasks do it: the
+            # PSF-flux mask is only recorded as the validity of the PSF columns).
+            def cacheMask(cache, cols, mask):
+                mask = mask.copy()
+                for col in cols:
+                    mask[numpy.logical_not(cache.getColumn(col)[1])] = False
+                return mask
+            mask = numpy.array([True, True, False, True, True])
+            psf_flux_mask = numpy.array([True, False, True, False])
+            cache = stile.ColumnCache(cache_name, ids, 'ghi')
+            cold_mask = cacheMask(cache, ['g1_sky'], mask)
+            cache.update('g1_sky', mask, [0.1, 0.2, 0.3, 0.4])
+            cache.update('psf_g1_sky', mask, [0.01, 0.02, 0.03, 0.04], psf_flux_mask)
+            cache.write()
+            cache = stile.ColumnCache(cache_name, ids, 'ghi')
+            numpy.testing.assert_equal(cacheMask(cache, ['g1_sky'], mask), cold_mask)
+            numpy.testing.assert_equal(cacheMask(cache, ['g1_sky', 'psf_g1_sky'], mask),
+                                       [True, False, False, True, False])
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_WriteFITSTable(self):
         """Test the ability to write a FITS table."""
         if stile.file_io.has_fits:
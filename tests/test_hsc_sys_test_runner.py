@@ -0,0 +1,58 @@
+import numpy
+import os
+import unittest
+try:
+    import stile
+except ImportError:
+    import sys
+    sys.path.append('..')
+    import stile
+from stile.hsc import sys_test_runner
+
+class TestSysTestRunner(unittest.TestCase):
+
+    def test_RunSysTests(self):
+        """Test running sys test adapters in a pool of worker processes."""
+        class TaskConfig(object):
+            treecorr_kwargs = {'num_threads': 4, 'nbins': 10}
+
+        class StubSysTest(object):
+            pass
+
+        class StubAdapter(object):
+            # Returns which process it ran in and how many TreeCorr threads it was allowed.
+            def __init__(self, sys_test):
+                self.sys_test = sys_test
+
+            def __call__(self, task_config, *data):
+                if hasattr(self.sys_test, 'getData'):
+                    self.sys_test.data = sum([len(d) for d in data])
+                return (os.getpid(), task_config.treecorr_kwargs['num_threads'],
+                        task_config.treecorr_kwargs['nbins'], sum([len(d) for d in data]))
+
+        config = TaskConfig()
+        jobs = [(StubAdapter(StubSysTest()), [numpy.arange(i+1)]) for i in range(4)]
+        # A test that draws a figure is run in this process
+        jobs.insert(2, (StubAdapter(stile.sys_tests.BaseWhiskerPlotSysTest()),
+                        [numpy.arange(3), numpy.arange(4)]))
+        serial_results = sys_test_runner.RunSysTests(jobs, config)
+        self.assertEqual([result for result, output in serial_results],
+                         [(os.getpid(), 4, 10, n) for n in [1, 2, 7, 3, 4]])
+        self.assertEqual([output for result, output in serial_results],
+                         [None, None, 7, None, None])
+
+        pool_results = sys_test_runner.RunSysTests(jobs, config, n_processes=2)
+        self.assertEqual([(n_threads, n_bins, n) for (pid, n_threads, n_bins, n), output
+                          in pool_results],
+                         [(1, 10, 1), (1, 10, 2), (4, 10, 7), (1, 10, 3), (1, 10, 4)])
+        self.assertEqual([output for result, output in pool_results], [None, None, 7, None, None])
+        pids = [pid for (pid, n_threads, n_bins, n), output in pool_results]
+        self.assertEqual(pids[2], os.getpid())
+        self.assertFalse(os.getpid() in pids[:2]+pids[3:])
+        # The config itself isn't changed
+        self.assertEqual(config.treecorr_kwargs['num_threads'], 4)
+        self.assertEqual(sys_test_runner._sys_test_jobs, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
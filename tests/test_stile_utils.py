@@ -1,4 +1,9 @@
+import collections
 import numpy
+import os
+import shutil
+import tempfile
+import time
 import unittest
 try:
     import stile
@@ -38,9 +43,277 @@ class TestStileUtils(unittest.TestCase):
         result2 = stile.FormatArray(data1, fields={'one': 0, 'two': 1, 'three': 2})
         numpy.testing.assert_equal(result, result2)
         # And one quick check for non-NumPy arrays, ie, assume a 1d array is a *row* not a *field*
-        # and that everything else works
+        # and that everything else works
         numpy.testing.assert_equal(stile.FormatArray([1, 2]), numpy.array([(1, 2)], dtype='l, l'))
 
+    def test_FormatArrayLayouts(self):
+        """Test FormatArray on multidimensional, non-contiguous, byte-swapped and object arrays."""
+        data = numpy.arange(24.).reshape(2, 3, 4)
+        expected = numpy.array([[tuple(row) for row in block] for block in data], dtype='d,d,d,d')
+        result = stile.FormatArray(data)
+        numpy.testing.assert_equal(result, expected)
+        self.assertEqual(result.shape, (2, 3))
+        # The data is copied unless the caller says it doesn't need to be, in which case a
+        # contiguous array is formatted without a copy
+        self.assertFalse(numpy.may_share_memory(result, data))
+        result = stile.FormatArray(data, copy=False)
+        numpy.testing.assert_equal(result, expected)
+        self.assertTrue(numpy.may_share_memory(result, data))
+        # Non-contiguous slices and big-endian arrays should come out the same as the native case
+        numpy.testing.assert_equal(stile.FormatArray(data[:, :, ::2]),
+                                   expected[['f0', 'f2']].astype('d,d'))
+        numpy.testing.assert_equal(stile.FormatArray(data.astype('>f8')), expected)
+        result = stile.FormatArray(data.astype('>f8'), fields={'one': 1})
+        numpy.testing.assert_equal(result.dtype.names, ['f0', 'one', 'f2', 'f3'])
+        numpy.testing.assert_equal(result['one'], data[:, :, 1])
+        # Object arrays can't be viewed as records, but should still work
+        data = numpy.array([[1, 'a'], [2, None]], dtype=object)
+        result = stile.FormatArray(data, fields=['num', 'obj'])
+        numpy.testing.assert_equal(result['num'], [1, 2])
+        numpy.testing.assert_equal(result['obj'], ['a', None])
+
+    def test_InterpolateJacobians(self):
+        """Test interpolated Jacobians and moment transformations against per-object versions."""
+        numpy.random.seed(42)
+        n = 2000
+        x = numpy.random.uniform(0, 2048, size=n)
+        y = numpy.random.uniform(0, 4176, size=n)
+        calls = [0]
+
+        def jacobian(x, y):
+            # A pixel scale of 0.17 arcsec with a cubic radial distortion and a small rotation
+            calls[0] += 1
+            r_sq = ((x-5000.)**2+(y+3000.)**2)/1.E8
+            scale = 0.17/3600.*(1.+0.01*r_sq)
+            return scale*numpy.array([[-0.99995, 0.01], [0.01, 0.99995]])
+        expected = numpy.array([jacobian(xi, yi) for xi, yi in zip(x, y)])
+        for tolerance in [1.E-4, 1.E-6, 1.E-8]:
+            calls[0] = 0
+            result = stile.stile_utils.InterpolateJacobians(jacobian, x, y, tolerance=tolerance)
+            self.assertEqual(result.shape, (n, 2, 2))
+            numpy.testing.assert_allclose(result, expected, rtol=0,
+                                          atol=10*tolerance*numpy.abs(expected).max())
+            # Coarse tolerances shouldn't need anywhere near one evaluation per object, and fine
+            # ones shouldn't waste too much time on grids before giving up and doing that
+            if tolerance == 1.E-4:
+                self.assertLess(calls[0], n/10)
+            self.assertLess(calls[0], 1.5*n)
+        numpy.testing.assert_equal(
+            stile.stile_utils.InterpolateJacobians(jacobian, x, y, tolerance=0), expected)
+        numpy.testing.assert_equal(
+            stile.stile_utils.InterpolateJacobians(jacobian, x[:3], y[:3]), expected[:3])
+        self.assertEqual(stile.stile_utils.InterpolateJacobians(jacobian, [], []).shape,
+                         (0, 2, 2))
+
+        # Now check the moment transformations against the matrix products
+        ixx = numpy.random.uniform(2., 4., size=n)
+        iyy = numpy.random.uniform(2., 4., size=n)
+        ixy = numpy.random.uniform(-1., 1., size=n)
+        moments = numpy.array([ixx, iyy, ixy]).T
+        covariances = numpy.random.uniform(-0.1, 0.1, size=(n, 3, 3))
+        covariances = numpy.einsum('nij,nkj->nik', covariances, covariances)
+        result, result_covariances = stile.stile_utils.TransformMoments(moments, expected,
+                                                                        covariances)
+        self.assertEqual(result.shape, (n, 3))
+        # Shift the moments by small amounts to get the derivatives of the transformation
+        derivatives = numpy.array([(stile.stile_utils.TransformMoments(moments+step, expected)[0] -
+                                    result)/1.E-3 for step in 1.E-3*numpy.identity(3)])
+        for i in range(0, n, 97):
+            matrix = numpy.dot(numpy.dot(expected[i], [[ixx[i], ixy[i]], [ixy[i], iyy[i]]]),
+                               expected[i].T)
+            numpy.testing.assert_allclose(result[i], [matrix[0, 0], matrix[1, 1], matrix[0, 1]],
+                                          rtol=1.E-12)
+            numpy.testing.assert_allclose(
+                result_covariances[i],
+                numpy.dot(numpy.dot(derivatives[:, i].T, covariances[i]), derivatives[:, i]),
+                rtol=1.E-6)
+        # Several sets of moments per object should be transformed the same way as one set
+        stacked, no_covariances = stile.stile_utils.TransformMoments(
+            numpy.array([moments, 2*moments]).transpose(1, 0, 2), expected)
+        self.assertTrue(no_covariances is None)
+        numpy.testing.assert_allclose(stacked[:, 0], result, rtol=1.E-14)
+        numpy.testing.assert_allclose(stacked[:, 1], 2*result, rtol=1.E-14)
+
+    def test_EvaluatePolynomial2D(self):
+        """Test array polynomial evaluation against a term-by-term sum at each position."""
+        numpy.random.seed(3)
+        x = numpy.random.uniform(-1, 1, size=50)
+        y = numpy.random.uniform(-1, 1, size=50)
+        x_orders = [0, 1, 0, 2, 1, 0, 3, 1]
+        y_orders = [0, 0, 1, 0, 1, 2, 0, 1]
+        coefficients = numpy.random.normal(size=len(x_orders))
+        chebyshev_polynomials = [lambda t: 1., lambda t: t, lambda t: 2*t**2-1,
+                                 lambda t: 4*t**3-3*t]
+        for chebyshev in [False, True]:
+            if chebyshev:
+                poly = lambda n, t: chebyshev_polynomials[n](t)
+            else:
+                poly = lambda n, t: t**n
+            expected = [sum(c*poly(nx, xi)*poly(ny, yi)
+                            for c, nx, ny in zip(coefficients, x_orders, y_orders))
+                        for xi, yi in zip(x, y)]
+            result = stile.stile_utils.EvaluatePolynomial2D(x, y, coefficients, x_orders, y_orders,
+                                                            chebyshev=chebyshev)
+            numpy.testing.assert_allclose(result, expected, rtol=1.E-12, atol=1.E-14)
+        numpy.testing.assert_equal(
+            stile.stile_utils.EvaluatePolynomial2D(x, y, [], [], []), numpy.zeros_like(x))
+
+    def test_ColumnStore(self):
+        """Test that a ColumnStore shares masked columns and arrays between equal masks."""
+        columns = {'x': numpy.arange(10.), 'y': numpy.arange(10.)**2, 'z': -numpy.arange(10.)}
+        n_made = collections.Counter()
+
+        def makeArray(column_dict):
+            fields = sorted(column_dict)
+            return stile.FormatArray(numpy.array([column_dict[key] for key in fields]).T,
+                                     fields=fields)
+
+        store = stile.stile_utils.ColumnStore()
+        mask1 = numpy.arange(10) % 2 == 0
+        mask2 = numpy.arange(10) % 2 == 0  # same contents, different object
+        mask3 = numpy.arange(10) < 5
+        for mask in [mask1, mask2, mask3]:
+            def makeColumn(column):
+                n_made[column] += 1
+                return columns[column][mask] if column in columns else None
+            key = store.maskKey(mask)
+            array1 = store.getArray(key, ['x', 'y', 'missing'], makeColumn, makeArray)
+            array2 = store.getArray(key, ['missing', 'y', 'x', 'x'], makeColumn, makeArray)
+            array3 = store.getArray(key, ['x', 'z'], makeColumn, makeArray)
+            self.assertTrue(array1 is array2)
+            self.assertEqual(set(array1.dtype.names), set(['x', 'y']))
+            numpy.testing.assert_equal(array1['y'], columns['y'][mask])
+            numpy.testing.assert_equal(array3['z'], columns['z'][mask])
+            self.assertFalse(array1.flags.writeable)
+            self.assertFalse(store.getColumn(key, 'x', makeColumn).flags.writeable)
+        self.assertEqual(store.maskKey(mask1), store.maskKey(mask2))
+        self.assertNotEqual(store.maskKey(mask1), store.maskKey(mask3))
+        self.assertEqual(store.maskKey([mask1, mask3]), store.maskKey([mask2, mask3]))
+        # Each column was made once per distinct mask
+        self.assertEqual(n_made, {'x': 2, 'y': 2, 'z': 2, 'missing': 2})
+        summary = store.summary()
+        self.assertEqual(summary['n_arrays'], 4)
+        self.assertEqual(summary['n_columns'], 8)
+        self.assertEqual(summary['array_reuses'], 5)
+        self.assertEqual(summary['column_reuses'], 5)
+        self.assertEqual(summary['column_bytes'], 2*3*5*8)
+        store.clear()
+        self.assertEqual(store.summary()['n_arrays'], 0)
+
+    def test_LoadConcurrently(self):
+        """Test concurrent loading against a fake butler serving FITS files with some latency."""
+        latency = 0.2
+
+        class FakeDataRef(object):
+            def __init__(self, file_name):
+                self.file_name = file_name
+
+            def get(self):
+                time.sleep(latency)
+                if self.file_name is None:
+                    raise RuntimeError('No catalog for this dataRef')
+                return stile.ReadFITSTable(self.file_name)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            data_refs = []
+            for i in range(8):
+                file_name = os.path.join(tmp_dir, 'cat%i.fits'%i)
+                stile.file_io.fits_handler.writeto(file_name, stile.FormatArray(
+                    numpy.array([[i, 0.5*i], [i+1, 0.5*i+1]]), fields=['id', 'x']))
+                data_refs.append(FakeDataRef(file_name))
+            data_refs.insert(3, FakeDataRef(None))
+
+            start = time.time()
+            loaded, failed = stile.stile_utils.LoadConcurrently(lambda ref: ref.get(), data_refs,
+                                                                n_workers=4)
+            self.assertLess(time.time()-start, 0.5*latency*len(data_refs))
+            self.assertEqual([ref for ref, catalog in loaded],
+                             data_refs[:3]+data_refs[4:])
+            numpy.testing.assert_equal([catalog['id'][0] for ref, catalog in loaded], range(8))
+            self.assertEqual(len(failed), 1)
+            self.assertTrue(failed[0][0] is data_refs[3])
+            self.assertTrue(isinstance(failed[0][1], RuntimeError))
+
+            # Loading one at a time gives the same results
+            serial_loaded, serial_failed = stile.stile_utils.LoadConcurrently(
+                lambda ref: ref.get(), data_refs, n_workers=1)
+            self.assertEqual([ref for ref, catalog in serial_loaded],
+                             [ref for ref, catalog in loaded])
+            for (ref, catalog), (serial_ref, serial_catalog) in zip(loaded, serial_loaded):
+                numpy.testing.assert_equal(catalog['x'], serial_catalog['x'])
+
+            # A background load returns at once, and its results can be collected later
+            start = time.time()
+            pending = stile.stile_utils.LoadConcurrently(lambda ref: ref.get(), data_refs,
+                                                         n_workers=4, wait=False)
+            self.assertLess(time.time()-start, latency)
+            prefetched, prefetch_failed = pending.get()
+            self.assertTrue(pending.ready())
+            self.assertEqual([ref for ref, catalog in prefetched], [ref for ref, catalog in loaded])
+
+            # Other exceptions are not skipped
+            self.assertRaises(IOError, stile.stile_utils.LoadConcurrently,
+                              lambda ref: stile.ReadFITSTable(ref), [data_refs[0].file_name,
+                              os.path.join(tmp_dir, 'missing.fits')], n_workers=2)
+
+            # An abandoned background load, or one that raised, leaves the remaining items unloaded
+            n_loaded = []
+
+            def countingLoad(ref):
+                if ref is None:
+                    raise IOError('No file for this dataRef')
+                n_loaded.append(ref.get())
+            pending = stile.stile_utils.LoadConcurrently(countingLoad, data_refs[:3]+data_refs[4:],
+                                                         n_workers=2, wait=False)
+            pending.terminate()
+            self.assertLessEqual(len(n_loaded), 2)
+            del n_loaded[:]
+            self.assertRaises(IOError, stile.stile_utils.LoadConcurrently, countingLoad,
+                              [None]+data_refs[:3]+data_refs[4:], n_workers=2)
+            self.assertLessEqual(len(n_loaded), 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_PackedFlags(self):
+        """Test that PackedFlags masks agree with combining the flag columns one at a time."""
+        numpy.random.seed(7)
+        n = 1000
+        # More than 64 flags, so they take more than one word
+        flag_columns = [('flag%i'%i, numpy.random.uniform(size=n) < 0.05) for i in range(70)]
+        flag_columns.append(('nchild', numpy.random.randint(0, 3, size=n)))
+        flags = stile.stile_utils.PackedFlags(flag_columns)
+        columns = dict(flag_columns)
+        self.assertEqual(len(flags), n)
+        self.assertIn('flag69', flags)
+        self.assertNotIn('flag70', flags)
+        for keep_false, keep_true in [(['flag0'], []), (['flag%i'%i for i in range(70)], []),
+                                      (['flag3', 'flag65', 'nchild'], ['flag66']),
+                                      ([], ['flag1', 'flag68']), ([], [])]:
+            expected = numpy.ones(n, dtype=bool)
+            for name in keep_false:
+                expected &= columns[name] == False
+            for name in keep_true:
+                expected &= columns[name] == True
+            mask = flags.getMask(keep_false=keep_false, keep_true=keep_true)
+            numpy.testing.assert_equal(mask, expected)
+            # The cached masks shouldn't be changed by changing the returned mask
+            mask[:] = False
+            numpy.testing.assert_equal(flags.getMask(keep_false=keep_false[::-1],
+                                                     keep_true=keep_true), expected)
+            # Subsets of rows should get subsets of the masks
+            rows = columns['flag2'] == False
+            subset = flags.select(rows)
+            self.assertEqual(len(subset), numpy.count_nonzero(rows))
+            numpy.testing.assert_equal(subset.getMask(keep_false, keep_true), expected[rows])
+            numpy.testing.assert_equal(
+                subset.select([0, 5, 2]).getMask(keep_false, keep_true), expected[rows][[0, 5, 2]])
+        # Flags that weren't packed (eg because they aren't in the schema) are named in the error
+        self.assertRaisesRegexp(KeyError, 'flag70', flags.getMask, keep_false=['flag70'])
+        self.assertRaises(ValueError, flags.getMask, keep_false=['flag1'], keep_true=['flag1'])
+        self.assertRaises(ValueError, stile.stile_utils.PackedFlags,
+                          [('a', [True]), ('b', [True, False])])
+
 
 if __name__ == '__main__':
     unittest.main()